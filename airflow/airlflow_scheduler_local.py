@@ -37,7 +37,8 @@ start = DummyOperator(task_id='start', dag=dag)
 
 run_pipeline = BashOperator(
     task_id='run_pipeline',
-    bash_command='bash '+CURRENT_DIR+'/execute.sh ' + pipeline_conf['date'] + ' ' + pipeline_conf['env'],
+    bash_command='bash '+CURRENT_DIR+'/execute.sh ' + pipeline_conf['date'] + ' ' + pipeline_conf['env'] + ' ' +
+                 str(pipeline_conf.get('workers', 1)),
     dag=dag
 )
 start >> run_pipeline
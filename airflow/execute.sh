@@ -3,5 +3,5 @@
 DIR=$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )
 
 source $DIR/../env/bin/activate
-python $DIR/../ga-bq-pipeline/run_pipeline.py -d $1 -e $2
+python $DIR/../ga-bq-pipeline/run_pipeline.py -d $1 -e $2 -w ${3:-1}
 deactivate
\ No newline at end of file
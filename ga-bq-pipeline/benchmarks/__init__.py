@@ -0,0 +1 @@
+"""Offline benchmarks, run from the ga-bq-pipeline folder with python -m benchmarks.<name>"""
@@ -0,0 +1,405 @@
+"""
+In-process fakes of BigQuery, Cloud Storage and the Analytics Management API, so the pipeline runs end to end without
+a network connection or credentials.
+
+    from benchmarks.fakes import FakeServices, offline_pipeline
+    services = FakeServices(hits)
+    pipeline = offline_pipeline(services, date='20200101', workers=4)
+    pipeline.execute()
+
+The BigQuery fake answers the hits queries of daily runs from a dataframe of hits, such as one from
+benchmarks.hits. Load jobs and uploads read the whole file, as the real clients do, but only keep its size.
+"""
+import fnmatch
+import os
+import re
+import tempfile
+import threading
+import time
+import zlib
+import yaml
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+from ga_bq_pipeline.bq_etl import PIPELINE, APP_NAME, LOGGER_NAME, HIT_CONDITION
+
+READ_SIZE = 1024 * 1024
+
+SELECT_FIELD_RE = re.compile(r'jsonPayload\.(\w+)')
+NOT_NULL_RE = re.compile(r'jsonPayload\.(\w+) IS NOT NULL')
+ORDER_BY_RE = re.compile(r'ORDER BY jsonPayload\.(\w+), timestamp')
+
+# Environment of offline runs, sections passed to offline_pipeline are merged into these
+OFFLINE_ENV = {
+    'project': {'env': 'offline'},
+    'service_account': 'offline.json',
+    'bigquery': {'project': 'offline', 'dataset': 'analytics', 'table': 'sessions', 'source_project': 'offline',
+                 'source_dataset': 'logs', 'source_table': 'hits_'},
+    'storage': {'project': 'offline', 'bucket': 'offline-sessions'},
+    # No quota to stay inside, the fake's latency stands in for the API
+    'analytics': {'cache_path': ':memory:', 'requests_per_second': 10 ** 6},
+    'output': {'compression': 'gzip', 'load_from': 'storage'},
+    # Offline runs only log their metrics and profiles, they stay out of the run history in cache/
+    'metrics': {'path': ''},
+    'profiler': {'path': ''},
+}
+
+
+def read_size(file_obj, size=None):
+    """
+    Read a file object to the end, or size bytes
+    @return: Number of bytes read
+    """
+    total = 0
+    while size is None or total < size:
+        data = file_obj.read(READ_SIZE if size is None else min(READ_SIZE, size - total))
+        if not data:
+            break
+        total += len(data)
+    return total
+
+
+class Locked:
+    """
+    A fake whose state is guarded by a lock. Copies sent to worker processes started with spawn get a lock of their
+    own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class FakeJob:
+    """
+    A finished BigQuery job
+    """
+
+    def __init__(self, rows=None, total_bytes_processed=None):
+        self.rows = rows
+        self.total_bytes_processed = total_bytes_processed
+
+    def result(self, page_size=None):
+        return self.rows if self.rows is not None else self
+
+
+class FakeRowIterator:
+    """
+    Query results, as a dataframe or as rows
+    """
+
+    def __init__(self, frame=None, rows=None):
+        self.frame = frame
+        self.rows = rows
+
+    @property
+    def total_rows(self):
+        return len(self.frame) if self.frame is not None else len(self.rows)
+
+    def to_dataframe(self, *args, **kwargs):
+        return self.frame.copy()
+
+    def __iter__(self):
+        if self.rows is not None:
+            return iter(self.rows)
+        columns = list(self.frame.columns)
+        field_to_index = {column: i for i, column in enumerate(columns)}
+        return (bigquery.table.Row(values, field_to_index) for values in self.frame.itertuples(index=False))
+
+
+class FakeBigQueryClient(Locked):
+    """
+    Answers the hits queries of daily runs: the projected query, the query ordered by session for streaming, the
+    sessionized ARRAY_AGG query and their dry runs. The day's table has every column of the hits as a jsonPayload
+    field, on any date. Datasets and tables always exist.
+    """
+
+    def __init__(self, hits, storage=None):
+        """
+        @param hits: Dataframe of hits with a timestamp column, e.g. from benchmarks.hits.generate_hits
+        @param storage: FakeStorageClient that load jobs read gs:// URIs from
+        """
+        super().__init__()
+        self.hits = hits
+        self.storage = storage
+        self.queries = []
+        self.loads = []
+
+    @property
+    def payload_fields(self):
+        return [column for column in self.hits.columns if column != 'timestamp']
+
+    def get_dataset(self, dataset):
+        return dataset
+
+    def create_dataset(self, dataset):
+        return dataset
+
+    def get_table(self, table):
+        if not isinstance(table, str):
+            return table
+        payload = bigquery.SchemaField('jsonPayload', 'RECORD', fields=[
+            bigquery.SchemaField(field, 'STRING') for field in self.payload_fields])
+        return bigquery.Table(table, schema=[payload, bigquery.SchemaField('timestamp', 'TIMESTAMP')])
+
+    def create_table(self, table):
+        return table
+
+    def delete_table(self, table, not_found_ok=False):
+        return None
+
+    def query(self, query, job_config=None):
+        with self._lock:
+            self.queries.append(query)
+        select, _, where = query.partition(' FROM ')
+        if 'jsonPayload.*' in select:
+            fields = self.payload_fields
+        else:
+            fields = [field for field in SELECT_FIELD_RE.findall(select) if field in self.hits]
+        fields = list(dict.fromkeys(fields))
+        if 'timestamp <' in where or 'timestamp >' in where:
+            raise NotImplementedError('The fake only answers the queries of daily runs')
+
+        df = self.hits
+        if HIT_CONDITION in where:
+            df = df[~df['t'].isin(['timing', 'adtiming'])]
+        for field in NOT_NULL_RE.findall(where):
+            df = df[df[field].notnull()]
+        if job_config is not None and job_config.dry_run:
+            return FakeJob(total_bytes_processed=int(df[fields + ['timestamp']].memory_usage(deep=True).sum()))
+
+        df = df[fields + ['timestamp']]
+        if 'ARRAY_AGG' in select:
+            return FakeJob(FakeRowIterator(rows=self.session_rows(df, NOT_NULL_RE.findall(where)[0])))
+        order_by = ORDER_BY_RE.search(where)
+        if order_by is not None:
+            df = df.sort_values([order_by.group(1), 'timestamp'], kind='mergesort')
+        return FakeJob(FakeRowIterator(frame=df.reset_index(drop=True)))
+
+    @staticmethod
+    def session_rows(df, session_key):
+        """
+        @return: One row per session, with the session's hits in timestamp order and its first hit time
+        """
+        rows = []
+        for _, hits in df.sort_values('timestamp', kind='mergesort').groupby(session_key, sort=False):
+            hits = hits.to_dict('records')
+            rows.append(bigquery.table.Row((hits, hits[0]['timestamp']), {'hits': 0, 'first_hit': 1}))
+        return rows
+
+    def load_table_from_file(self, file_obj, destination, project=None, job_config=None, location=None, **kwargs):
+        self.record_load('file', destination, read_size(file_obj), job_config)
+        return FakeJob()
+
+    def load_table_from_uri(self, source_uris, destination, project=None, job_config=None, location=None, **kwargs):
+        size = None
+        if self.storage is not None:
+            bucket, _, name = source_uris[len('gs://'):].partition('/')
+            size = self.storage.size(bucket, name)
+        self.record_load(source_uris, destination, size, job_config)
+        return FakeJob()
+
+    def record_load(self, source, destination, size, job_config):
+        with self._lock:
+            self.loads.append({'source': source, 'destination': destination, 'bytes': size,
+                               'format': job_config.source_format if job_config is not None else None,
+                               'job_config': job_config})
+
+
+class FakeBlob:
+
+    def __init__(self, bucket, name, chunk_size=None):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = chunk_size
+
+    def upload_from_file(self, file_obj, size=None, **kwargs):
+        size = read_size(file_obj, size)
+        self.bucket.client.put(self.bucket.name, self.name, size)
+        self.bucket.client.record('uploads', {'name': self.name, 'bytes': size, 'chunk_size': self.chunk_size})
+
+    def compose(self, sources):
+        self.bucket.client.put(self.bucket.name, self.name,
+                               sum(self.bucket.client.size(self.bucket.name, source.name) for source in sources))
+        self.bucket.client.record('composes', {'name': self.name, 'sources': [source.name for source in sources]})
+
+    def delete(self):
+        self.bucket.client.delete(self.bucket.name, self.name)
+
+
+class FakeBucket:
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def blob(self, name, chunk_size=None, **kwargs):
+        return FakeBlob(self, name, chunk_size)
+
+
+class FakeStorageClient(Locked):
+    """
+    Buckets and the size of each object uploaded to them, with a log of the uploads and composes
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.buckets = set()
+        self.objects = {}
+        self.uploads = []
+        self.composes = []
+
+    def bucket(self, name):
+        return FakeBucket(self, name)
+
+    def get_bucket(self, bucket):
+        name = getattr(bucket, 'name', bucket)
+        if name not in self.buckets:
+            raise NotFound('Bucket {} not found'.format(name))
+        return FakeBucket(self, name)
+
+    def create_bucket(self, bucket, **kwargs):
+        name = getattr(bucket, 'name', bucket)
+        self.buckets.add(name)
+        return FakeBucket(self, name)
+
+    def put(self, bucket, name, size):
+        with self._lock:
+            self.objects[(bucket, name)] = size
+
+    def delete(self, bucket, name):
+        with self._lock:
+            self.objects.pop((bucket, name), None)
+
+    def record(self, log, entry):
+        with self._lock:
+            getattr(self, log).append(entry)
+
+    def size(self, bucket, pattern):
+        """
+        @param pattern: Object name, or a wildcard as used in load job URIs
+        @return: Total size of the matching objects
+        """
+        with self._lock:
+            return sum(size for (b, name), size in self.objects.items() if b == bucket and
+                       fnmatch.fnmatchcase(name, pattern))
+
+
+class FakeBatchRequest:
+
+    def __init__(self, api, callback):
+        self.api = api
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        if self.api.latency:
+            time.sleep(self.api.latency)
+        self.api.count(len(self.requests))
+        for request_id, body in self.requests:
+            hashed = self.api.hashed_client_id(body['clientId'], body['webPropertyId'])
+            self.callback(request_id, {'kind': 'analytics#hashClientIdResponse', 'hashedClientId': hashed}, None)
+
+
+class FakeAnalyticsApi(Locked):
+    """
+    Stands in for the Analytics Management API v3 service, only the hashClientId method in batch requests
+    """
+
+    def __init__(self, latency=0):
+        """
+        @param latency: Seconds each batch request takes
+        """
+        super().__init__()
+        self.latency = latency
+        self.batches = 0
+        self.requests = 0
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatchRequest(self, callback)
+
+    def management(self):
+        return self
+
+    def clientId(self):
+        return self
+
+    def hashClientId(self, body):
+        return body
+
+    def count(self, requests):
+        with self._lock:
+            self.batches += 1
+            self.requests += requests
+
+    @staticmethod
+    def hashed_client_id(client_id, property_id):
+        return str(zlib.crc32('{}/{}'.format(property_id, client_id).encode('utf-8')))
+
+
+class FakeServices:
+    """
+    The fakes of one offline run
+    """
+
+    def __init__(self, hits, analytics_latency=0):
+        """
+        @param hits: Dataframe of hits the source tables hold
+        @param analytics_latency: Seconds each hashClientId batch request takes
+        """
+        self.storage = FakeStorageClient()
+        self.bigquery = FakeBigQueryClient(hits, self.storage)
+        self.analytics = FakeAnalyticsApi(analytics_latency)
+
+
+class OfflinePipeline(PIPELINE):
+    """
+    PIPELINE with BigQuery, Cloud Storage and the Analytics API replaced by the fakes of a FakeServices
+    """
+
+    services = None
+
+    @property
+    def bq_client(self):
+        return self.services.bigquery
+
+    @property
+    def gs_client(self):
+        return self.services.storage
+
+    @property
+    def visitor_ids(self):
+        resolver = super().visitor_ids
+        if resolver._api is None:
+            resolver._api = self.services.analytics
+        return resolver
+
+
+def offline_pipeline(services, env=None, **args):
+    """
+    Create an OfflinePipeline, as run_pipeline.py creates the pipeline but with the environment given here
+    @param services: FakeServices
+    @param env: Environment sections, merged into OFFLINE_ENV
+    @param args: Pipeline arguments, e.g. date and workers
+    @return: OfflinePipeline
+    """
+    config = {key: dict(value) if isinstance(value, dict) else value for key, value in OFFLINE_ENV.items()}
+    for key, value in (env or {}).items():
+        config[key] = dict(config.get(key) or {}, **value) if isinstance(value, dict) else value
+    with tempfile.TemporaryDirectory() as conf_path:
+        with open(os.path.join(conf_path, 'offline.yaml'), 'w') as conf:
+            yaml.dump(config, conf)
+        pipeline = OfflinePipeline(app_name=APP_NAME, conf_file_path=conf_path, args_file_name=None,
+                                   logger_name=LOGGER_NAME, env_name='offline')
+    pipeline.services = services
+    return pipeline.with_args(**args)
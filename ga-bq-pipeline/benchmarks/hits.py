@@ -0,0 +1,198 @@
+"""
+Seeded generator of a synthetic day of Google Analytics hits, shaped like the rows the pipeline reads from the day's
+hits table: every hit parameter is a string column, missing parameters are None, and the hit time is in a UTC
+timestamp column.
+
+    from benchmarks.hits import generate_hits
+    df = generate_hits(sessions=10000, hits_per_session=12, impressions=20)
+"""
+import random
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+from ga_bq_pipeline.bq_etl import CUSTOM_DEFINITION_OFFSET, SESSION_ID_CD, USER_AGENT_CD, HIT_FIELDS
+
+PROPERTY_ID = 'UA-12345678-1'
+
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.149 '
+    'Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_3) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/13.0.5 '
+    'Safari/605.1.15',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:74.0) Gecko/20100101 Firefox/74.0',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 13_3 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) '
+    'Version/13.0.5 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (Linux; Android 10; SM-G973F) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.119 '
+    'Mobile Safari/537.36',
+    'Mozilla/5.0 (iPad; CPU OS 12_2 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148',
+]
+BOT_USER_AGENTS = [
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+    'Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)',
+    'Mozilla/5.0 (compatible; AhrefsBot/6.1; +http://ahrefs.com/robot/)',
+]
+SCREENS = [('1920x1080', '1903x937'), ('1440x900', '1440x789'), ('375x812', '375x635'), ('412x869', '412x732')]
+LANGUAGES = ['en-gb', 'en-us', 'fr-fr', 'de-de']
+
+PAGES = [('/', 'Home'), ('/search?q=red%20shoes', 'Search%20results'), ('/basket', 'Basket'),
+         ('/help/delivery', 'Delivery%20%26%20returns'), ('/stores/london', 'Caf%C3%A9%20and%20store')]
+CATEGORIES = ['womens/shoes', 'mens/shirts', 'home/kitchen', 'kids/toys']
+BRANDS = ['Acme', 'Globex', 'Initech']
+REFERRERS = [None, None, None, 'https://www.google.com/', 'https://www.facebook.com/', 'https://t.co/x1',
+             'https://news.example.org/article']
+CAMPAIGNS = [None, None, ('newsletter', 'email', 'spring_sale'), ('facebook', 'social', 'brand'),
+             ('google', 'cpc', 'shoes')]
+EVENTS = [('video', 'play', 'hero'), ('navigation', 'click', 'menu'), ('form', 'submit', 'newsletter'),
+          ('scroll', '75%25', None)]
+
+# Share of each kind of hit after the landing page, the rest are pageviews
+EVENT_SHARE = 0.3
+ECOMMERCE_SHARE = 0.2
+TIMING_SHARE = 0.02
+
+
+def definition_indices(count):
+    """
+    @param count: Number of custom definitions
+    @return: The first count custom definition indices, leaving out the session id and user agent dimensions
+    """
+    reserved = {int(SESSION_ID_CD), int(USER_AGENT_CD)}
+    return [i for i in range(1, CUSTOM_DEFINITION_OFFSET + 1) if i not in reserved][:count]
+
+
+def product(r, sku):
+    """
+    @return: The name, brand, price and variant of a product
+    """
+    return {'nm': 'Product%20{}'.format(sku), 'br': r.choice(BRANDS), 'pr': '{}.99'.format(r.randint(4, 120)),
+            'va': r.choice([None, 'red', 'blue', 'large'])}
+
+
+def generate_hits(sessions=1000, hits_per_session=8, impressions=10, custom_dimensions=20, custom_metrics=5,
+                  bot_share=0.05, date='20200101', seed=1):
+    """
+    @param sessions: Number of sessions in the day
+    @param hits_per_session: Average number of hits per session, the session lengths are exponentially distributed
+    @param impressions: Number of product impressions on the pageviews of category pages
+    @param custom_dimensions: Number of custom dimensions, each with a fixed hit, session or user scope
+    @param custom_metrics: Number of custom metrics
+    @param bot_share: Share of the sessions sent by a bot user agent
+    @param date: Day of the hits, YYYYMMDD
+    @param seed: Random seed
+    @return: Dataframe of hits in timestamp order, with a column for every parameter the transformation reads
+    """
+    r = random.Random(seed)
+    day = datetime.strptime(date, '%Y%m%d').replace(tzinfo=timezone.utc)
+    dimensions = [(i, r.choice('HHSU')) for i in definition_indices(custom_dimensions)]
+    metrics = [(i, r.choice('HHS')) for i in range(1, custom_metrics + 1)]
+    # Most visitors come back during the day, so client ids repeat across sessions
+    clients = ['{}.{}'.format(r.randint(10 ** 8, 10 ** 9), r.randint(10 ** 9, 2 * 10 ** 9))
+               for _ in range(max(1, int(sessions * 0.7)))]
+    skus = ['SKU{:05d}'.format(i) for i in range(500)]
+
+    rows = []
+    for s in range(sessions):
+        bot = r.random() < bot_share
+        screen, viewport = r.choice(SCREENS)
+        session = {'cid': r.choice(clients), 'tid': PROPERTY_ID, 'sr': screen, 'vp': viewport,
+                   'ul': r.choice(LANGUAGES), 'cd' + SESSION_ID_CD: '{}.{}'.format(s, r.randint(10 ** 6, 10 ** 7)),
+                   'cd' + USER_AGENT_CD: r.choice(BOT_USER_AGENTS if bot else USER_AGENTS),
+                   'exp': r.choice([None, None, None, 'Xh3kPqTzS2yLcV.1', 'Xh3kPqTzS2yLcV.0'])}
+        time = day + timedelta(seconds=r.uniform(0, 86000))
+        length = max(1, int(round(r.expovariate(1 / hits_per_session))))
+        basket = []
+        for n in range(length):
+            hit = dict(session, t='pageview', timestamp=time)
+            path, title = r.choice(PAGES)
+            hit['dl'] = 'https://shop.example.com' + path
+            hit['dt'] = title
+            if n == 0:
+                hit['dr'] = r.choice(REFERRERS)
+                campaign = r.choice(CAMPAIGNS)
+                if campaign is not None:
+                    hit['dl'] += '&' if '?' in hit['dl'] else '?'
+                    hit['dl'] += 'utm_source={}&utm_medium={}&utm_campaign={}'.format(*campaign)
+                    hit['cs'], hit['cm'], hit['cn'] = campaign
+            else:
+                kind = r.random()
+                if kind < TIMING_SHARE:
+                    hit['t'] = 'timing'
+                elif kind < TIMING_SHARE + EVENT_SHARE:
+                    hit['t'] = 'event'
+                    hit['ec'], hit['ea'], hit['el'] = r.choice(EVENTS)
+                    hit['ev'] = r.choice([None, '1', '5'])
+                    hit['ni'] = r.choice([None, '1'])
+                elif kind < TIMING_SHARE + EVENT_SHARE + ECOMMERCE_SHARE:
+                    add_ecommerce(r, hit, basket, skus)
+                elif impressions:
+                    category = r.choice(CATEGORIES)
+                    hit['dl'] = 'https://shop.example.com/' + category
+                    hit['dt'] = category.replace('/', '%20-%20')
+                    hit['il1nm'] = category
+                    for p in range(1, impressions + 1):
+                        sku = r.choice(skus)
+                        details = product(r, sku)
+                        hit['il1pi{}id'.format(p)] = sku
+                        hit['il1pi{}nm'.format(p)] = details['nm']
+                        hit['il1pi{}br'.format(p)] = details['br']
+                        hit['il1pi{}pr'.format(p)] = details['pr']
+                        hit['il1pi{}ca'.format(p)] = category
+            add_custom_definitions(r, hit, n, dimensions, metrics)
+            rows.append(hit)
+            time += timedelta(seconds=r.expovariate(1 / 40))
+
+    df = pd.DataFrame(rows)
+    # The table has a field for every parameter, whether or not any hit of the day sent it
+    for field in HIT_FIELDS:
+        if field not in df:
+            df[field] = None
+    df = df.sort_values('timestamp', kind='mergesort').reset_index(drop=True)
+    columns = [column for column in df.columns if column != 'timestamp']
+    df[columns] = df[columns].astype(object).where(df[columns].notnull(), None)
+    df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True)
+    return df
+
+
+def add_ecommerce(r, hit, basket, skus):
+    """
+    Make the hit a product detail, add to basket, checkout or purchase, carrying the products of the basket
+    """
+    action = r.choice(['detail', 'detail', 'add', 'checkout', 'purchase'] if basket else ['detail', 'add'])
+    if action in ['detail', 'add']:
+        sku = r.choice(skus)
+        products = [(sku, product(r, sku))]
+        if action == 'add':
+            basket.extend(products)
+    else:
+        products = list(basket)
+    hit['t'] = 'event'
+    hit['ec'], hit['ea'] = 'ecommerce', action
+    hit['pa'] = action
+    for p, (sku, details) in enumerate(products, 1):
+        hit['pr{}id'.format(p)] = sku
+        hit['pr{}ps'.format(p)] = str(p)
+        for key, value in details.items():
+            hit['pr{}{}'.format(p, key)] = value
+    if products and r.random() < 0.5:
+        hit['pr1cd1'] = r.choice(['sale', 'new', 'bestseller'])
+        hit['pr1cd{}'.format(1 + CUSTOM_DEFINITION_OFFSET)] = 'P'
+    if action == 'checkout':
+        hit['cos'] = str(r.randint(1, 3))
+    elif action == 'purchase':
+        revenue = sum(float(details['pr']) for _, details in products)
+        hit['ti'] = 'T{}'.format(r.randint(10 ** 6, 10 ** 7))
+        hit['tr'], hit['tt'], hit['ts'] = '{:.2f}'.format(revenue), '{:.2f}'.format(revenue / 6), '3.95'
+        hit['cu'] = 'GBP'
+        del basket[:]
+
+
+def add_custom_definitions(r, hit, n, dimensions, metrics):
+    """
+    Set the custom dimensions and metrics of a hit, with their scope parameters. Session and user scoped values are
+    mostly sent on the first hit of the session, hit scoped ones on about a third of the hits.
+    """
+    for definitions, prefix in [(dimensions, 'cd'), (metrics, 'cm')]:
+        for i, scope in definitions:
+            if r.random() < (0.3 if scope == 'H' else 0.8 if n == 0 else 0.05):
+                hit['{}{}'.format(prefix, i)] = 'value{}_{}'.format(i, r.randint(0, 9)) if prefix == 'cd' \
+                    else str(r.randint(1, 20))
+                hit['{}{}'.format(prefix, i + CUSTOM_DEFINITION_OFFSET)] = scope
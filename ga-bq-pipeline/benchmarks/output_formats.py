@@ -0,0 +1,88 @@
+"""
+Compare the output formats on a day of sessions: file size, write time and, optionally, BigQuery load job time.
+
+    python -m benchmarks.output_formats output20200101.jsonl
+    python -m benchmarks.output_formats output20200101.jsonl --table my-project.scratch.format_benchmark
+
+The load jobs replace the contents of the --table table, so point it at a scratch table. Load times are only
+measured against BigQuery, the fake of benchmarks.fakes doesn't load anything, so without --table the formats are only
+compared on size and write time.
+"""
+import argparse
+import gzip
+import json
+import os
+import tempfile
+import time
+from google.cloud import bigquery
+from ga_bq_pipeline.bq_etl import load_job_configs
+from ga_bq_pipeline.schema.tables import export_schema
+from ga_bq_pipeline.sink import create_sink, EXTENSIONS
+
+# (label, format, compression)
+FORMATS = [('json', 'json', None),
+           ('json gzip', 'json', 'gzip'),
+           ('avro deflate', 'avro', 'deflate'),
+           ('parquet snappy', 'parquet', 'snappy'),
+           ('parquet gzip', 'parquet', 'gzip')]
+
+
+def read_sessions(path):
+    """
+    @param path: jsonl or jsonl.gz file of sessions
+    @return: List of sessions
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as source:
+        return [json.loads(line) for line in source if line.strip()]
+
+
+def write(sessions, output_format, compression, directory):
+    """
+    @return: File path, size in bytes and seconds taken to write it
+    """
+    path = os.path.join(directory, 'benchmark' + EXTENSIONS[output_format])
+    start = time.perf_counter()
+    with create_sink(path, output_format, fields=export_schema, compression=compression) as sink:
+        sink.write_all(sessions)
+    elapsed = time.perf_counter() - start
+    return sink.path, os.path.getsize(sink.path), elapsed
+
+
+def load(client, path, output_format, table):
+    """
+    @return: Seconds taken by the load job
+    """
+    config = bigquery.LoadJobConfig.from_api_repr(load_job_configs[output_format].to_api_repr())
+    config.write_disposition = 'WRITE_TRUNCATE'
+    start = time.perf_counter()
+    with open(path, 'rb') as source_file:
+        job = client.load_table_from_file(source_file, table, job_config=config)
+    job.result()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare output formats')
+    parser.add_argument('sessions', help='jsonl output file to read the sessions from')
+    parser.add_argument('--table', help='scratch table to time load jobs against, project.dataset.table')
+    args = parser.parse_args()
+
+    sessions = read_sessions(args.sessions)
+    client = bigquery.Client() if args.table else None
+    print('{} sessions'.format(len(sessions)))
+    print('{:<16}{:>14}{:>12}{:>12}'.format('format', 'bytes', 'write s', 'load s'))
+    with tempfile.TemporaryDirectory() as directory:
+        for label, output_format, compression in FORMATS:
+            try:
+                path, size, write_time = write(sessions, output_format, compression, directory)
+            except Exception as ex:
+                print('{:<16}failed: {}'.format(label, ex))
+                continue
+            load_time = '{:.2f}'.format(load(client, path, output_format, args.table)) if client else '-'
+            print('{:<16}{:>14}{:>12.2f}{:>12}'.format(label, size, write_time, load_time))
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""
+Measure the transformation and whole runs of the pipeline on a synthetic day of hits, offline: BigQuery, Cloud Storage
+and the Analytics API are replaced by the in-process fakes of benchmarks.fakes.
+
+    python -m benchmarks.pipeline
+    python -m benchmarks.pipeline --sessions 20000 --hits-per-session 12 --impressions 20 --workers 4
+    python -m benchmarks.pipeline --only session_func product_func --no-memory
+    python -m benchmarks.pipeline --hits 'replay/hits_{date}*.parquet' --date 20200315
+
+With --hits a recorded day is replayed from NDJSON or Parquet files through the pipeline's files source, rather than
+generated.
+
+Every benchmark reports sessions/s and hits/s, and the peak memory allocated while it runs. Memory is traced in a
+second run of each benchmark, as tracing slows it down, and only covers this process, so it leaves out the transform
+processes of a run with --workers.
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+from benchmarks.fakes import FakeServices, offline_pipeline
+from benchmarks.hits import generate_hits
+from ga_bq_pipeline.bq_etl import PIPELINE, LOGGER_NAME, SESSION_ID_CD, ecommerce_columns, parse_user_agent, unquote
+
+def clear_caches():
+    # Every benchmark starts as a new daily run would
+    unquote.cache_clear()
+    parse_user_agent.cache_clear()
+    ecommerce_columns.cache_clear()
+
+
+class Day:
+    """
+    The synthetic day and the pieces of it the function benchmarks start from
+    """
+
+    def __init__(self, args):
+        self.args = args
+        if args.hits:
+            # Read by the pipeline from the files, the BigQuery fake has no hits
+            self.hits = None
+            self.source = {'type': 'files', 'path': args.hits}
+        else:
+            self.hits = generate_hits(sessions=args.sessions, hits_per_session=args.hits_per_session,
+                                      impressions=args.impressions, custom_dimensions=args.custom_dimensions,
+                                      custom_metrics=args.custom_metrics, bot_share=args.bot_share,
+                                      date=args.date, seed=args.seed)
+            self.source = {}
+        # Read through the pipeline, so the hits are filtered, sorted and decoded as a run reads them
+        self.pipeline = offline_pipeline(FakeServices(self.hits), env={'source': self.source}, date=args.date)
+        self.data = self.pipeline.query_data()
+        self.pipeline.resolve_visitor_ids(self.data)
+        self.totals = self.pipeline.session_totals(self.data)
+        self.hit_fields = PIPELINE.add_hit_fields(self.data.copy())
+        self.sessions, sids = self.pipeline.prepare_data(self.data.copy())
+        self.user_agents = {}
+        for sid in sids:
+            ua = self.pipeline.user_agent(self.sessions[sid])
+            if ua is None or not ua.is_bot:
+                self.user_agents[sid] = ua
+        self.session_hits = sum(len(self.sessions[sid]) for sid in self.user_agents)
+
+    @property
+    def counts(self):
+        """
+        :return: Number of sessions and hits the transformation turns into sessions, leaving out the bots
+        """
+        return len(self.user_agents), self.session_hits
+
+
+def bench_add_custom_definitions(day):
+    PIPELINE.add_custom_definitions(day.hit_fields.copy())
+    return day.data['cd' + SESSION_ID_CD].nunique(), len(day.data)
+
+
+def bench_session_func(day):
+    for sid, ua in day.user_agents.items():
+        day.pipeline.session_func(day.sessions[sid], day.totals.get(sid), ua)
+    return day.counts
+
+
+def bench_process_hit(day):
+    for sid in day.user_agents:
+        obj = day.sessions[sid]
+        for i in range(len(obj)):
+            day.pipeline.process_hit(obj, i)
+    return day.counts
+
+
+def bench_product_func(day):
+    for sid in day.user_agents:
+        obj = day.sessions[sid]
+        for i in range(len(obj)):
+            day.pipeline.product_func(obj, i)
+    return day.counts
+
+
+# The default codec of each binary format
+CODECS = {'avro': 'deflate', 'parquet': 'snappy'}
+
+
+def bench_execute(day):
+    args = day.args
+    services = FakeServices(day.hits, analytics_latency=args.analytics_latency)
+    env = {'source': day.source, 'output': {'format': args.format, 'shards': args.shards}}
+    if args.format != 'json':
+        env['output']['codec'] = CODECS[args.format]
+    pipeline = offline_pipeline(services, env=env, date=args.date, workers=args.workers)
+    pipeline.execute()
+    return day.counts
+
+
+BENCHMARKS = [('add_custom_definitions', bench_add_custom_definitions),
+              ('session_func', bench_session_func),
+              ('process_hit', bench_process_hit),
+              ('product_func', bench_product_func),
+              ('execute', bench_execute)]
+
+
+def measure(function, day, memory):
+    """
+    @return: Sessions and hits processed, seconds taken and the peak traced memory in bytes, None unless memory
+    """
+    clear_caches()
+    start = time.perf_counter()
+    sessions, hits = function(day)
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        clear_caches()
+        tracemalloc.start()
+        try:
+            function(day)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return sessions, hits, seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the pipeline offline on a synthetic day of hits')
+    parser.add_argument('--sessions', type=int, default=1000, help='sessions in the day')
+    parser.add_argument('--hits-per-session', type=int, default=8, help='average hits per session')
+    parser.add_argument('--impressions', type=int, default=10, help='product impressions on category pages')
+    parser.add_argument('--custom-dimensions', type=int, default=20, help='number of custom dimensions')
+    parser.add_argument('--custom-metrics', type=int, default=5, help='number of custom metrics')
+    parser.add_argument('--bot-share', type=float, default=0.05, help='share of sessions sent by bots')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--date', default='20200101', help='date of the day, YYYYMMDD')
+    parser.add_argument('--hits', help='NDJSON or Parquet files of a day of hits to replay, {date} is replaced '
+                                       'with the date')
+    parser.add_argument('--workers', type=int, default=1, help='transform processes of the execute benchmark')
+    parser.add_argument('--format', default='json', choices=['json', 'avro', 'parquet'], help='output format')
+    parser.add_argument('--shards', type=int, default=1, help='output shards')
+    parser.add_argument('--analytics-latency', type=float, default=0,
+                        help='seconds each hashClientId batch request takes')
+    parser.add_argument('--only', nargs='+', choices=[name for name, _ in BENCHMARKS], help='benchmarks to run')
+    parser.add_argument('--no-memory', action='store_true', help="don't trace the peak memory")
+    args = parser.parse_args()
+
+    # Keep the runs' logs out of the report, every pipeline created resets the logger's level
+    logging.getLogger(LOGGER_NAME).disabled = True
+    directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as work:
+        # Runs write their output files to the working directory
+        os.chdir(work)
+        try:
+            day = Day(args)
+            print('{} sessions, {} hits, {} bots'.format(day.data['cd' + SESSION_ID_CD].nunique(), len(day.data),
+                                                          len(day.sessions) - len(day.user_agents)))
+            print('{:<24}{:>10}{:>14}{:>14}{:>10}'.format('benchmark', 'seconds', 'sessions/s', 'hits/s', 'peak MB'))
+            for name, function in BENCHMARKS:
+                if args.only and name not in args.only:
+                    continue
+                sessions, hits, seconds, peak = measure(function, day, not args.no_memory)
+                print('{:<24}{:>10.2f}{:>14,.0f}{:>14,.0f}{:>10}'.format(
+                    name, seconds, sessions / seconds, hits / seconds,
+                    '{:.1f}'.format(peak / 1024 ** 2) if peak is not None else '-'))
+        finally:
+            os.chdir(directory)
+
+
+if __name__ == '__main__':
+    main()
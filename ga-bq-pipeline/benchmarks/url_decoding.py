@@ -0,0 +1,73 @@
+"""
+Compare URL decoding a synthetic day of hits with PIPELINE.decode_hits against unquoting every cell with applymap.
+
+    python -m benchmarks.url_decoding
+    python -m benchmarks.url_decoding --hits 500000 --columns 300
+"""
+import argparse
+import random
+import time
+import urllib.parse
+import numpy as np
+import pandas as pd
+from ga_bq_pipeline.bq_etl import PIPELINE, unquote
+
+PAGE_TITLES = ['Home', 'Caf%C3%A9 menu', 'Search results', 'Basket', 'Checkout %7C Payment', 'Order complete']
+PRODUCT_NAMES = ['T-shirt', 'Jeans%20slim', 'Socks %26 more', 'Hat', 'Scarf']
+
+
+def generate(hits, columns, seed=1):
+    """
+    @param hits: Number of hits
+    @param columns: Number of custom dimension columns, about a third of their cells are set
+    @param seed: Random seed
+    @return: Dataframe of hits with a mix of escaped and plain strings, numbers and empty cells
+    """
+    r = random.Random(seed)
+    data = {
+        'timestamp': pd.date_range('2020-01-01', periods=hits, freq='s'),
+        'dl': ['https://example.com/{}?q=a%20b'.format(r.randint(1, 200)) for _ in range(hits)],
+        'dt': [r.choice(PAGE_TITLES) for _ in range(hits)],
+        'pr1nm': [r.choice(PRODUCT_NAMES + [None] * 5) for _ in range(hits)],
+        'ev': np.arange(hits, dtype=float),
+    }
+    for i in range(1, columns + 1):
+        data['cd{}'.format(i)] = [r.choice(['v{}_{}'.format(i, r.randint(0, 9)), 'a%2Fb', None, None, None])
+                                  for _ in range(hits)]
+    return pd.DataFrame(data)
+
+
+def applymap(df):
+    # DataFrame.applymap was renamed DataFrame.map in pandas 2.1 and removed in pandas 3
+    elementwise = df.map if hasattr(df, 'map') else df.applymap
+    return elementwise(lambda x: urllib.parse.unquote(x) if isinstance(x, str) else x)
+
+
+def timed(function, df):
+    """
+    @return: The decoded dataframe and seconds taken
+    """
+    df = df.copy()
+    start = time.perf_counter()
+    result = function(df)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare URL decoding of the hits')
+    parser.add_argument('--hits', type=int, default=100000, help='number of hits')
+    parser.add_argument('--columns', type=int, default=100, help='number of custom dimension columns')
+    args = parser.parse_args()
+
+    df = generate(args.hits, args.columns)
+    print('{} hits, {} columns'.format(*df.shape))
+    expected, applymap_time = timed(applymap, df)
+    unquote.cache_clear()
+    result, decode_time = timed(PIPELINE.decode_hits, df)
+    print('{:<16}{:>10.2f}s'.format('applymap', applymap_time))
+    print('{:<16}{:>10.2f}s'.format('decode_hits', decode_time))
+    print('speedup {:.1f}x, identical: {}'.format(applymap_time / decode_time, expected.equals(result)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,7 @@
 from google.cloud import bigquery, storage
 import argparse
+import copy
+import threading
 from abc import ABCMeta
 import yaml
 import os
@@ -32,6 +34,9 @@ class ETL(metaclass=ABCMeta):
 
     This methods are called by the execute() method and they run in sequence.
 
+    The BigQuery and Cloud Storage clients are created once per thread rather than once per ETL, as the clients
+    aren't thread safe and the days of a backfill and the parts of a composite upload run on threads of their own.
+
     """
     def __init__(self, app_name, conf_file_path, args_file_name, logger_name, env_name=None):
         """
@@ -42,6 +47,7 @@ class ETL(metaclass=ABCMeta):
         :param logger_name: logger name
         """
         self.__get_arguments(args_file_name)
+        self._clients = threading.local()
 
         # configure the logging
         self._logger = Logger(app_name, logger_name)
@@ -71,6 +77,26 @@ class ETL(metaclass=ABCMeta):
         """
         return self.__args
 
+    def __getstate__(self):
+        # Clients can't be sent to worker processes, each process creates its own
+        state = self.__dict__.copy()
+        del state['_clients']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._clients = threading.local()
+
+    def with_args(self, **args):
+        """
+        A copy of the ETL with some of its arguments replaced, sharing the environment, the logger and the clients
+        :param args: arguments to replace
+        :return: ETL
+        """
+        etl = copy.copy(self)
+        etl.__args = dict(self.__args, **args)
+        return etl
+
     @property
     def env(self):
         """
@@ -90,18 +116,22 @@ class ETL(metaclass=ABCMeta):
     @property
     def bq_client(self):
         """
-        Creates a BigQuery Client
+        Creates a BigQuery Client, once per thread
         :return: BigQuery Client
         """
-        return bigquery.Client()
+        if getattr(self._clients, 'bq', None) is None:
+            self._clients.bq = bigquery.Client()
+        return self._clients.bq
 
     @property
     def gs_client(self):
         """
-        Creates a Cloud Storage Client
+        Creates a Cloud Storage Client, once per thread
         :return: Cloud Storage Client
         """
-        return storage.Client()
+        if getattr(self._clients, 'gs', None) is None:
+            self._clients.gs = storage.Client()
+        return self._clients.gs
 
     @property
     def bigquery(self):
@@ -117,6 +147,13 @@ class ETL(metaclass=ABCMeta):
         """
         return self.env['storage']
 
+    @property
+    def source(self):
+        """
+        Get source properties
+        """
+        return self.env.get('source') or {}
+
     def __get_arguments(self, args_file_name):
         """
         Get all arguments from the arg configuration file and parse them.
@@ -158,6 +195,9 @@ class ETL(metaclass=ABCMeta):
             arg_required = args[arg].get('required', False)
             arg_choices = args[arg].get('choices', None)
             arg_help = args[arg].get('help', None)
+            if args[arg].get('type', None) == 'flag':
+                parser.add_argument('-{0}'.format(short), '--{0}'.format(arg), action='store_true', help=arg_help)
+                continue
             arg_type = int if args[arg].get('type', None) == 'int' else None
 
             parser.add_argument(
@@ -1,23 +1,38 @@
 import urllib.parse as parse_qs
+import json
 from urllib3.util import parse_url as parse
-from datetime import timedelta, date
+from datetime import timedelta, date, datetime
 import re
+import heapq
+import time
+import itertools
+import zlib
+from functools import lru_cache
+from operator import itemgetter
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 from google.api_core.exceptions import NotFound
-from googleapiclient.errors import HttpError
-from googleapiclient.discovery import build
-import jsonlines
-import json
+import numpy as np
+import pandas as pd
 from user_agents import parse as ua_parse
-from google.oauth2 import service_account
 from ga_bq_pipeline.schema.tables import export_schema
+from ga_bq_pipeline.checkpoint import Checkpoint, DEFAULT_CHECKPOINT_PATH
+from ga_bq_pipeline.hit_cache import HitCache, DEFAULT_HIT_CACHE_PATH, DEFAULT_MAX_SIZE_MB
+from ga_bq_pipeline.metrics import Metrics, DEFAULT_METRICS_PATH
+from ga_bq_pipeline.profiler import SessionProfiler, DEFAULT_PROFILE_PATH, DEFAULT_TOP_SESSIONS
+from ga_bq_pipeline.session_state import SessionStateStore, DEFAULT_STATE_PATH, DEFAULT_SESSION_TIMEOUT_MINUTES, \
+    DEFAULT_LATENESS_MINUTES
+from ga_bq_pipeline.source import BigQuerySource, FileSource, missing_as_none
+from ga_bq_pipeline.sink import create_sink, JsonlSink, DEFAULT_FLUSH_ROWS, EXTENSIONS
+from ga_bq_pipeline.sql_transform import SqlTransform
+from ga_bq_pipeline.visitor_id import VisitorIdResolver, DEFAULT_CACHE_PATH, DEFAULT_BATCH_SIZE, DEFAULT_WORKERS, \
+    DEFAULT_REQUESTS_PER_SECOND, DEFAULT_MAX_RETRIES
 from ga_bq_pipeline.schema.array_fields import *
 from ga_bq_pipeline.ETL import *
 
 
 # UPDATE THESE
 CUSTOM_DEFINITION_OFFSET = 100
-TOTAL_CUSTOM_DIMENSIONS = 20
-TOTAL_CUSTOM_METRICS = 20
 USER_AGENT_CD = '30'
 SESSION_ID_CD = '5'
 #Social Source Regex
@@ -39,11 +54,192 @@ LOGGER_NAME = __name__
 
 PYTHON_MIN_VERSION = (3, 6)
 
+# Resumable uploads to Cloud Storage are sent in chunks of this many MB
+UPLOAD_CHUNK_SIZE_MB = 8
+# Files larger than this are uploaded as parallel parts and composed in the bucket
+COMPOSITE_THRESHOLD_MB = 256
+COMPOSITE_PARTS = 8
+# Cloud Storage can compose at most 32 objects at once
+MAX_COMPOSE_SOURCES = 32
+
+# Hits that are never part of a session
+HIT_CONDITION = 'jsonPayload.t != \'timing\' AND jsonPayload.t != \'adtiming\''
+
+# Hit parameters read by the transformation, besides the custom definitions, products and impressions
+HIT_FIELDS = ['cid', 'tid', 't', 'ni', 'dl', 'dt', 'dr', 'cs', 'cm', 'cn', 'ck', 'ct', 'ec', 'ea', 'el', 'ev',
+              'cg1', 'cg2', 'cg3', 'cg4', 'cg5', 'exp', 'pa', 'col', 'cos', 'ti', 'ta', 'tr', 'tt', 'ts', 'tc', 'cu',
+              'sr', 'vp', 'ul', 'cd' + SESSION_ID_CD, 'cd' + USER_AGENT_CD]
+PRODUCT_FIELD_RE = re.compile(r'pr\d+(id|nm|br|pr|va|ps)$|il\d+(nm|pi\d+(id|nm|br|pr|va|ca))$')
+CUSTOM_DEFINITION_FIELD_RE = re.compile(r'(cd|cm|pr1cd|pr1cm|il\d+pi\d+cd)(\d+)$')
+
+# Scopes of the custom definitions, hit, session, user and product
+CUSTOM_DEFINITION_SCOPES = ['H', 'S', 'U', 'P']
+
+# Streaming mode, rows fetched per page and number of complete sessions transformed together
+STREAM_PAGE_SIZE = 10000
+STREAM_LOOKAHEAD = 200
+
 job_config = bigquery.LoadJobConfig(
     schema=export_schema,
     source_format='NEWLINE_DELIMITED_JSON'
 )
 
+# Avro files carry their own schema, DATE columns are written with the date logical type
+avro_job_config = bigquery.LoadJobConfig(
+    source_format='AVRO',
+    use_avro_logical_types=True
+)
+
+parquet_job_config = bigquery.LoadJobConfig(
+    source_format='PARQUET'
+)
+# Load LIST columns as REPEATED fields rather than records wrapping a 'list' field. ParquetOptions and
+# LoadJobConfig.parquet_options only arrived in google-cloud-bigquery 2.x, and the pinned 1.25.0 has no public way to
+# set load.parquetOptions, so the option goes straight into the job resource, which is what to_api_repr sends. Newer
+# clients use the public API.
+try:
+    from google.cloud.bigquery.format_options import ParquetOptions
+    parquet_options = ParquetOptions()
+    parquet_options.enable_list_inference = True
+    parquet_job_config.parquet_options = parquet_options
+except ImportError:
+    parquet_job_config._properties['load']['parquetOptions'] = {'enableListInference': True}
+
+load_job_configs = {'json': job_config, 'avro': avro_job_config, 'parquet': parquet_job_config}
+
+# Distinct hit values kept decoded across chunks of a day
+URL_DECODE_CACHE_SIZE = 100000
+
+# Distinct user agents kept parsed for the life of the process, shared by every day and session it transforms
+USER_AGENT_CACHE_SIZE = 10000
+
+# The pipeline used by process pool workers, set by _init_worker
+_worker_pipeline = None
+
+
+@lru_cache(maxsize=URL_DECODE_CACHE_SIZE)
+def unquote(value):
+    return parse_qs.unquote(value)
+
+
+@lru_cache(maxsize=USER_AGENT_CACHE_SIZE)
+def parse_user_agent(user_agent):
+    return ua_parse(user_agent)
+
+
+def consumed_field(name):
+    """
+    @param name: Hit parameter
+    @return: True if the transformation reads the parameter
+    """
+    if name in HIT_FIELDS or PRODUCT_FIELD_RE.match(name):
+        return True
+    match = CUSTOM_DEFINITION_FIELD_RE.match(name)
+    if match:
+        index = int(match.group(2))
+        # Custom definitions and their scopes, CUSTOM_DEFINITION_OFFSET higher
+        index = index - CUSTOM_DEFINITION_OFFSET if index > CUSTOM_DEFINITION_OFFSET else index
+        return 1 <= index <= CUSTOM_DEFINITION_OFFSET
+    return False
+
+
+def definition_lists(table, hits):
+    """
+    @param table: Rows of a custom_definition_table for a single kind, in hit then index order
+    @param hits: Number of hits
+    @return: List of the custom definitions of every hit, empty_cmd for hits without any
+    """
+    lists = [empty_cmd] * hits
+    rows = zip(table['hit'].tolist(), table['index'].tolist(), table['value'].tolist())
+    for hit, definitions in itertools.groupby(rows, key=itemgetter(0)):
+        lists[hit] = [{'index': index, 'value': value} for _, index, value in definitions]
+    return lists
+
+
+@lru_cache(maxsize=32)
+def ecommerce_columns(columns):
+    """
+    Index of the product and impression columns of a frame, built once per set of columns rather than with a regex
+    scan of every column name on every hit
+    @param columns: Tuple of the frame's column names
+    @return: Dictionary with 'lists', a list of (list name column, list key, [(impression id column, position key)])
+    in column order, and 'products', a list of (product id or name column, product key)
+    """
+    lists = []
+    for column in columns:
+        match = re.search(r'il(\d+)nm', column)
+        if match:
+            key = match.group(1)
+            impression_re = re.compile('il' + key + r'pi\d+id')
+            impressions = [(name, re.search(r'il\d+pi(\d+)id', name).group(1)) for name in columns
+                           if impression_re.search(name)]
+            lists.append((column, key, impressions))
+    products = [(column, int(re.search(r'pr(\d+)(id|nm)', column).group(1))) for column in columns
+                if re.search(r'pr\d+(id|nm)', column)]
+    return {'lists': lists, 'products': products}
+
+
+def session_shard(session_id, shards):
+    """
+    Stable shard number for a session, the same in every process (unlike hash())
+    @param session_id: Session Id
+    @param shards: Number of shards
+    @return: Shard number between 0 and shards - 1
+    """
+    return zlib.crc32(str(session_id).encode('utf-8')) % shards
+
+
+def _init_worker(pipeline):
+    global _worker_pipeline
+    _worker_pipeline = pipeline
+
+
+def _reset_worker_stats():
+    # Each task times and profiles its own sessions, the main process merges them into the run's
+    _worker_pipeline._metrics = None
+    _worker_pipeline._profiler = None
+
+
+def _worker_stats():
+    """
+    @return: Dictionary of the task's metrics snapshot and its session profiler snapshot, None unless profiling,
+    for PIPELINE.merge_worker_stats
+    """
+    profiler = _worker_pipeline.profiler
+    if profiler is not None:
+        # The slowest sessions are replayed here, where their hits are
+        profiler.finish(_worker_pipeline.session_func, _worker_pipeline.session_shape)
+    return {'metrics': _worker_pipeline.metrics.snapshot(),
+            'profiler': profiler.snapshot() if profiler is not None else None}
+
+
+def _transform_shard(shard):
+    """
+    Process pool task, transform the sessions of a single shard
+    @param shard: Tuple of the shard's hits, the session positions and the session totals
+    @return: List of (position, session) tuples in position order, and the task's stats from _worker_stats
+    """
+    hits, positions, totals = shard
+    _reset_worker_stats()
+    with _worker_pipeline.metrics.stage('prepare_data'):
+        dfs, sids = _worker_pipeline.prepare_data(hits)
+    results = [(positions[sids.iloc[x]], session)
+               for x, session in _worker_pipeline.transform_sessions(dfs, sids, totals)]
+    return results, _worker_stats()
+
+
+def _write_shard(shard):
+    """
+    Process pool task, transform the sessions of a single shard and write them to the shard's output file
+    @param shard: Tuple of the shard's hits, the session totals and the output file name
+    @return: The output file name, and the task's stats from _worker_stats
+    """
+    hits, totals, file = shard
+    _reset_worker_stats()
+    with _worker_pipeline.metrics.stage('prepare_data'):
+        dfs, sids = _worker_pipeline.prepare_data(hits)
+    sessions = (session for _, session in _worker_pipeline.transform_sessions(dfs, sids, totals))
+    return _worker_pipeline.write_to_file(sessions, file), _worker_stats()
 
 
 class PIPELINE(ETL):
@@ -58,24 +254,524 @@ class PIPELINE(ETL):
 
     def pipeline(self):
         """
-        1. Fetch the data from BigQuery
-        2. Combine the data into dataframes grouped by session Id
+        1. Fetch the data from BigQuery, or the local files of the source
+        2. Combine the data into dataframes grouped by session Id, or with source sessionize set, have BigQuery
+           group the hits into sessions
         3. Process each session into the output format.
         4. Upload
+
+        Sessions are written to the output file as they are produced. With checkpoints enabled, a retry of the day
+        skips the stages its failed run completed.
+        """
+        if self.transform == 'sql':
+            self.sql_pipeline()
+            return
+        if self.source.get('incremental'):
+            self.incremental_pipeline()
+            return
+        if self.source.get('stream'):
+            self.logger.info("Date: {} (streaming)".format(self.args['date']))
+            self.upload_to_cloud(self.process_stream(self.stream_sessions()))
+            return
+        checkpoint = self.checkpoint
+        if checkpoint is not None and checkpoint.stages:
+            self.logger.info("Date: {} Resuming from the checkpoint, {} stages completed".format(
+                self.args['date'], len(checkpoint.stages)))
+            if checkpoint.done('loaded'):
+                self.logger.info("Date: {} Already loaded".format(self.args['date']))
+                return
+            if checkpoint.done('output') and all(os.path.exists(file) for file in self.output_files):
+                self.load_output()
+                return
+        self.load_sessions(self.get_data(), grouped=self.source.get('sessionize'))
+
+    def load_sessions(self, data, grouped=False):
+        """
+        Transform the sessions of the hits and load them into BigQuery
+        @param data: The dataframe of hits
+        @param grouped: The hits of each session are together, see prepare_grouped_data
+        @return: None
         """
-        data = self.get_data()
-        grouped_sessions, session_ids = self.prepare_data(data)
-        results = self.process_data(grouped_sessions, session_ids)
+        self.resolve_visitor_ids(data)
+        totals = self.session_totals(data)
+        if self.workers > 1 and self.output_shards > 1:
+            self.write_shards_parallel(data, totals)
+            self.mark_checkpoint('output')
+            self.load_output()
+            return
+        if self.workers > 1:
+            results = self.process_data_parallel(data, totals)
+        else:
+            prepare = self.prepare_grouped_data if grouped else self.prepare_data
+            with self.metrics.stage('prepare_data'):
+                grouped_sessions, session_ids = prepare(data)
+            results = (session for _, session in self.transform_sessions(grouped_sessions, session_ids, totals))
         self.upload_to_cloud(results)
 
+    def incremental_pipeline(self):
+        """
+        Transform only the hits that have reached the day's table since the last run, up to the source
+        lateness_minutes before now. They're stitched to the hits of the sessions that were still open after the last
+        run. Sessions without a hit in the last session_timeout_minutes, or all of them once the day is over, are
+        loaded into the day's partition, the others are kept in the state store until a later run closes them.
+        """
+        day = self.args['date']
+        watermark, open_hits = self.session_state.load(day)
+        upper = self.incremental_upper
+        if watermark is not None and watermark >= upper:
+            self.logger.info("Date: {} No new hits since {}".format(day, watermark))
+            return
+        self.logger.info("Date: {} (incremental, hits after {} up to {})".format(day, watermark, upper))
+
+        hits = self.query_data(after=watermark, until=upper)
+        hits = hits[hits['cd' + SESSION_ID_CD].notnull()]
+        if open_hits is not None:
+            hits = pd.concat([open_hits, hits], ignore_index=True, sort=False)
+
+        # No more hits can reach the table once the day is over, so every session is closed
+        timeout = pd.Timedelta(minutes=self.source.get('session_timeout_minutes', DEFAULT_SESSION_TIMEOUT_MINUTES))
+        if upper >= pd.Timestamp(day, tz='UTC') + pd.Timedelta(days=1):
+            closed = pd.Series(True, index=hits.index)
+        else:
+            last_hit = hits.groupby('cd' + SESSION_ID_CD, sort=False)['timestamp'].transform('max')
+            closed = last_hit <= upper - timeout
+
+        closed_hits = hits[closed].reset_index(drop=True)
+        open_hits = hits[~closed].reset_index(drop=True)
+        self.logger.info("Date: {} {} sessions closed, {} still open".format(
+            day, closed_hits['cd' + SESSION_ID_CD].nunique(), open_hits['cd' + SESSION_ID_CD].nunique()))
+        if len(closed_hits) > 0:
+            self.load_sessions(closed_hits)
+        # Only once the sessions are loaded, a failed run reads the same hits again
+        self.session_state.save(day, upper, open_hits)
+
+    @property
+    def incremental_upper(self):
+        """
+        The timestamp an incremental run reads hits up to, fixed for the run
+        :return: Timestamp
+        """
+        if getattr(self, '_incremental_upper', None) is None:
+            lateness = pd.Timedelta(minutes=self.source.get('lateness_minutes', DEFAULT_LATENESS_MINUTES))
+            self._incremental_upper = (pd.Timestamp.now(tz='UTC') - lateness).floor('s')
+        return self._incremental_upper
+
+    @property
+    def session_state(self):
+        """
+        The incremental run state store, opened once
+        :return: SessionStateStore
+        """
+        if getattr(self, '_session_state', None) is None:
+            self._session_state = SessionStateStore(self.source.get('state_path', DEFAULT_STATE_PATH))
+        return self._session_state
+
+    def sql_pipeline(self):
+        """
+        Transform the day in BigQuery with an INSERT ... SELECT into the destination table, see sql_transform.
+        Python only builds the side table of each session's Full Visitor Id and device, leaving out the bots.
+        """
+        if not isinstance(self.hit_source, BigQuerySource):
+            raise ValueError('The SQL transform runs in BigQuery on the day\'s table, it needs the bigquery source')
+        self.logger.info("Date: {} (SQL transform)".format(self.args['date']))
+        transform = SqlTransform(self.source_fields(), session_key='cd' + SESSION_ID_CD,
+                                 user_agent_key='cd' + USER_AGENT_CD, condition=HIT_CONDITION,
+                                 offset=CUSTOM_DEFINITION_OFFSET)
+        side_table = '{}.{}.{}_sessions{}'.format(self.bigquery['project'], self.bigquery['dataset'],
+                                                  self.bigquery['table'], self.args['date'])
+        self.load_side_table(side_table, transform.side_table_schema,
+                             self.session_side_rows(transform.first_hits_query(self.source_table)))
+        try:
+            destination = '{}.{}.{}'.format(self.bigquery['project'], self.bigquery['dataset'],
+                                            self.bigquery['table'])
+            with self.metrics.stage('sql_transform'):
+                self.bq_client.query(transform.compile(self.source_table, destination, side_table)).result()
+            self.metrics.count('bigquery_queries')
+        finally:
+            self.bq_client.delete_table(side_table, not_found_ok=True)
+        self.logger.info("Date: {} Completed".format(self.args['date']))
+
+    def session_side_rows(self, query):
+        """
+        @param query: The query for the first hit of each session
+        @return: Generator of side table rows, the visitId, clientId, fullVisitorId and device of each session that
+        isn't a bot
+        """
+        df = self.decode_hits(self.bq_client.query(query).result().to_dataframe())
+        self.metrics.count('bigquery_queries')
+        self.resolve_visitor_ids(df)
+        for hit in df.to_dict('records'):
+            user_agent = hit.get('cd' + USER_AGENT_CD)
+            ua = parse_user_agent(user_agent) if user_agent else None
+            if ua is not None and ua.is_bot:
+                continue
+            client_id = str(hit['cid'])
+            yield {'visitId': hit['cd' + SESSION_ID_CD],
+                   'clientId': client_id,
+                   'fullVisitorId': self.get_full_visitor_id(client_id, hit['tid'])['hashedClientId'],
+                   'device': self.device_info(ua, hit.get('sr'), hit.get('vp'), hit.get('ul'))}
+
+    def load_side_table(self, table, schema, rows):
+        """
+        Replace the side table with the rows
+        @param table: Table name
+        @param schema: Table schema
+        @param rows: Iterable of rows
+        @return: None
+        """
+        with JsonlSink('sessions' + self.args['date'] + '.jsonl') as sink:
+            sink.write_all(rows)
+        try:
+            with open(sink.path, 'rb') as source_file:
+                job = self.bq_client.load_table_from_file(
+                    file_obj=source_file,
+                    destination=table,
+                    project=self.bigquery['project'],
+                    job_config=bigquery.LoadJobConfig(schema=schema, source_format='NEWLINE_DELIMITED_JSON',
+                                                      write_disposition='WRITE_TRUNCATE'),
+                    location='EU'
+                )
+            job.result()
+        finally:
+            os.remove(sink.path)
+
+    @property
+    def metrics(self):
+        """
+        The stage timers and counters of the run, shared by every day of a backfill
+        :return: Metrics
+        """
+        if getattr(self, '_metrics', None) is None:
+            self._metrics = Metrics()
+        return self._metrics
+
+    def merge_worker_stats(self, stats):
+        """
+        Merge the metrics and session profile of a process pool task into the run's
+        @param stats: The task's stats, from _worker_stats
+        @return: None
+        """
+        self.metrics.merge(stats['metrics'])
+        if stats['profiler'] is not None:
+            self.profiler.merge(stats['profiler'])
+
+    @property
+    def profiler(self):
+        """
+        The slow session profiler of the run, shared by every day of a backfill
+        :return: SessionProfiler, None unless profiling is enabled
+        """
+        settings = self.env.get('profiler') or {}
+        if not settings.get('enabled'):
+            return None
+        if getattr(self, '_profiler', None) is None:
+            self._profiler = SessionProfiler(top=settings.get('top', DEFAULT_TOP_SESSIONS),
+                                             cprofile=settings.get('cprofile', False))
+        return self._profiler
+
+    @staticmethod
+    def session_shape(obj):
+        """
+        @param obj: Session object
+        @return: Dictionary of the session's number of hits, products, impressions, product and impression columns
+        set and custom definitions set
+        """
+        columns = [column for column in obj.columns if obj[column].notnull().any()]
+        product_columns = [column for column in columns if PRODUCT_FIELD_RE.match(column)]
+        definitions = [match for match in map(CUSTOM_DEFINITION_FIELD_RE.match, columns)
+                       if match and int(match.group(2)) <= CUSTOM_DEFINITION_OFFSET]
+        return {'hits': len(obj),
+                'products': int(sum(obj[column].notnull().sum() for column in product_columns
+                                    if re.match(r'pr\d+id$', column))),
+                'impressions': int(sum(obj[column].notnull().sum() for column in product_columns
+                                       if re.match(r'il\d+pi\d+id$', column))),
+                'product_columns': len(product_columns),
+                'custom_definitions': len(definitions)}
+
+    def write_profile(self):
+        """
+        Write the slow session profile report to the profiler path (cache/profiles unless set, an empty path only
+        logs the summary) and log its summary. Profiling only diagnoses the run, so a failure to write the report is
+        logged rather than raised.
+        @return: None
+        """
+        profiler = self.profiler
+        if profiler is None or not profiler.sessions:
+            return
+        try:
+            profiler.finish(self.session_func, self.session_shape)
+            directory = (self.env.get('profiler') or {}).get('path', DEFAULT_PROFILE_PATH)
+            path = None
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+                path = os.path.join(directory, 'sessions{}{}.txt'.format(
+                    self.args['date'], '-' + self.args['end_date'] if self.args.get('end_date') else ''))
+                with open(path, 'w') as file:
+                    file.write(profiler.report())
+            slowest = profiler.slowest
+            self.logger.info('Session profile: {} sessions, slowest {:.3f}s ({}){}'.format(
+                profiler.sessions, slowest[0]['seconds'], slowest[0]['session_id'],
+                ', report in {}'.format(path) if path else ''))
+        except Exception as ex:
+            self.logger.error('Session profile failed: {}'.format(ex))
+
+    def write_metrics(self, error=None):
+        """
+        Log the run's metrics record as a line of JSON and append it to the metrics file (cache/metrics.jsonl unless
+        the metrics path is set, an empty path only logs it)
+        @param error: The exception the run failed with, None if it succeeded
+        @return: None
+        """
+        record = self.metrics.record(app=APP_NAME, environment=(self.env.get('project') or {}).get('env'),
+                                     date=self.args['date'], end_date=self.args.get('end_date'),
+                                     transform=self.transform, workers=self.workers,
+                                     status='failed' if error is not None else 'succeeded',
+                                     error=str(error) if error is not None else None)
+        line = Metrics.to_json(record)
+        self.logger.info('Metrics: {}'.format(line))
+        path = (self.env.get('metrics') or {}).get('path', DEFAULT_METRICS_PATH)
+        if path:
+            Metrics.write(line, path)
+
+    @property
+    def checkpoint(self):
+        """
+        The day's checkpoint, only kept for batch runs of the Python transform. Streaming and incremental runs never
+        hold the whole day, and the SQL transform runs in a single BigQuery script.
+        :return: Checkpoint, None unless checkpoints are enabled
+        """
+        settings = self.env.get('checkpoint') or {}
+        if not settings.get('enabled') or self.transform == 'sql' or self.source.get('stream') or \
+                self.source.get('incremental'):
+            return None
+        if getattr(self, '_checkpoint', None) is None:
+            self._checkpoint = Checkpoint(
+                os.path.join(settings.get('path', DEFAULT_CHECKPOINT_PATH), self.args['date']),
+                {'bigquery': self.bigquery, 'source': self.source, 'output': self.output, 'workers': self.workers})
+        return self._checkpoint
+
+    def mark_checkpoint(self, stage):
+        """
+        Record a stage of the day as completed, if checkpoints are enabled
+        @param stage: Stage name
+        @return: None
+        """
+        if self.checkpoint is not None:
+            self.checkpoint.mark(stage)
+
+    @property
+    def transform(self):
+        """
+        Where the sessions are transformed, 'python' or 'sql'
+        :return: transform mode from the environment configuration
+        """
+        return self.env.get('transform') or 'python'
+
+    @property
+    def output(self):
+        """
+        Output file settings
+        :return: output properties from the environment configuration
+        """
+        return self.env.get('output') or {}
+
+    @property
+    def output_extension(self):
+        """
+        :return: The output file extension for the format and compression
+        """
+        extension = EXTENSIONS[self.output_format]
+        if self.output_format == 'json' and self.output.get('compression') == 'gzip':
+            extension += '.gz'
+        return extension
+
+    @property
+    def output_name(self):
+        """
+        :return: The output file name without the extension. Incremental runs add the time they read hits up to, so
+        each run's file is kept in the bucket
+        """
+        if self.source.get('incremental') and self.transform != 'sql':
+            return 'output{}-{}'.format(self.args['date'], self.incremental_upper.strftime('%H%M%S'))
+        return 'output' + self.args['date']
+
+    @property
+    def output_file(self):
+        """
+        :return: The name of the day's output file
+        """
+        return self.output_name + self.output_extension
+
+    @property
+    def output_shards(self):
+        """
+        Number of files the output is split into. Sessions are assigned to a shard by a hash of the session id.
+        :return: shard count
+        """
+        return int(self.output.get('shards') or 1)
+
+    def shard_file(self, shard):
+        """
+        The shard count is part of the name, so a wildcard over one run's shards never picks up files left in the
+        bucket by a run with a different count.
+        @param shard: Shard number, or '*' for a wildcard matching every shard
+        @return: The name of the shard's output file
+        """
+        shard = shard if shard == '*' else '{:05d}'.format(shard)
+        return '{}-{}-of-{:05d}{}'.format(self.output_name, shard, self.output_shards, self.output_extension)
+
+    @property
+    def output_files(self):
+        """
+        :return: The names of the day's output files, the single output file or one per shard
+        """
+        if self.output_shards > 1:
+            return [self.shard_file(shard) for shard in range(self.output_shards)]
+        return [self.output_file]
+
+    @property
+    def output_format(self):
+        """
+        :return: The output file format, json, avro or parquet
+        """
+        return self.output.get('format') or 'json'
+
+    @property
+    def workers(self):
+        """
+        Number of processes used to transform the sessions
+        :return: worker count
+        """
+        return self.args.get('workers') or 1
+
     def post_execution(self):
         """
-        1. If the JSON file has been created, upload it to cloud storage.
+        1. Write the slow session profile report, while the Full Visitor Id resolver its replays use is open.
+        2. If the output files have been created, upload them to cloud storage, unless they were loaded from there.
+        3. Close the Full Visitor Id cache and the incremental run state store.
+        4. Report the user agent cache hit rate, for the sessions transformed in this process.
+        """
+        self.write_profile()
+        self.upload_output_files()
+        if getattr(self, '_visitor_ids', None) is not None:
+            stats = self._visitor_ids.stats
+            self.logger.info('Full Visitor Id cache: {hits} hits, {misses} misses'.format(**stats))
+            self.metrics.count('visitor_id_cache_hits', stats['hits'])
+            self.metrics.count('visitor_id_cache_misses', stats['misses'])
+            self.metrics.count('analytics_requests', stats['requests'])
+            self.metrics.count('analytics_batches', stats['batches'])
+            self._visitor_ids.close()
+            self._visitor_ids = None
+        if getattr(self, '_session_state', None) is not None:
+            self._session_state.close()
+            self._session_state = None
+        cache = parse_user_agent.cache_info()
+        if cache.hits + cache.misses:
+            self.logger.info('User agent cache: {} hits, {} misses, {:.1%} hit rate, {} of {} entries'.format(
+                cache.hits, cache.misses, cache.hits / (cache.hits + cache.misses), cache.currsize, cache.maxsize))
+
+    def upload_output_files(self):
+        """
+        Upload the day's output files that have been created to cloud storage, unless they were loaded from there,
+        and remove them. With checkpoints enabled the files are kept until the day is loaded, for its retry to load,
+        and the checkpoint is removed once they're uploaded.
+        @return: None
+        """
+        checkpoint = self.checkpoint
+        if checkpoint is not None and not checkpoint.done('loaded'):
+            return
+        for file in self.output_files:
+            if os.path.exists(file):
+                if file not in self.uploaded:
+                    self.upload_to_gs(file)
+                os.remove(file)
+        if checkpoint is not None:
+            checkpoint.clear()
+
+    @property
+    def days(self):
+        """
+        :return: The dates to run, YYYYMMDD, from date to end_date inclusive
         """
-        file = 'output{}.jsonl'.format(self.args['date'])
-        if file in os.listdir():
-            self.upload_to_gs(file)
-            os.remove(file)
+        start = datetime.strptime(self.args['date'], '%Y%m%d')
+        end = datetime.strptime(self.args.get('end_date') or self.args['date'], '%Y%m%d')
+        return [(start + timedelta(days=i)).strftime('%Y%m%d') for i in range((end - start).days + 1)]
+
+    def backfill(self):
+        """
+        Run the pipeline for every day of the date range, concurrent_days at a time. The days share the BigQuery and
+        Cloud Storage clients of the thread they run on, the Full Visitor Id resolver and cache, the incremental run
+        state store and the user agent cache. A failed day doesn't stop the others, each day's result is logged once
+        they have all finished.
+        @return: None
+        """
+        days = self.days
+        concurrent_days = max(1, min(self.args.get('concurrent_days') or 1, len(days)))
+        self.logger.info('Backfill of {} days from {} to {}, {} at a time'.format(len(days), days[0], days[-1],
+                                                                                   concurrent_days))
+        self._init_shared_resources()
+        with ThreadPoolExecutor(max_workers=concurrent_days) as pool:
+            results = list(pool.map(self.run_day, days))
+
+        failed = [day for day, error, _ in results if error is not None]
+        for day, error, seconds in results:
+            self.logger.info('Date: {} {} in {:.1f}s{}'.format(day, 'Failed' if error else 'Succeeded', seconds,
+                                                              ': {}'.format(error) if error else ''))
+        self.logger.info('Backfill: {} days succeeded, {} failed'.format(len(days) - len(failed), len(failed)))
+        if failed:
+            raise Exception('Backfill failed for {}'.format(', '.join(failed)))
+
+    def _init_shared_resources(self):
+        """
+        Create the run's metrics, session profiler, hit cache, Full Visitor Id resolver and, for incremental runs,
+        state store before the days of a backfill start, so every day uses the same ones rather than each creating its
+        own
+        @return: List of the resources, None for those that aren't enabled
+        """
+        resources = [self.metrics, self.profiler, self.hit_cache, self.visitor_ids]
+        if self.source.get('incremental'):
+            resources.append(self.session_state)
+        return resources
+
+    def run_day(self, day):
+        """
+        Run the pipeline for a single day of a backfill
+        @param day: Date, YYYYMMDD
+        @return: Tuple of the day, the exception it failed with or None, and the seconds it took
+        """
+        pipeline = self.with_args(date=day)
+        pipeline._uploaded = None
+        pipeline._incremental_upper = None
+        pipeline._checkpoint = None
+        start = time.perf_counter()
+        error = None
+        try:
+            try:
+                pipeline.pipeline()
+            finally:
+                pipeline.upload_output_files()
+        except Exception as ex:
+            self.logger.error('Date: {} Failed! {}'.format(day, ex))
+            error = ex
+        return day, error, time.perf_counter() - start
+
+    @property
+    def visitor_ids(self):
+        """
+        The Full Visitor Id resolver, created once and reused for every session
+        :return: VisitorIdResolver
+        """
+        if getattr(self, '_visitor_ids', None) is None:
+            analytics = self.env.get('analytics') or {}
+            self._visitor_ids = VisitorIdResolver(self.service_account, self.logger,
+                                                  cache_path=analytics.get('cache_path', DEFAULT_CACHE_PATH),
+                                                  batch_size=analytics.get('batch_size', DEFAULT_BATCH_SIZE),
+                                                  workers=analytics.get('workers', DEFAULT_WORKERS),
+                                                  requests_per_second=analytics.get('requests_per_second',
+                                                                                    DEFAULT_REQUESTS_PER_SECOND),
+                                                  burst=analytics.get('burst'),
+                                                  max_retries=analytics.get('max_retries', DEFAULT_MAX_RETRIES))
+        return self._visitor_ids
 
     def check_create_tables(self):
         bq = self.bq_client
@@ -99,45 +795,231 @@ class PIPELINE(ETL):
 
     def check_create_bucket(self):
         gs = self.gs_client
-        bucket = storage.Bucket(client=gs, name=self.storage['bucket'], project=self.storage['project'])
         try:
-            gs.get_bucket(bucket)
+            gs.get_bucket(self.storage['bucket'])
         except NotFound:
-            gs.create_bucket(bucket, location='EU', project=self.storage['project'])
+            gs.create_bucket(self.storage['bucket'], location='EU', project=self.storage['project'])
         return
 
-    def query_data(self):
+    @property
+    def source_table(self):
+        """
+        :return: The day's hits table
+        """
+        return '{}.{}.{}'.format(self.bigquery['source_project'], self.bigquery['source_dataset'],
+                                 self.bigquery['source_table'] + self.args['date'])
+
+    def source_fields(self):
+        """
+        The hit parameters in the day's table that the transformation reads, see consumed_field
+        @return: List of jsonPayload field names
+        """
+        table = self.bq_client.get_table(self.source_table)
+        payload = next(field for field in table.schema if field.name == 'jsonPayload')
+        return [field.name for field in payload.fields if consumed_field(field.name)]
+
+    def build_query(self, order_by=None, condition=None, projection=True):
+        """
+        The query for all the hits from the relevant date. This may need to be updated depending on how your hits
+        are ingested into BigQuery
+        @param order_by: ORDER BY clause
+        @param condition: Additional WHERE condition
+        @param projection: Only select the hit parameters the transformation reads, rather than jsonPayload.*
+        @return: Query string
         """
-        This queries the BigQuery table to get all the hits from the relevant date. This may need to be updated
-        depending on how your hits are ingested into BigQuery
+        columns = ', '.join('jsonPayload.' + field for field in self.source_fields()) if projection \
+            else 'jsonPayload.*'
+        query = 'SELECT {columns}, timestamp FROM {table} WHERE {condition}'.format(
+            columns=columns, table=self.source_table, condition=HIT_CONDITION)
+        if condition:
+            query += ' AND ' + condition
+        if order_by:
+            query += ' ORDER BY ' + order_by
+        return query
+
+    @property
+    def hit_source(self):
         """
-        query = 'SELECT jsonPayload.*, timestamp FROM {project}.{dataset}.{table} WHERE jsonPayload.t !=\'timing\' ' \
-                'AND jsonPayload.t != \'adtiming\' ORDER BY timestamp'.format(project=self.bigquery['source_project'],
-                                                                              dataset=self.bigquery['source_dataset'],
-                                                                              table=self.bigquery['source_table'] +
-                                                                                    self.args['date'])
-        query_req = self.bq_client.query(query)
-        rows = query_req.result()
-        df = bigquery.table.RowIterator.to_dataframe(rows)
-        df = df.applymap(lambda x: parse.unquote(x) if isinstance(x, str) else x)
+        Where the day's hits are read from, set by the source type: the day's BigQuery table (bigquery, the default)
+        or local NDJSON or Parquet files (files) matching the source path
+        :return: BigQuerySource or FileSource
+        """
+        source_type = self.source.get('type') or 'bigquery'
+        if source_type == 'bigquery':
+            return BigQuerySource(self)
+        if source_type == 'files':
+            return FileSource(self.source['path'], self.args['date'], file_format=self.source.get('format'),
+                              field_filter=consumed_field, fields=HIT_FIELDS)
+        raise ValueError('Unsupported source type: {}'.format(source_type))
+
+    def query_data(self, after=None, until=None):
+        """
+        This reads all the hits from the relevant date from the hit source, the BigQuery table unless the source
+        type is set. The hits aren't sorted, prepare_data puts each session's hits in timestamp order.
+        @param after: Only read the hits after this timestamp
+        @param until: Only read the hits up to this timestamp
+        """
+        def read():
+            return self.decode_hits(self.hit_source.read(after=after, until=until))
+
+        with self.metrics.stage('query_data'):
+            if after is None and until is None:
+                df = self.read_hits(lambda: self.hit_source.query(), read)
+            else:
+                df = read()
+        self.metrics.count('hits', len(df))
+        return df
+
+    @property
+    def hit_cache(self):
+        """
+        The local cache of the hits read from BigQuery, shared by every day of a backfill
+        :return: HitCache, None unless the hit cache is enabled
+        """
+        settings = self.env.get('hit_cache') or {}
+        if not settings.get('enabled'):
+            return None
+        if getattr(self, '_hit_cache', None) is None:
+            self._hit_cache = HitCache(settings.get('path', DEFAULT_HIT_CACHE_PATH),
+                                       max_size_mb=settings.get('max_size_mb', DEFAULT_MAX_SIZE_MB),
+                                       max_age_hours=settings.get('max_age_hours'))
+        return self._hit_cache
+
+    def read_hits(self, query, read):
+        """
+        Read the day's hits through the hit cache, when it's enabled and they're read from the day's BigQuery table.
+        A cached copy is used while the table hasn't been modified since it was made, see HitCache.get. With the
+        no_hit_cache argument the cache isn't read, but the copy is still replaced with the hits read.
+        @param query: Function returning the query the hits are read with, part of the cache key
+        @param read: Function reading the hits from the source and decoding them
+        @return: Dataframe of decoded hits
+        """
+        cache = self.hit_cache
+        if cache is None or not isinstance(self.hit_source, BigQuerySource):
+            return read()
+        key = HitCache.key(self.source_table, self.args['date'], query())
+        modified = self.bq_client.get_table(self.source_table).modified
+        if not self.args.get('no_hit_cache'):
+            df = cache.get(key, modified)
+            if df is not None:
+                self.logger.info("Date: {} Hits read from the hit cache".format(self.args['date']))
+                self.metrics.count('hit_cache_hits')
+                return df
+        self.metrics.count('hit_cache_misses')
+        df = read()
+        for removed in cache.put(key, df, modified):
+            self.logger.info('Hit cache: removed {}'.format(removed))
         return df
 
+    def build_session_query(self):
+        """
+        The query for the day's sessions, with the hits grouped into one row per session in BigQuery
+        @return: Query string
+        """
+        session_key = 'cd' + SESSION_ID_CD
+        columns = ', '.join('jsonPayload.{0} AS {0}'.format(field) for field in self.source_fields())
+        return 'SELECT ARRAY_AGG(STRUCT({columns}, timestamp) ORDER BY timestamp) AS hits, ' \
+               'MIN(timestamp) AS first_hit FROM {table} WHERE {condition} AND jsonPayload.{key} IS NOT NULL ' \
+               'GROUP BY jsonPayload.{key}'.format(columns=columns, table=self.source_table,
+                                                   condition=HIT_CONDITION, key=session_key)
+
+    def query_sessions(self):
+        """
+        Read the day's sessions from the hit source, grouped in BigQuery for the bigquery source, see
+        build_session_query. The hits are flattened into one dataframe with each session's hits together, in the
+        order of the sessions' first hits.
+        @return: Dataframe of hits
+        """
+        with self.metrics.stage('query_sessions'):
+            df = self.read_hits(self.build_session_query,
+                                lambda: self.decode_hits(self.hit_source.read_sessions('cd' + SESSION_ID_CD)))
+        self.metrics.count('hits', len(df))
+        return df
+
+    def query_bytes(self, query):
+        """
+        @param query: Query string
+        @return: Bytes the query would scan, from a dry run
+        """
+        job = self.bq_client.query(query, job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False))
+        return job.total_bytes_processed
+
+    def query_report(self, query):
+        """
+        Log the bytes scanned by the query against the unprojected SELECT jsonPayload.* query
+        @param query: Query string
+        @return: None
+        """
+        scanned = self.query_bytes(query)
+        full = self.query_bytes(self.build_query(order_by='timestamp', projection=False))
+        self.logger.info('Query scans {:,} bytes, {:,} bytes with SELECT jsonPayload.* ({:.0%} less)'.format(
+            scanned, full, 1 - scanned / full if full else 0))
+
     @staticmethod
-    def collapse_session_cdm(cdm):
-        """
-        @param cdm: An array of Custom Dimensions or Metrics in the form {index: x, value: y}
-        @return: A formatted array of Custom Dimensions or Metrics
-        """
-        values = list(map(lambda x: {x.get('index'): x.get('value')}, cdm))
-        values = list(filter(lambda x: x != {None: None}, values))
-        obj = {}
-        arr = []
-        for item in values:
-            for k, v in item.items():
-                obj[k] = v
-        for k, v in obj.items():
-            arr.append({'index': k, 'value': v})
-        return arr if len(arr) > 0 else empty_cmd
+    def decode_hits(df):
+        """
+        URL decode the hit values. Only string columns are looked at and only values containing an escape are
+        decoded, each distinct value once, and the decoded values are mapped back onto the column in place.
+        @param df: Dataframe of hits
+        @return: Decoded dataframe
+        """
+        for column in df.columns:
+            values = df[column]
+            if not pd.api.types.is_string_dtype(values.dtype):
+                continue
+            decoded = {value: unquote(value) for value in values.unique() if isinstance(value, str) and '%' in value}
+            if decoded:
+                decoded_values = values.map(decoded)
+                df[column] = values.where(decoded_values.isnull(), decoded_values)
+        return df
+
+    def stream_sessions(self):
+        """
+        Read the hits ordered by session id and timestamp from the hit source, a page at a time from BigQuery, so only
+        the current session is held in memory. Missing values are None, as in the dataframes of the other modes.
+        @return: Generator of session dataframes, each containing every hit of one session
+        """
+        session_key = 'cd' + SESSION_ID_CD
+        hits = []
+        for row in self.hit_source.stream(session_key, STREAM_PAGE_SIZE):
+            if hits and row[session_key] != hits[0][session_key]:
+                self.metrics.count('hits', len(hits))
+                yield self.decode_hits(missing_as_none(pd.DataFrame(hits)))
+                hits = []
+            hits.append(row)
+        if hits:
+            self.metrics.count('hits', len(hits))
+            yield self.decode_hits(missing_as_none(pd.DataFrame(hits)))
+
+    def process_stream(self, sessions):
+        """
+        Transform sessions as they arrive. Sessions are collected STREAM_LOOKAHEAD at a time so their Full Visitor
+        Ids can still be requested together.
+        @param sessions: Iterable of session dataframes, e.g. from stream_sessions
+        @return: Generator of sessions
+        """
+        if self.workers > 1:
+            self.logger.warning('Streaming mode transforms sessions in a single process, ignoring workers')
+        chunk = []
+        for obj in sessions:
+            chunk.append(obj)
+            if len(chunk) >= STREAM_LOOKAHEAD:
+                yield from self.process_chunk(chunk)
+                chunk = []
+        if chunk:
+            yield from self.process_chunk(chunk)
+
+    def process_chunk(self, chunk):
+        """
+        @param chunk: List of session dataframes
+        @return: Generator of sessions
+        """
+        hits = pd.concat(chunk, ignore_index=True, sort=False)
+        self.resolve_visitor_ids(hits)
+        with self.metrics.stage('prepare_data'):
+            dfs, sids = self.prepare_grouped_data(hits)
+        for _, session in self.transform_sessions(dfs, sids, self.session_totals(hits)):
+            yield session
 
     # noinspection PyBroadException
     @staticmethod
@@ -155,32 +1037,6 @@ class PIPELINE(ETL):
         except Exception:
             return default
 
-    def custom_definition(self, obj, key, limit, y, def_type, scope):
-        """
-        @param obj: The Session object
-        @param key: The key that assigns to the custom definition
-        @param limit: The number of custom dimensions to look through
-        @param y: The hit number
-        @param def_type: is this a dimension or metric?
-        @param scope: The scope of the custom dimension/metric.
-        @return: An array containing an index and value column.
-        """
-        df = []
-        for i in range(1, limit + 1):
-            result = {}
-            var = key + str(i)
-            var_s = key + str(i + CUSTOM_DEFINITION_OFFSET)
-            try:
-                if obj.get(var).iloc[y] is not None:
-                    if obj.get(var_s).iloc[y] in scope:
-                        result['index'] = i
-                        value = self.retrieve_value(obj, var, y)
-                        result['value'] = int(value) if def_type == 'metric' else value
-                        df.append(result.copy())
-            except (KeyError, AttributeError):
-                pass
-        return df if df != [] else empty_cmd
-
     def get_hit_time(self, session, index):
         """
         @param session: The session object
@@ -226,8 +1082,8 @@ class PIPELINE(ETL):
             'productListName': self.retrieve_value(session_obj, 'pr' + i + 'nm', n),
             'isImpression': is_impression,
             'isClick': is_click,
-            'customDimensions': self.custom_definition(session_obj, 'pr1cd', int(TOTAL_CUSTOM_DIMENSIONS), n, 'dimension', ['P']),
-            'customMetrics': self.custom_definition(session_obj, 'pr1cm', int(TOTAL_CUSTOM_METRICS), n, 'dimension', ['P'])
+            'customDimensions': session_obj['_productCustomDimensions'].iloc[n],
+            'customMetrics': session_obj['_productCustomMetrics'].iloc[n]
         }
         return obj
 
@@ -241,13 +1097,15 @@ class PIPELINE(ETL):
         click_id = self.retrieve_value(session_obj, 'pr1id', n) if session_obj.get('pa').iloc[n] == 'click' else None
         products = []
         product_impression_click = False
+        columns = ecommerce_columns(tuple(session_obj.columns))
+
+        def is_set(column):
+            return pd.notnull(session_obj[column].iat[n])
 
         if session_obj.get('pa').iloc[n] == 'click' or session_obj.get('pa').iloc[n] is None:
-            lists = session_obj.filter(regex='il\d+nm').iloc[n].dropna()
-            list_keys = list(lists.index.map(lambda x: str(re.search('il(\d+)nm', x).group(1))))
-            for key in list_keys:
-                impressions = session_obj.filter(regex='il' + key + 'pi\d+id').iloc[n].dropna()
-                impression_keys = list(impressions.index.map(lambda x: str(re.search('il\d+pi(\d+)id', x).group(1))))
+            list_keys = [(key, impressions) for column, key, impressions in columns['lists'] if is_set(column)]
+            for key, impressions in list_keys:
+                impression_keys = [i for column, i in impressions if is_set(column)]
                 if len(impression_keys) > 0:
                     impression_keys.sort()
                     for i in impression_keys:
@@ -269,11 +1127,10 @@ class PIPELINE(ETL):
                             'productListName': self.retrieve_value(session_obj, 'il' + str(key) + 'nm', n),
                             'isImpression': True,
                             'isClick': is_click,
-                            'customDimensions': self.custom_definition(session_obj, 'il' + key + 'pi' + i + 'cd', int(TOTAL_CUSTOM_DIMENSIONS), n,
-                                                                       'dimension', ['P']),
-                            'customMetrics': self.custom_definition(session_obj, 'il' + key + 'pi  ' + i + 'cm', int(TOTAL_CUSTOM_METRICS), n,
-                                                                    'metric',
-                                                                    ['P'])
+                            'customDimensions': (session_obj['_impressionCustomDimensions'].iloc[n] or {}).get(
+                                'il' + key + 'pi' + i + 'cd', empty_cmd),
+                            # Impression custom metrics have never been read
+                            'customMetrics': empty_cmd
                         }
                         # Product Custom Dimensions
                         hits_product = {k: hits_product.get(k) for k in hits_product_order}
@@ -288,8 +1145,7 @@ class PIPELINE(ETL):
             products.append(hits_product_action.copy())
 
         if session_obj.get('pa').iloc[n] in ['checkout', 'purchase']:
-            prods = session_obj.filter(regex='pr\d+(id|nm)').iloc[n].dropna()
-            product_keys = list(set(list(prods.index.map(lambda x: int(re.search('pr(\d+)(id|nm)', x).group(1))))))
+            product_keys = list(set(i for column, i in columns['products'] if is_set(column)))
             product_keys.sort()
             for i in product_keys:
                 i = str(i)
@@ -308,49 +1164,29 @@ class PIPELINE(ETL):
         @param i: Hit Index
         @return: The processed hit row
         """
-        output = {'customDimensions': [], 'customMetrics': [], 'product': [], 'isExit': ''}
+        output = {'customDimensions': [], 'customMetrics': [], 'product': []}
         hitsContentGroup = {}
         hitsPage = {}
         hits_transaction = {}
 
         expRe = '(.*)\.(\d+)'
 
-        first_hit = self.get_hit_time(session, 0)
-
         # Declare Variables
-        hit_time = self.get_hit_time(session, i)
         url = session.get('dl').iloc[i]
         groups = parse(url)
 
-        # Hit Values
-        output['hitNumber'] = int(i + 1)
+        # Hit Values, precomputed for the whole day by add_hit_fields
+        output['hitNumber'] = int(session['_hitNumber'].iloc[i])
         try:
             output['type'] = hitType.get(session.get('t').iloc[i]) or session.get('t').iloc[i]
         except AttributeError:
             output['type'] = None
-        output['time'] = int(round(timedelta.total_seconds(hit_time - first_hit) * 1000))
-        output['hour'] = int(hit_time.time().hour)
-        output['minute'] = int(hit_time.time().minute)
-        if i == 0:
-            output['isEntrance'] = str('true')
-        else:
-            output['isEntrance'] = None
-        j = len(session)
-        while j > 0:
-            if session.get('ni').iloc[j - 1] != '1':
-                if i == (j - 1):
-                    output['isExit'] = str('true')
-                    break
-                else:
-                    output['isExit'] = None
-                    break
-            else:
-                output['isExit'] = None
-            j -= 1
-        if session['ni'].iloc[i] == '1':
-            output['isInteraction'] = str('false')
-        else:
-            output['isInteraction'] = str('true')
+        output['time'] = int(session['_time'].iloc[i])
+        output['hour'] = int(session['_hour'].iloc[i])
+        output['minute'] = int(session['_minute'].iloc[i])
+        output['isEntrance'] = session['_isEntrance'].iloc[i]
+        output['isExit'] = session['_isExit'].iloc[i]
+        output['isInteraction'] = session['_isInteraction'].iloc[i]
         # Event Values
 
         hitsEventInfo = {'eventCategory': self.retrieve_value(session, 'ec', i),
@@ -361,8 +1197,8 @@ class PIPELINE(ETL):
 
         output['eventInfo'] = hitsEventInfo.copy()
 
-        output['customDimensions'] = self.custom_definition(session, 'cd', int(TOTAL_CUSTOM_DIMENSIONS), i, 'dimension', ['H'])
-        output['customMetrics'] = self.custom_definition(session, 'cm', int(TOTAL_CUSTOM_METRICS), i, 'metric', ['H'])
+        output['customDimensions'] = session['_customDimensions'].iloc[i]
+        output['customMetrics'] = session['_customMetrics'].iloc[i]
 
         # Hit Content Groups
         for k in range(1, 6):
@@ -427,25 +1263,47 @@ class PIPELINE(ETL):
         # Add hit to list of hits
         return {k: output.get(k) for k in hits_order}
 
-    def device_func(self, obj):
+    def device_func(self, obj, ua=None):
         """
         Reformat the device format. In this, values have been sent with the hits, but if User Agent has been saved
         this could be parsed in a similar way. This equates to the 'deviceInformation' record.
         @param obj: Session object
+        @param ua: The session's parsed user agent, from user_agent if not given
+        @return: The device information
+        """
+        if ua is None:
+            ua = self.user_agent(obj)
+        return self.device_info(ua, self.retrieve_value(obj, 'sr', 0), self.retrieve_value(obj, 'vp', 0),
+                                self.retrieve_value(obj, 'ul', 0))
+
+    def user_agent(self, obj):
+        """
+        @param obj: Session object
+        @return: The parsed user agent of the session's first hit, or None if it has none. Each distinct user agent
+        is only parsed once, see parse_user_agent
+        """
+        user_agent = self.retrieve_value(obj, 'cd' + USER_AGENT_CD, 0)
+        return parse_user_agent(user_agent) if user_agent else None
+
+    @staticmethod
+    def device_info(ua, screen_resolution, browser_size, language):
+        """
+        @param ua: Parsed user agent, or None
+        @param screen_resolution: Screen resolution hit value
+        @param browser_size: Viewport size hit value
+        @param language: Language hit value
         @return: The device information
         """
-        user_agent = self.retrieve_value(obj, 'cd'+USER_AGENT_CD, 0)
-        if user_agent:
-            ua = ua_parse(user_agent)
+        if ua is not None:
             if ua.is_pc:
                 device = 'desktop'
             elif ua.is_tablet:
                 device = 'tablet'
             else:
                 device = 'mobile'
-            dev = {'screenResolution': self.retrieve_value(obj, 'sr', 0),
-                   'browserSize': self.retrieve_value(obj, 'vp', 0),
-                   'language': self.retrieve_value(obj, 'ul', 0),
+            dev = {'screenResolution': screen_resolution,
+                   'browserSize': browser_size,
+                   'language': language,
                    'browser': ua.browser.family,
                    'browserVersion': ua.browser.version_string,
                    'deviceCategory': device,
@@ -564,33 +1422,68 @@ class PIPELINE(ETL):
 
         return {k: total[k] for k in totals_order}
 
+    @staticmethod
+    def session_totals(df):
+        """
+        Compute the 'totals' record of every session in one grouped aggregation, matching total_func.
+        @param df: The dataframe of all hits
+        @return: Dictionary of session id to the session totals
+        """
+        df = df[df['cd' + SESSION_ID_CD].notnull()]
+        session_ids = df['cd' + SESSION_ID_CD]
+
+        def matches(column, value):
+            return df[column] == value if column in df else pd.Series(False, index=df.index)
+
+        counts = pd.DataFrame({'pageViews': matches('t', 'pageview'),
+                               'events': matches('t', 'event'),
+                               'ni': matches('ni', '1'),
+                               'purchases': matches('pa', 'purchase'),
+                               'revenue': df['tr'].notnull() if 'tr' in df else False},
+                              index=df.index).groupby(session_ids, sort=False).sum()
+        times = df['timestamp'].groupby(session_ids, sort=False).agg(['min', 'max'])
+
+        totals = pd.DataFrame(index=counts.index)
+        totals['hits'] = counts['pageViews'] + counts['events']
+        totals['pageViews'] = counts['pageViews']
+        totals['timeOnSite'] = (times['max'] - times['min']).dt.total_seconds().astype(int)
+        totals['bounces'] = np.where(totals['hits'] - counts['ni'] <= 1, 1, np.nan)
+        # Transactions are only set for sessions with a purchase, and only if the revenue column exists
+        purchased = (counts['purchases'] > 0) & ('tr' in df)
+        totals['totalTransactionRevenue'] = np.where(purchased, counts['revenue'] * (10 ** 6), np.nan)
+        totals['transactions'] = np.where(purchased, counts['purchases'], np.nan)
+
+        return {sid: {k: None if pd.isnull(v) else int(v) for k, v in row.items()}
+                for sid, row in totals[totals_order].to_dict('index').items()}
+
     def get_full_visitor_id(self, client_id, property_id):
         """
         Fetch the Full Visitor Id from Google Analytics. The exact hash isn't known, so this is best way to do this.
+        Ids are served from the local cache where possible, see resolve_visitor_ids.
         @param client_id: Client Id
         @param property_id: Property Id
         @return: API Response
         """
-        body = {'kind': 'analytics#hashClientIdRequest', 'clientId': client_id, 'webPropertyId': property_id}
-        credentials = service_account.Credentials.from_service_account_file(self.service_account,
-                                                                            scopes=[
-                                                                                'https://www.googleapis.com/auth/analytics.edit'
-                                                                            ]
-                                                                            )
-        api = build('analytics', 'v3', credentials=credentials)
-        try:
-            request = api.management().clientId().hashClientId(body=body)
-            response = request.execute()
-            return response
-        except HttpError as ex:
-            self.logger.error('{} Error: {}'.format(ex.resp.status,
-                                                    json.loads(ex.content)['error']['errors'][0]['message']))
-            return {"hashedClientId": ""}
+        return {'hashedClientId': self.visitor_ids.resolve(client_id, property_id)}
+
+    def resolve_visitor_ids(self, df):
+        """
+        Resolve the Full Visitor Id of every session in the day up front, so uncached client ids are requested in
+        concurrent, rate limited batches rather than one request per session.
+        @param df: The dataframe of all hits
+        @return: None
+        """
+        with self.metrics.stage('resolve_visitor_ids'):
+            first_hits = df.drop_duplicates('cd' + SESSION_ID_CD)
+            pairs = zip(first_hits['cid'].astype(str), first_hits['tid'])
+            self.visitor_ids.resolve_many(pairs)
 
-    def session_func(self, obj):
+    def session_func(self, obj, totals=None, ua=None):
         """
         Function that manages the different processes for each session, converting the hits into a single BQ row.
         @param obj: Session object
+        @param totals: The session's row from session_totals, computed with total_func if not given
+        @param ua: The session's parsed user agent, see device_func
         @return:
         """
         session = {}
@@ -608,24 +1501,19 @@ class PIPELINE(ETL):
         session['visitStartTime'] = first_hit_posix
         session['date'] = first_hit.strftime('%Y-%m-%d')
         # Totals
-        session['totals'] = self.total_func(obj)
+        session['totals'] = dict(totals) if totals is not None else self.total_func(obj)
         # Traffic Source
         session['trafficSource'] = self.traffic_func(obj)
         # Device Information
-        session['device'] = self.device_func(obj)
+        session['device'] = self.device_func(obj, ua)
         # Hit Level information
-        cds = []
-        cms = []
         for y in range(0, len(obj)):
             # Initiate Dicts and Lists
             hit = self.process_hit(obj, y)
             hits.append(hit.copy())
-            cds += self.custom_definition(obj, 'cd', int(TOTAL_CUSTOM_DIMENSIONS), y, 'dimension', ['S', 'U'])
-            cms += self.custom_definition(obj, 'cm', int(TOTAL_CUSTOM_METRICS), y, 'metric', ['S', 'U'])
-        cds = self.collapse_session_cdm(cds)
-        cms = self.collapse_session_cdm(cms)
-        session['customDimensions'] = cds
-        session['customMetrics'] = cms
+        # Session and user scoped custom definitions, collapsed for the whole day by add_custom_definitions
+        session['customDimensions'] = obj['_sessionCustomDimensions'].iloc[0]
+        session['customMetrics'] = obj['_sessionCustomMetrics'].iloc[0]
         session['geoNetwork'] = geo_network
         h = hits[0]
         try:
@@ -636,112 +1524,534 @@ class PIPELINE(ETL):
         session['hits'] = hits
         return {k: session.get(k) for k in session_order}
 
-    def write_to_file(self, obj):
+    def create_sink(self, file):
         """
-        Write the session array to a jsonlines file
-        @param obj: Formatted array of sessions
+        The output compression only gzips JSON files, Avro and Parquet files are compressed with the output codec
+        @param file: Output file name
+        @return: An unopened sink for the output format and compression
+        """
+        compression = self.output.get('compression') if self.output_format == 'json' else self.output.get('codec')
+        return create_sink(file, self.output_format, fields=export_schema, compression=compression,
+                           flush_rows=self.output.get('flush_rows', DEFAULT_FLUSH_ROWS))
+
+    def write_to_file(self, obj, file=None):
+        """
+        Write the sessions to the output file as they're produced, jsonlines unless another output format is set
+        @param obj: Iterable of formatted sessions
+        @param file: Output file name, the day's output file by default
         @return: filename
         """
-        source_file_name = 'output' + self.args['date'] + '.jsonl'
-        with jsonlines.open(source_file_name, mode='w') as writer:
-            writer.write_all(obj)
-        return source_file_name
+        with self.metrics.stage('write_to_file'):
+            with self.create_sink(file or self.output_file) as sink:
+                sink.write_all(obj)
+        self.log_sink(sink)
+        return sink.path
+
+    def write_shards(self, obj):
+        """
+        Write the sessions to one file per shard, each session goes to the shard of its session id
+        @param obj: Iterable of formatted sessions
+        @return: List of filenames
+        """
+        with self.metrics.stage('write_shards'):
+            sinks = [self.create_sink(self.shard_file(shard)).open() for shard in range(self.output_shards)]
+            try:
+                for session in obj:
+                    sinks[session_shard(session['visitId'], self.output_shards)].write(session)
+            finally:
+                for sink in sinks:
+                    sink.close()
+        for sink in sinks:
+            self.log_sink(sink)
+        return [sink.path for sink in sinks]
+
+    def log_sink(self, sink):
+        stats = sink.stats
+        self.logger.info('Wrote {rows} sessions to {file}, {bytes} bytes ({file_bytes} bytes on disk)'.format(
+            file=sink.path, **stats))
+        self.metrics.count('sessions', stats['rows'])
+        self.metrics.count('output_bytes', stats['file_bytes'] or 0)
 
     def upload_to_bq(self, file):
         """
-        Upload the sessions to BigQuery using the jsonl file.
+        Upload the sessions to BigQuery using the output file, with the load job config for its format. BigQuery reads
+        gzip compressed jsonl files as well.
         @param file: File Name
         @return: None
         """
-        with open(file, 'rb') as source_file:
-            job = self.bq_client.load_table_from_file(
-                file_obj=source_file,
+        with self.metrics.stage('upload_to_bq'):
+            with open(file, 'rb') as source_file:
+                job = self.bq_client.load_table_from_file(
+                    file_obj=source_file,
+                    destination='{}.{}.{}'.format(self.bigquery['project'],
+                                                  self.bigquery['dataset'],
+                                                  self.bigquery['table']),
+                    project=self.bigquery['project'],
+                    job_config=load_job_configs[self.output_format],
+                    location='EU'
+                )
+            job.result()
+        self.metrics.count('load_jobs')
+
+    def load_from_gs(self, uri):
+        """
+        Load the sessions into BigQuery from a file already in Cloud Storage
+        @param uri: gs:// URI of the output file
+        @return: None
+        """
+        with self.metrics.stage('load_from_gs'):
+            job = self.bq_client.load_table_from_uri(
+                source_uris=uri,
                 destination='{}.{}.{}'.format(self.bigquery['project'],
                                               self.bigquery['dataset'],
                                               self.bigquery['table']),
                 project=self.bigquery['project'],
-                job_config=job_config,
+                job_config=load_job_configs[self.output_format],
                 location='EU'
             )
-        job.result()
+            job.result()
+        self.metrics.count('load_jobs')
 
     def upload_to_gs(self, file):
         """
-        Save the jsonl file to GCS in case it's needed to reload the data in the future.
+        Save the jsonl file (compressed or not) to GCS in case it's needed to reload the data in the future.
+        The file is sent as a chunked resumable upload, large files are split into parts that are uploaded in
+        parallel and composed into a single object in the bucket.
         @param file: Sessions jsonl file
-        @return: None
+        @return: gs:// URI of the uploaded file
         """
-        bucket = self.gs_client.bucket(self.storage['bucket'])
-        blob = bucket.blob(file)
+        # Chunks must be a multiple of 256KB
+        chunk_size = max(1, int(self.storage.get('chunk_size_mb', UPLOAD_CHUNK_SIZE_MB) * 4)) * 256 * 1024
+        threshold = self.storage.get('composite_threshold_mb', COMPOSITE_THRESHOLD_MB) * 1024 * 1024
+        parts = min(int(self.storage.get('composite_parts', COMPOSITE_PARTS)), MAX_COMPOSE_SOURCES)
+
+        size = os.path.getsize(file)
+        with self.metrics.stage('upload_to_gs'):
+            if parts > 1 and size > threshold:
+                self.composite_upload(file, size, parts, chunk_size)
+            else:
+                self.upload_part(file, file, 0, size, chunk_size)
+        self.metrics.count('storage_uploads')
+        self.metrics.count('uploaded_bytes', size)
+        return 'gs://{}/{}'.format(self.storage['bucket'], file)
+
+    @property
+    def uploaded(self):
+        """
+        :return: Set of the output files already uploaded to cloud storage
+        """
+        if getattr(self, '_uploaded', None) is None:
+            self._uploaded = set()
+        return self._uploaded
 
+    def upload_part(self, file, name, offset, size, chunk_size):
+        """
+        Resumable upload of a byte range of a file. Each thread uses its own client so parts can be sent from
+        different threads.
+        @param file: Local file
+        @param name: Object name
+        @param offset: Start of the range
+        @param size: Number of bytes to upload
+        @param chunk_size: Resumable upload chunk size, a multiple of 256KB
+        @return: The uploaded blob
+        """
+        bucket = self.gs_client.bucket(self.storage['bucket'])
+        blob = bucket.blob(name, chunk_size=chunk_size)
         with open(file, 'rb') as source_file:
-            blob.upload_from_file(source_file)
-            source_file.close()
+            source_file.seek(offset)
+            blob.upload_from_file(source_file, size=size)
+        return blob
+
+    def composite_upload(self, file, size, parts, chunk_size):
+        """
+        Upload a file as parallel parts and compose them into one object
+        @param file: Local file
+        @param size: File size
+        @param parts: Number of parts
+        @param chunk_size: Resumable upload chunk size
+        @return: None
+        """
+        # Parts have to be whole chunks, except the last one
+        part_size = -(-size // parts // chunk_size) * chunk_size
+        ranges = [(offset, min(part_size, size - offset)) for offset in range(0, size, part_size)]
+        self.logger.info('Uploading {} in {} parts'.format(file, len(ranges)))
+        with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+            blobs = list(pool.map(
+                lambda n: self.upload_part(file, '{}.part{}'.format(file, n), ranges[n][0], ranges[n][1], chunk_size),
+                range(len(ranges))))
+        bucket = self.gs_client.bucket(self.storage['bucket'])
+        try:
+            bucket.blob(file).compose(blobs)
+        finally:
+            for blob in blobs:
+                blob.delete()
 
     def get_data(self):
+        checkpoint = self.checkpoint
+        if checkpoint is not None and checkpoint.done('hits'):
+            self.logger.info("Date: {} Hits read from the checkpoint".format(self.args['date']))
+            return checkpoint.load('hits')
         self.logger.info("Date: {}".format(self.args['date']))
-        df = self.query_data()
+        df = self.query_sessions() if self.source.get('sessionize') else self.query_data()
+        if checkpoint is not None:
+            checkpoint.save('hits', df)
+        return df
+
+    @staticmethod
+    def add_hit_fields(df):
+        """
+        Compute the hit number, time, hour, minute, entrance, exit and interaction values of every hit in one pass
+        over the day, rather than hit by hit. Each session's hits must be in timestamp order, hits without a session
+        id are dropped.
+        @param df: The dataframe of all hits
+        @return: The dataframe with the _hitNumber, _time, _hour, _minute, _isEntrance, _isExit and _isInteraction
+        columns added
+        """
+        df = df[df['cd' + SESSION_ID_CD].notnull()].copy()
+        session_ids = df['cd' + SESSION_ID_CD]
+        sessions = df.groupby(session_ids, sort=False)
+
+        position = sessions.cumcount()
+        first_hit = sessions['timestamp'].transform('first')
+        df['_hitNumber'] = position + 1
+        df['_time'] = ((df['timestamp'] - first_hit).dt.total_seconds() * 1000).round().astype(int)
+        df['_hour'] = df['timestamp'].dt.hour
+        df['_minute'] = df['timestamp'].dt.minute
+        df['_isEntrance'] = pd.Series(np.where(position == 0, 'true', None), index=df.index, dtype=object)
+
+        # The exit is the last interaction hit in the session, found by counting interactions from the end
+        ni = df['ni'] if 'ni' in df else pd.Series(None, index=df.index, dtype=object)
+        interaction = ni != '1'
+        remaining = interaction.iloc[::-1].groupby(session_ids.iloc[::-1], sort=False).cumsum().iloc[::-1]
+        df['_isExit'] = pd.Series(np.where(interaction & (remaining == 1), 'true', None), index=df.index,
+                                  dtype=object)
+        df['_isInteraction'] = np.where(interaction, 'true', 'false')
+        return df
+
+    @staticmethod
+    def custom_definition_table(df):
+        """
+        Melt the custom dimensions and metrics of every hit, with their scopes from the parameters
+        CUSTOM_DEFINITION_OFFSET higher, into one long table. Definitions are discovered from the columns, every index
+        up to CUSTOM_DEFINITION_OFFSET that has a scope parameter is included.
+        @param df: The dataframe of hits
+        @return: Dataframe of the hit position, kind (the parameter prefix e.g. cd, cm or pr1cd), index, scope and
+        value of every definition that is set and scoped, in hit, kind then index order
+        """
+        empty = pd.DataFrame({'hit': pd.Series(dtype=int), 'kind': pd.Series(dtype=object),
+                              'index': pd.Series(dtype=int), 'scope': pd.Series(dtype=object),
+                              'value': pd.Series(dtype=object)})
+        definitions = {}
+        for column in df.columns:
+            match = CUSTOM_DEFINITION_FIELD_RE.match(column)
+            if match is None:
+                continue
+            kind, index = match.group(1), int(match.group(2))
+            scope = kind + str(index + CUSTOM_DEFINITION_OFFSET)
+            if 1 <= index <= CUSTOM_DEFINITION_OFFSET and match.group(2) == str(index) and scope in df:
+                definitions[column] = (kind, index, scope)
+        if not definitions:
+            return empty
+
+        values = df[list(definitions)].reset_index(drop=True)
+        scopes = df[[scope for _, _, scope in definitions.values()]].reset_index(drop=True)
+        scopes.columns = values.columns
+        table = pd.DataFrame({'value': values.stack(), 'scope': scopes.stack()})
+        table = table[table['value'].notnull() & table['scope'].isin(CUSTOM_DEFINITION_SCOPES)]
+        if table.empty:
+            return empty
+        columns = table.index.get_level_values(1)
+        table = pd.DataFrame({'hit': table.index.get_level_values(0),
+                              'kind': columns.map({column: kind for column, (kind, _, _) in definitions.items()}),
+                              'index': columns.map({column: index for column, (_, index, _) in definitions.items()}),
+                              'scope': table['scope'].values,
+                              'value': table['value'].values})
+        return table.sort_values(['hit', 'kind', 'index']).reset_index(drop=True)
+
+    @staticmethod
+    def add_custom_definitions(df):
+        """
+        Filter the custom definitions of every hit by scope and collapse each session's session and user scoped
+        definitions, as group operations on the day's custom_definition_table rather than index by index, hit by hit.
+        @param df: The dataframe of hits, from add_hit_fields
+        @return: The dataframe with the hit scoped _customDimensions and _customMetrics, the product scoped
+        _productCustomDimensions, _productCustomMetrics and _impressionCustomDimensions (a dictionary of impression
+        prefix to definitions, or None), and the session's _sessionCustomDimensions and _sessionCustomMetrics columns
+        """
+        table = PIPELINE.custom_definition_table(df)
+        # Hit and session metrics are integers, product metrics are kept as sent
+        metrics = table['kind'] == 'cm'
+        table['value'] = table['value'].astype(object)
+        table.loc[metrics, 'value'] = table.loc[metrics, 'value'].map(int)
+
+        hit_scoped = table[table['scope'] == 'H']
+        product_scoped = table[table['scope'] == 'P']
+        for column, definitions in [('_customDimensions', hit_scoped[hit_scoped['kind'] == 'cd']),
+                                    ('_customMetrics', hit_scoped[hit_scoped['kind'] == 'cm']),
+                                    ('_productCustomDimensions', product_scoped[product_scoped['kind'] == 'pr1cd']),
+                                    ('_productCustomMetrics', product_scoped[product_scoped['kind'] == 'pr1cm'])]:
+            df[column] = pd.Series(definition_lists(definitions, len(df)), index=df.index, dtype=object)
+
+        impressions = [None] * len(df)
+        impression_scoped = product_scoped[~product_scoped['kind'].isin(['pr1cd', 'pr1cm'])]
+        rows = zip(impression_scoped['hit'].tolist(), impression_scoped['kind'].tolist(),
+                   impression_scoped['index'].tolist(), impression_scoped['value'].tolist())
+        for (hit, kind), definitions in itertools.groupby(rows, key=itemgetter(0, 1)):
+            impressions[hit] = impressions[hit] or {}
+            impressions[hit][kind] = [{'index': index, 'value': value} for _, _, index, value in definitions]
+        df['_impressionCustomDimensions'] = pd.Series(impressions, index=df.index, dtype=object)
+
+        # The last value of each index, in order of first appearance in the session
+        session_ids = df['cd' + SESSION_ID_CD]
+        session_scoped = table[table['scope'].isin(['S', 'U'])]
+        session_scoped = session_scoped.assign(session=session_ids.values[session_scoped['hit'].values])
+        for column, kind in [('_sessionCustomDimensions', 'cd'), ('_sessionCustomMetrics', 'cm')]:
+            definitions = session_scoped[session_scoped['kind'] == kind]
+            collapsed = definitions.groupby(['session', 'index'], sort=False)['value'].last()
+            sessions = {}
+            for (session_id, index), value in zip(collapsed.index.tolist(), collapsed.tolist()):
+                sessions.setdefault(session_id, []).append({'index': index, 'value': value})
+            df[column] = pd.Series([sessions.get(session_id, empty_cmd) for session_id in session_ids],
+                                   index=df.index, dtype=object)
         return df
 
     @staticmethod
     def prepare_data(df):
         """
-        Group hits into sessions and return the sessions and the session ids.
+        Group hits into sessions and return the sessions and the session ids. The hits are sorted by session id and
+        timestamp once, so each session is a slice of the dataframe, see prepare_grouped_data.
+        @param df: The dataframe of all hits, in any order
+        @return: Sessions and Session Ids, in the order of the sessions' first hits
+        """
+        df = df[df['cd' + SESSION_ID_CD].notnull()]
+        df = df.sort_values(['cd' + SESSION_ID_CD, 'timestamp'], kind='mergesort').reset_index(drop=True)
+        dfs, _ = PIPELINE.prepare_grouped_data(df)
+        return dfs, PIPELINE.sessions_by_first_hit(df)
+
+    @staticmethod
+    def sessions_by_first_hit(df):
+        """
+        @param df: The dataframe of all hits
+        @return: Series of the session ids in the order of the sessions' first hits, sessions that start at the same
+        time in session id order
+        """
+        first_hits = df.groupby('cd' + SESSION_ID_CD)['timestamp'].min().sort_values(kind='mergesort')
+        return pd.Series(first_hits.index, dtype=object)
+
+    @staticmethod
+    def prepare_grouped_data(df):
+        """
+        prepare_data for hits that already have each session's hits together and in order, from the sessionized
+        query or the stream. Sessions are sliced out of the dataframe rather than grouped.
         @param df: The dataframe of all hits
         @return: Sessions and Session Ids
         """
-        # Group hits into sessions by SESSION_ID_CD
-        dfs = dict(tuple(df.groupby('cd'+SESSION_ID_CD)))
-        sids = df['cd'+SESSION_ID_CD].drop_duplicates()
+        df = PIPELINE.add_custom_definitions(PIPELINE.add_hit_fields(df))
+        session_ids = df['cd' + SESSION_ID_CD]
+        starts = np.flatnonzero((session_ids != session_ids.shift()).values)
+        ends = np.append(starts[1:], len(df))
+        sids = session_ids.iloc[starts]
+        dfs = {sid: df.iloc[start:end] for sid, start, end in zip(sids, starts, ends)}
         return dfs, sids
 
-    def process_data(self, dfs, sids):
+    def process_data(self, dfs, sids, totals=None):
         """
         Create an array of sessions, with each session taking a single row
         @param dfs: The dataframe of sessions
         @param sids: The session ids
+        @param totals: The session totals from session_totals
         @return:
         """
         array = []
         # Fetch the Array
+        for _, session in self.transform_sessions(dfs, sids, totals):
+            # Add session to list
+            array.append(session.copy())
+        return array
+
+    def transform_sessions(self, dfs, sids, totals=None):
+        """
+        Transform sessions in session id order, skipping bots
+        @param dfs: The dataframe of sessions
+        @param sids: The session ids
+        @param totals: The session totals from session_totals
+        @return: Generator of (position in sids, session) tuples
+        """
+        profiler = self.profiler
         for x in range(0, len(sids)):
             # Clear Session Level Values, Dicts and Lists
             key = sids.iloc[x]
             obj = dfs[key]
-            user_agent = self.retrieve_value(obj, 'cd30', 0)
-            if user_agent:
-                ua = ua_parse(user_agent)
-                if ua.is_bot:
+            # Timed a session at a time, as the sessions are consumed by whatever writes them
+            with self.metrics.stage('process_data'):
+                ua = self.user_agent(obj)
+                if ua is not None and ua.is_bot:
+                    self.metrics.count('bots')
                     continue
-            try:
-                session = self.session_func(obj)
-            except Exception as ex:
-                self.logger.critical('There was an Execption: {}'.format(ex))
-                raise Exception(ex)
-            # Add session to list
-            array.append(session.copy())
-        return array
+                session_totals = totals.get(key) if totals is not None else None
+                try:
+                    start = time.perf_counter()
+                    session = self.session_func(obj, session_totals, ua)
+                    if profiler is not None:
+                        profiler.record(time.perf_counter() - start, key, self.args['date'],
+                                        (obj, session_totals, ua))
+                except Exception as ex:
+                    self.logger.critical('There was an Execption: {}'.format(ex))
+                    raise Exception(ex)
+            yield x, session
+
+    def __getstate__(self):
+        """
+        The pipeline as it's sent to the process pool workers, whichever the start method. The run's metrics, session
+        profiler, checkpoint, hit cache and state store stay in the main process, each task creates its own metrics and
+        profiler and sends them back, see _worker_stats. The Full Visitor Id resolver is sent with the ids resolved
+        for the day.
+        """
+        state = super().__getstate__()
+        for name in ['_metrics', '_profiler', '_checkpoint', '_hit_cache', '_session_state']:
+            state.pop(name, None)
+        return state
+
+    def process_data_parallel(self, df, totals):
+        """
+        Transform the sessions on a process pool. Sessions are sharded by a hash of the session id, each worker gets
+        one slice of the hits dataframe and groups it itself, and the results are merged back in the same order as
+        process_data. Each shard's sessions are saved to the checkpoint as it completes, and a retry only transforms the
+        shards that are missing.
+        @param df: The dataframe of all hits
+        @param totals: The session totals from session_totals
+        @return: Generator of sessions
+        """
+        df = df[df['cd' + SESSION_ID_CD].notnull()]
+        sids = self.sessions_by_first_hit(df)
+        positions = dict(zip(sids, range(len(sids))))
+        sid_shards = {sid: session_shard(sid, self.workers) for sid in sids}
+        hit_shards = df['cd' + SESSION_ID_CD].map(sid_shards)
+
+        checkpoint = self.checkpoint
+        results = []
+        stages = []
+        shards = []
+        for shard, hits in df.groupby(hit_shards, sort=False):
+            stage = 'sessions-{}'.format(shard)
+            if checkpoint is not None and checkpoint.done(stage):
+                results.append(checkpoint.load(stage))
+                continue
+            shard_sids = hits['cd' + SESSION_ID_CD].drop_duplicates()
+            stages.append(stage)
+            shards.append((hits,
+                           {sid: positions[sid] for sid in shard_sids},
+                           {sid: totals.get(sid) for sid in shard_sids}))
+
+        self.logger.info('Transforming {} sessions on {} workers, {} of {} shards from the checkpoint'.format(
+            len(sids), self.workers, len(results), len(results) + len(shards)))
+        if shards:
+            with Pool(processes=self.workers, initializer=_init_worker, initargs=(self,)) as pool:
+                for stage, (result, stats) in zip(stages, pool.imap(_transform_shard, shards, chunksize=1)):
+                    self.merge_worker_stats(stats)
+                    if checkpoint is not None:
+                        checkpoint.save(stage, result)
+                    results.append(result)
+        return (session for _, session in heapq.merge(*results, key=lambda result: result[0]))
+
+    def write_shards_parallel(self, df, totals):
+        """
+        Transform the sessions on a process pool, with each task transforming one shard of the sessions and writing
+        it to the shard's output file. Each shard file is recorded in the checkpoint as it's written, and a retry only
+        writes the shards that are missing.
+        @param df: The dataframe of all hits
+        @param totals: The session totals from session_totals
+        @return: List of filenames
+        """
+        df = df[df['cd' + SESSION_ID_CD].notnull()]
+        sid_shards = {sid: session_shard(sid, self.output_shards) for sid in df['cd' + SESSION_ID_CD].unique()}
+        hit_shards = df['cd' + SESSION_ID_CD].map(sid_shards)
+        hits = dict(tuple(df.groupby(hit_shards, sort=False)))
+
+        checkpoint = self.checkpoint
+        shards = []
+        for shard in range(self.output_shards):
+            file = self.shard_file(shard)
+            if checkpoint is not None and checkpoint.done(file) and os.path.exists(file):
+                continue
+            # Empty shards still get a file, so every shard of the run is in the bucket
+            shard_hits = hits.get(shard, df.iloc[:0])
+            shard_sids = shard_hits['cd' + SESSION_ID_CD].unique()
+            shards.append((shard_hits, {sid: totals.get(sid) for sid in shard_sids}, file))
+
+        self.logger.info('Writing {} sessions to {} of {} shards on {} workers'.format(
+            len(sid_shards), len(shards), self.output_shards, self.workers))
+        if shards:
+            with Pool(processes=min(self.workers, len(shards)), initializer=_init_worker, initargs=(self,)) as pool:
+                for file, stats in pool.imap_unordered(_write_shard, shards):
+                    self.merge_worker_stats(stats)
+                    self.mark_checkpoint(file)
+        return self.output_files
+
+    def load_shards(self, files):
+        """
+        Upload the shard files to Cloud Storage concurrently and load them all in a single load job, using a
+        wildcard URI that matches this run's shards
+        @param files: List of shard filenames
+        @return: None
+        """
+        with ThreadPoolExecutor(max_workers=len(files)) as pool:
+            list(pool.map(self.upload_to_gs, files))
+        self.uploaded.update(files)
+        self.load_from_gs('gs://{}/{}'.format(self.storage['bucket'], self.shard_file('*')))
 
     def upload_to_cloud(self, array):
         """
-        Write the sessions to a jsonl file and upload that to BigQuery
-        @param array: The array of sessions
+        Write the sessions to a jsonl file and upload that to BigQuery, either directly or by uploading it to Cloud
+        Storage once and loading it from there. Sharded output is always loaded from Cloud Storage.
+        @param array: Iterable of sessions
+        @return: None
+        """
+        if self.output_shards > 1:
+            self.write_shards(array)
+        else:
+            self.write_to_file(array)
+        self.mark_checkpoint('output')
+        self.load_output()
+
+    def load_output(self):
+        """
+        Load the day's output files into BigQuery, the shards with a single load job from Cloud Storage and a single
+        file as set by load_from
         @return: None
         """
-        file = self.write_to_file(array)
-        self.upload_to_bq(file)
+        if self.output_shards > 1:
+            self.load_shards(self.output_files)
+        elif self.output.get('load_from') == 'storage':
+            uri = self.upload_to_gs(self.output_file)
+            self.uploaded.add(self.output_file)
+            self.load_from_gs(uri)
+        else:
+            self.upload_to_bq(self.output_file)
+        self.mark_checkpoint('loaded')
         self.logger.info("Date: {} Completed".format(self.args['date']))
 
     def execute(self):
         """
-        Execute the ETL pipeline
+        Execute the ETL pipeline, for each day of the date range if an end date is given. The run's metrics record
+        is written at the end, whether it succeeded or not.
         """
-
+        # Created first, so the run's record starts with the run
+        metrics = self.metrics
+        error = None
         try:
-            self.pre_execution_checks()
-            self.pipeline()
+            with metrics.stage('pre_execution_checks'):
+                self.pre_execution_checks()
+            if len(self.days) > 1:
+                self.backfill()
+            else:
+                self.pipeline()
         except Exception as ex:
+            error = ex
             self.logger.critical('Pipeline Failure! {}'.format(ex))
             raise ex
         finally:
-            self.post_execution()
+            try:
+                self.post_execution()
+            finally:
+                self.write_metrics(error)
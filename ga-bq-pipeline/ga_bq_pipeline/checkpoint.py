@@ -0,0 +1,103 @@
+import json
+import os
+import pickle
+import shutil
+from ga_bq_pipeline.ETL import ROOT
+
+# Default directory of the checkpoints, with one directory per day
+DEFAULT_CHECKPOINT_PATH = os.path.join(ROOT, 'cache', 'checkpoints')
+
+MANIFEST_FILE = 'manifest.json'
+
+
+class Checkpoint:
+    """
+    Progress of a day's run, kept on disk so a retry of the day resumes after the last stage or shard that completed
+    rather than starting the day again.
+
+    The manifest lists the completed stages along with the settings of the run that wrote them. Stages can carry a
+    value, such as the fetched hits or a shard's sessions, which is pickled next to the manifest. A checkpoint left by a
+    run with different settings wouldn't match the files this run produces, so it's discarded.
+    """
+
+    def __init__(self, directory, settings):
+        """
+        @param directory: The day's checkpoint directory
+        @param settings: JSON serialisable settings the saved stages depend on
+        """
+        self.directory = directory
+        # Compared as they read back from the manifest
+        self.settings = json.loads(json.dumps(settings, sort_keys=True))
+        self.stages = []
+        manifest = self.read_manifest()
+        if manifest is not None:
+            if manifest.get('settings') == self.settings:
+                self.stages = manifest.get('stages') or []
+            else:
+                self.clear()
+
+    def read_manifest(self):
+        """
+        @return: The manifest, None if there is no checkpoint or it can't be read
+        """
+        try:
+            with open(os.path.join(self.directory, MANIFEST_FILE)) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def write_manifest(self):
+        # Replaced in one step, so a run killed while writing it leaves the previous manifest
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, MANIFEST_FILE)
+        with open(path + '.tmp', 'w') as file:
+            json.dump({'settings': self.settings, 'stages': self.stages}, file)
+        os.replace(path + '.tmp', path)
+
+    def done(self, stage):
+        """
+        @param stage: Stage name
+        @return: True if the stage has completed
+        """
+        return stage in self.stages
+
+    def mark(self, stage):
+        """
+        Record a stage as completed
+        @param stage: Stage name
+        @return: None
+        """
+        if stage not in self.stages:
+            self.stages.append(stage)
+            self.write_manifest()
+
+    def value_path(self, stage):
+        return os.path.join(self.directory, '{}.pkl'.format(stage))
+
+    def save(self, stage, value):
+        """
+        Save the value a stage produced and record the stage as completed
+        @param stage: Stage name
+        @param value: Picklable value
+        @return: None
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.value_path(stage), 'wb') as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.mark(stage)
+
+    def load(self, stage):
+        """
+        @param stage: Stage name
+        @return: The value saved by the stage
+        """
+        with open(self.value_path(stage), 'rb') as file:
+            return pickle.load(file)
+
+    def clear(self):
+        """
+        Remove the checkpoint, once the day no longer needs resuming
+        @return: None
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.stages = []
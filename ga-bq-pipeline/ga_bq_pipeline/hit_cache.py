@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import pandas as pd
+from ga_bq_pipeline.ETL import ROOT
+
+# Default directory of the cached hits
+DEFAULT_HIT_CACHE_PATH = os.path.join(ROOT, 'cache', 'hits')
+
+# Default size the cache is kept under, the least recently used days are removed first
+DEFAULT_MAX_SIZE_MB = 2048
+
+
+class HitCache:
+    """
+    Local copies of the decoded hits read from BigQuery, one Parquet file per source table, date and query, so a
+    rerun, retry or debugging run of a day doesn't scan and download its hits again.
+
+        cache = HitCache('cache/hits', max_size_mb=2048)
+        key = HitCache.key(table, date, query)
+        df = cache.get(key, modified)
+        if df is None:
+            df = read_hits()
+            cache.put(key, df, modified)
+
+    A copy is only used while the table hasn't been modified since it was made, and while it's younger than
+    max_age_hours if that's set. Reading a copy makes it the most recently used.
+    """
+
+    def __init__(self, directory, max_size_mb=DEFAULT_MAX_SIZE_MB, max_age_hours=None):
+        """
+        @param directory: Directory of the cached hits
+        @param max_size_mb: Size the Parquet files are kept under
+        @param max_age_hours: Hours a copy is used for, however long the table stays unmodified
+        """
+        self.directory = directory
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self.max_age_hours = max_age_hours
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(table, date, query):
+        """
+        @param table: The source table
+        @param date: Date of the day, YYYYMMDD
+        @param query: The query the hits are read with
+        @return: Cache key, also the name of the copy's files
+        """
+        return '{}-{}-{}'.format(table, date, hashlib.sha256(query.encode('utf-8')).hexdigest()[:16])
+
+    def data_path(self, key):
+        return os.path.join(self.directory, key + '.parquet')
+
+    def meta_path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key, modified=None):
+        """
+        @param key: Cache key
+        @param modified: When the source table was last modified, None if unknown
+        @return: Dataframe of the cached hits, None if there's no valid copy
+        """
+        with self._lock:
+            try:
+                with open(self.meta_path(key)) as file:
+                    meta = json.load(file)
+            except (IOError, ValueError):
+                return None
+            if not os.path.exists(self.data_path(key)):
+                return None
+            cached_modified = meta.get('table_modified')
+            if modified is not None and (cached_modified is None or
+                                         pd.Timestamp(modified) > pd.Timestamp(cached_modified)):
+                return None
+            if self.max_age_hours is not None and \
+                    time.time() - meta['created'] > float(self.max_age_hours) * 3600:
+                return None
+            df = pd.read_parquet(self.data_path(key))
+            os.utime(self.data_path(key))
+        # Strings with None for missing values, as the query returns them
+        columns = [column for column in df.columns if pd.api.types.is_string_dtype(df[column].dtype)]
+        df[columns] = df[columns].astype(object).where(df[columns].notnull(), None)
+        return df
+
+    def put(self, key, df, modified=None):
+        """
+        Cache the hits, replacing any copy with the same key, and remove the least recently used copies over the
+        size limit
+        @param key: Cache key
+        @param df: Dataframe of decoded hits
+        @param modified: When the source table was last modified, None if unknown
+        @return: List of the keys removed to stay under the size limit
+        """
+        with self._lock:
+            path = self.data_path(key)
+            df.reset_index(drop=True).to_parquet(path + '.tmp', index=False)
+            os.replace(path + '.tmp', path)
+            meta = {'created': time.time(), 'rows': len(df),
+                    'table_modified': modified.isoformat() if modified is not None else None}
+            with open(self.meta_path(key) + '.tmp', 'w') as file:
+                json.dump(meta, file)
+            os.replace(self.meta_path(key) + '.tmp', self.meta_path(key))
+            return self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used copies until the cache is under its size limit, a copy larger than the limit
+        on its own isn't kept
+        @return: List of the removed keys
+        """
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.parquet'):
+                stat = os.stat(os.path.join(self.directory, name))
+                files.append((stat.st_mtime, stat.st_size, name[:-len('.parquet')]))
+        total = sum(size for _, size, _ in files)
+        removed = []
+        for _, size, key in sorted(files):
+            if total <= self.max_bytes:
+                break
+            for path in [self.data_path(key), self.meta_path(key)]:
+                if os.path.exists(path):
+                    os.remove(path)
+            total -= size
+            removed.append(key)
+        return removed
+
+    def __getstate__(self):
+        # Locks can't be sent to worker processes, they never read the hits
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
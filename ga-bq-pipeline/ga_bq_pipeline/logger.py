@@ -34,14 +34,19 @@ class Logger:
         error_stream_handler.setLevel(pyLogging.ERROR)
         error_stream_handler.setFormatter(log_stream_formatter)
 
-        # Logger which outputs to StdOut/StdErr (local)
+        # Logger which outputs to StdOut/StdErr (local), only once for each logger name
         logger.setLevel(pyLogging.DEBUG)
-        logger.addHandler(info_stream_handler)
-        logger.addHandler(error_stream_handler)
+        if not logger.handlers:
+            logger.addHandler(info_stream_handler)
+            logger.addHandler(error_stream_handler)
         logger.propagate = False
 
         self.logger = logger
 
+    def __reduce__(self):
+        # Worker processes started with spawn set up the handlers again
+        return Logger, (self.app_name, self.logger_name)
+
     def info(self, message):
         self.logger.info(message)
 
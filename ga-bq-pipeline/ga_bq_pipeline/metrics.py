@@ -0,0 +1,137 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from ga_bq_pipeline.ETL import ROOT
+
+# Default file the run records are appended to, one JSON object per line
+DEFAULT_METRICS_PATH = os.path.join(ROOT, 'cache', 'metrics.jsonl')
+
+
+class Metrics:
+    """
+    Stage timers and counters of a run.
+
+    A stage's seconds include the stages that run inside it, self_seconds leave them out. Sessions are transformed as
+    the output file is written, so the process_data stages inside write_to_file make up most of its seconds and
+    self_seconds is the time spent writing. Stages and counters from worker processes are merged in with merge, the
+    seconds of stages that ran at the same time are added together.
+    """
+
+    def __init__(self):
+        self.started = datetime.now(timezone.utc)
+        self._start = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def _stack(self):
+        # Time spent in the nested stages of each stage open on this thread
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a stage
+        @param name: Stage name
+        """
+        stack = self._stack
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += seconds
+            self.add_stage(name, seconds, seconds - nested, 1)
+
+    def add_stage(self, name, seconds, self_seconds, calls):
+        with self._lock:
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'self_seconds': 0.0, 'calls': 0})
+            stage['seconds'] += seconds
+            stage['self_seconds'] += self_seconds
+            stage['calls'] += calls
+
+    def count(self, name, value=1):
+        """
+        Add to a counter
+        @param name: Counter name
+        @param value: Amount added
+        @return: None
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """
+        @return: The stages and counters so far, for merge
+        """
+        with self._lock:
+            return {'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                    'counters': dict(self.counters)}
+
+    def merge(self, snapshot):
+        """
+        Add the stages and counters of another process
+        @param snapshot: Metrics.snapshot() of the other process
+        @return: None
+        """
+        for name, stage in snapshot['stages'].items():
+            self.add_stage(name, stage['seconds'], stage['self_seconds'], stage['calls'])
+        for name, value in snapshot['counters'].items():
+            self.count(name, value)
+
+    def record(self, **fields):
+        """
+        @param fields: Fields describing the run, e.g. its date and status
+        @return: The run record, with the stage seconds rounded to the millisecond
+        """
+        snapshot = self.snapshot()
+        return dict(fields,
+                    started=self.started.isoformat(),
+                    seconds=round(time.perf_counter() - self._start, 3),
+                    stages={name: {'seconds': round(stage['seconds'], 3),
+                                   'self_seconds': round(stage['self_seconds'], 3),
+                                   'calls': stage['calls']} for name, stage in snapshot['stages'].items()},
+                    counters=snapshot['counters'])
+
+    @staticmethod
+    def to_json(record):
+        """
+        @param record: Run record
+        @return: The record as a single line of JSON
+        """
+        return json.dumps(record, sort_keys=True, default=str)
+
+    @staticmethod
+    def write(line, path):
+        """
+        Append a run record to a JSON lines file
+        @param line: The record, from to_json
+        @param path: File path
+        @return: None
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'a') as file:
+            file.write(line + '\n')
+
+    def __getstate__(self):
+        # Locks can't be sent to worker processes, each process times its own stages
+        state = self.__dict__.copy()
+        del state['_lock']
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._local = threading.local()
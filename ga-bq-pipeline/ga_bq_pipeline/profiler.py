@@ -0,0 +1,159 @@
+import bisect
+import cProfile
+import heapq
+import io
+import itertools
+import os
+import pstats
+import threading
+from ga_bq_pipeline.ETL import ROOT
+
+# Default directory of the profile reports
+DEFAULT_PROFILE_PATH = os.path.join(ROOT, 'cache', 'profiles')
+
+# Number of slowest sessions kept
+DEFAULT_TOP_SESSIONS = 20
+
+# Upper bounds of the latency histogram buckets, in milliseconds, the last bucket has no bound
+HISTOGRAM_BOUNDS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+# Functions listed in each cProfile dump, by cumulative time
+PROFILE_LINES = 30
+
+HISTOGRAM_WIDTH = 50
+
+
+class SessionProfiler:
+    """
+    Latency histogram of the transformed sessions, and the slowest of them.
+
+    The time each session takes in session_func is counted in a histogram bucket, and the top slowest sessions are
+    kept. Their shape is only worked out when the report is made. With cprofile set, those sessions are transformed
+    again under cProfile at that point, so profiling costs nothing for the rest of the day; the replays run with the
+    caches the day has already filled, e.g. the user agent and Full Visitor Id caches.
+    """
+
+    def __init__(self, top=DEFAULT_TOP_SESSIONS, cprofile=False):
+        """
+        @param top: Number of slowest sessions kept
+        @param cprofile: Profile the slowest sessions with cProfile
+        """
+        self.top = int(top)
+        self.cprofile = cprofile
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+        self.sessions = 0
+        self.seconds = 0.0
+        # Heap of (seconds, sequence, entry), the fastest of the kept sessions first
+        self._slowest = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def record(self, seconds, session_id, date, args):
+        """
+        Count a session's latency, keeping it if it's one of the slowest so far
+        @param seconds: Time the session took
+        @param session_id: Session id
+        @param date: Date of the session's day, YYYYMMDD
+        @param args: The session_func arguments, replayed by finish
+        @return: None
+        """
+        bucket = bisect.bisect_left(HISTOGRAM_BOUNDS_MS, seconds * 1000)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.sessions += 1
+            self.seconds += seconds
+            if len(self._slowest) < self.top or seconds > self._slowest[0][0]:
+                self.keep({'session_id': session_id, 'date': date, 'seconds': seconds, 'args': args})
+
+    def keep(self, entry):
+        item = (entry['seconds'], next(self._sequence), entry)
+        if len(self._slowest) < self.top:
+            heapq.heappush(self._slowest, item)
+        elif item[0] > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, item)
+
+    @property
+    def slowest(self):
+        """
+        :return: The kept sessions, slowest first
+        """
+        with self._lock:
+            return [entry for _, _, entry in sorted(self._slowest, key=lambda item: -item[0])]
+
+    def finish(self, session_func, session_shape):
+        """
+        Work out the shape of the kept sessions, profile them if cprofile is set, and let go of their hits
+        @param session_func: The function the sessions were timed in
+        @param session_shape: Function returning a dictionary describing a session's hits
+        @return: None
+        """
+        for entry in self.slowest:
+            args = entry.pop('args', None)
+            if args is None:
+                continue
+            entry.update(session_shape(args[0]))
+            if self.cprofile:
+                profile = cProfile.Profile()
+                profile.runcall(session_func, *args)
+                stream = io.StringIO()
+                pstats.Stats(profile, stream=stream).sort_stats('cumulative').print_stats(PROFILE_LINES)
+                entry['profile'] = stream.getvalue()
+
+    def snapshot(self):
+        """
+        @return: The histogram and the finished kept sessions, for merge
+        """
+        with self._lock:
+            return {'counts': list(self.counts), 'sessions': self.sessions, 'seconds': self.seconds,
+                    'slowest': [dict(entry) for _, _, entry in self._slowest if 'args' not in entry]}
+
+    def merge(self, snapshot):
+        """
+        Add the sessions of another process
+        @param snapshot: SessionProfiler.snapshot() of the other process, after finish
+        @return: None
+        """
+        with self._lock:
+            self.counts = [a + b for a, b in zip(self.counts, snapshot['counts'])]
+            self.sessions += snapshot['sessions']
+            self.seconds += snapshot['seconds']
+            for entry in snapshot['slowest']:
+                self.keep(entry)
+
+    def report(self):
+        """
+        @return: The text report, the histogram, the slowest sessions' shapes and their cProfile output
+        """
+        slowest = self.slowest
+        lines = ['Session latency: {} sessions, {:.1f}s in session_func, mean {:.1f}ms, max {:.1f}ms'.format(
+            self.sessions, self.seconds, 1000 * self.seconds / self.sessions if self.sessions else 0,
+            1000 * slowest[0]['seconds'] if slowest else 0), '']
+        labels = ['<= {}ms'.format(bound) for bound in HISTOGRAM_BOUNDS_MS] + \
+                 ['> {}ms'.format(HISTOGRAM_BOUNDS_MS[-1])]
+        most = max(self.counts) or 1
+        for label, count in zip(labels, self.counts):
+            lines.append('{:>10} {:>10}  {}'.format(label, count, '#' * int(round(HISTOGRAM_WIDTH * count / most))))
+
+        columns = ['seconds', 'hits', 'products', 'impressions', 'product_columns', 'custom_definitions', 'date',
+                   'session_id']
+        lines += ['', 'Slowest {} sessions:'.format(len(slowest)), '  '.join('{:>18}'.format(c) for c in columns)]
+        for entry in slowest:
+            values = ['{:.3f}'.format(entry['seconds'])] + [entry.get(column, '') for column in columns[1:]]
+            lines.append('  '.join('{:>18}'.format(value) for value in values))
+        for entry in slowest:
+            if entry.get('profile'):
+                lines += ['', 'cProfile of session {session_id} ({date}, {seconds:.3f}s):'.format(**entry),
+                          entry['profile']]
+        return '\n'.join(lines) + '\n'
+
+    def __getstate__(self):
+        # Locks can't be sent to worker processes, each process profiles its own sessions
+        state = self.__dict__.copy()
+        del state['_lock']
+        del state['_sequence']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
@@ -0,0 +1,54 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket rate limiter.
+
+    Tokens are added at `rate` per second up to `capacity`. A caller asking for more tokens than the bucket can hold
+    waits for a full bucket and then borrows the difference, which is paid back before anyone else gets through.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        @param rate: Tokens added per second
+        @param capacity: Maximum number of tokens held, defaults to one second's worth
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        """
+        Block until the tokens are available
+        @param tokens: Number of tokens to take
+        @return: Seconds spent waiting
+        """
+        waited = 0.0
+        needed = min(float(tokens), self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= needed:
+                    self._tokens -= tokens
+                    return waited
+                delay = (needed - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
@@ -0,0 +1,91 @@
+"""
+Avro and Parquet versions of the BigQuery export schema, and conversion of session rows to match them.
+
+The JSON rows are loosely typed (BigQuery coerces strings, single records for repeated fields and field names in a
+different case), Avro and Parquet aren't, so rows are conformed to the schema before they're written.
+"""
+from datetime import date, datetime
+import pyarrow as pa
+
+AVRO_TYPES = {'STRING': 'string', 'INTEGER': 'long', 'INT64': 'long', 'FLOAT': 'double', 'FLOAT64': 'double',
+              'BOOLEAN': 'boolean', 'BOOL': 'boolean', 'DATE': {'type': 'int', 'logicalType': 'date'}}
+
+ARROW_TYPES = {'STRING': pa.string(), 'INTEGER': pa.int64(), 'INT64': pa.int64(), 'FLOAT': pa.float64(),
+               'FLOAT64': pa.float64(), 'BOOLEAN': pa.bool_(), 'BOOL': pa.bool_(), 'DATE': pa.date32()}
+
+
+def avro_schema(fields, name='ga_sessions'):
+    """
+    @param fields: List of BigQuery SchemaFields, e.g. export_schema
+    @param name: Record name
+    @return: Avro schema dictionary
+    """
+    return {'type': 'record', 'name': name, 'fields': [_avro_field(field, name) for field in fields]}
+
+
+def _avro_field(field, parent):
+    if field.field_type in ('RECORD', 'STRUCT'):
+        # Avro record names must be unique, so nested records are named by their path
+        field_type = avro_schema(field.fields, name=parent + '_' + field.name)
+    else:
+        field_type = AVRO_TYPES[field.field_type]
+    if field.mode == 'REPEATED':
+        return {'name': field.name, 'type': {'type': 'array', 'items': field_type}, 'default': []}
+    return {'name': field.name, 'type': ['null', field_type], 'default': None}
+
+
+def arrow_schema(fields):
+    """
+    @param fields: List of BigQuery SchemaFields, e.g. export_schema
+    @return: pyarrow Schema
+    """
+    return pa.schema([pa.field(field.name, _arrow_type(field)) for field in fields])
+
+
+def _arrow_type(field):
+    if field.field_type in ('RECORD', 'STRUCT'):
+        field_type = pa.struct([pa.field(f.name, _arrow_type(f)) for f in field.fields])
+    else:
+        field_type = ARROW_TYPES[field.field_type]
+    return pa.list_(field_type) if field.mode == 'REPEATED' else field_type
+
+
+def conform(row, fields):
+    """
+    Convert a session row to the types in the schema. Fields are matched case insensitively, keys that aren't in the
+    schema are dropped, single records are wrapped for repeated fields and scalar values are cast.
+    @param row: Session dictionary
+    @param fields: List of BigQuery SchemaFields
+    @return: Dictionary with exactly the schema's fields
+    """
+    values = {k.lower(): v for k, v in row.items()} if row else {}
+    return {field.name: _conform_field(values.get(field.name.lower()), field) for field in fields}
+
+
+def _conform_field(value, field):
+    if field.mode == 'REPEATED':
+        if value is None:
+            return []
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        return [_conform_value(v, field) for v in value if v is not None]
+    return _conform_value(value, field)
+
+
+def _conform_value(value, field):
+    field_type = field.field_type
+    if value is None or (value == '' and field_type != 'STRING'):
+        return None
+    if field_type in ('RECORD', 'STRUCT'):
+        return conform(value, field.fields)
+    if field_type in ('INTEGER', 'INT64'):
+        return int(float(value)) if isinstance(value, str) else int(value)
+    if field_type in ('FLOAT', 'FLOAT64'):
+        return float(value)
+    if field_type in ('BOOLEAN', 'BOOL'):
+        return value.lower() == 'true' if isinstance(value, str) else bool(value)
+    if field_type == 'DATE':
+        if isinstance(value, datetime):
+            return value.date()
+        return value if isinstance(value, date) else datetime.strptime(value, '%Y-%m-%d').date()
+    return str(value)
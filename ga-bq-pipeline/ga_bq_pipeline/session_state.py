@@ -0,0 +1,93 @@
+import os
+import pickle
+import sqlite3
+import threading
+import pandas as pd
+from ga_bq_pipeline.ETL import ROOT
+
+# Default location of the incremental run state, shared by every run on this machine
+DEFAULT_STATE_PATH = os.path.join(ROOT, 'cache', 'sessions.db')
+
+# Minutes without a hit after which a session is closed, as in Google Analytics
+DEFAULT_SESSION_TIMEOUT_MINUTES = 30
+
+# Minutes hits may take to reach the source table, incremental runs only read hits older than this
+DEFAULT_LATENESS_MINUTES = 5
+
+
+class SessionStateStore:
+    """
+    Persistent state of the incremental runs of each day.
+
+    The watermark is the timestamp the day's table has been read up to. The hits of the sessions that were still open
+    after the last run are kept with it, so they're stitched to the next run's hits and each session is transformed
+    once, when it closes. Values are kept in a SQLite file so they survive between runs.
+    """
+
+    def __init__(self, path):
+        """
+        @param path: SQLite database file path, ':memory:' keeps the store in memory only
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def conn(self):
+        """
+        Open the database on first use
+        @return: SQLite connection
+        """
+        if self._conn is None:
+            if self.path != ':memory:':
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('CREATE TABLE IF NOT EXISTS session_state ('
+                               'day TEXT NOT NULL PRIMARY KEY, '
+                               'watermark TEXT NOT NULL, '
+                               'open_hits BLOB)')
+            self._conn.commit()
+        return self._conn
+
+    def load(self, day):
+        """
+        @param day: Date, YYYYMMDD
+        @return: Tuple of the day's watermark and the hits of its open sessions, (None, None) before the first run
+        """
+        with self._lock:
+            row = self.conn.execute('SELECT watermark, open_hits FROM session_state WHERE day = ?', [day]).fetchone()
+        if row is None:
+            return None, None
+        watermark, open_hits = row
+        return pd.Timestamp(watermark), pickle.loads(open_hits) if open_hits is not None else None
+
+    def save(self, day, watermark, open_hits):
+        """
+        Replace the day's state
+        @param day: Date, YYYYMMDD
+        @param watermark: Timestamp the hits have been read up to
+        @param open_hits: Dataframe of the hits of the sessions that are still open, or None
+        @return: None
+        """
+        blob = None
+        if open_hits is not None and len(open_hits) > 0:
+            blob = pickle.dumps(open_hits, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO session_state VALUES (?, ?, ?)',
+                              [day, watermark.isoformat(), blob])
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __getstate__(self):
+        # Connections and locks can't be sent to worker processes
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
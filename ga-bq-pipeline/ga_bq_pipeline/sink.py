@@ -0,0 +1,197 @@
+import gzip
+import json
+import os
+from fastavro import parse_schema
+from fastavro.write import Writer
+import pyarrow as pa
+import pyarrow.parquet as pq
+from ga_bq_pipeline.schema.formats import avro_schema, arrow_schema, conform
+
+# Number of rows buffered before they are written to the file
+DEFAULT_FLUSH_ROWS = 1000
+
+COMPRESSION_EXTENSIONS = {None: '', 'gzip': '.gz'}
+
+# Avro codecs fastavro writes with the requirements alone, snappy needs another package
+AVRO_CODECS = ['null', 'deflate']
+
+
+class JsonlSink:
+    """
+    Writes sessions to a newline delimited JSON file as they are produced, so the day's output never has to be held
+    in memory. Rows are buffered and written flush_rows at a time, optionally gzip compressed.
+
+        with JsonlSink('output20200101.jsonl', compression='gzip') as sink:
+            for session in sessions:
+                sink.write(session)
+        sink.stats  # {'rows': ..., 'bytes': ..., 'file_bytes': ...}
+    """
+
+    def __init__(self, path, compression=None, flush_rows=DEFAULT_FLUSH_ROWS):
+        """
+        @param path: Output file path, the compression extension is added if it's missing
+        @param compression: None or 'gzip'
+        @param flush_rows: Number of rows buffered between writes
+        """
+        if compression not in COMPRESSION_EXTENSIONS:
+            raise ValueError('Unsupported compression: {}'.format(compression))
+        extension = COMPRESSION_EXTENSIONS[compression]
+        self.path = path if path.endswith(extension) else path + extension
+        self.compression = compression
+        self.flush_rows = int(flush_rows)
+        self.rows = 0
+        self.bytes = 0
+        self._buffer = []
+        self._file = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def open(self):
+        if self.compression == 'gzip':
+            self._file = gzip.open(self.path, 'wb')
+        else:
+            self._file = open(self.path, 'wb')
+        return self
+
+    def write(self, row):
+        """
+        @param row: A single session
+        @return: None
+        """
+        self._buffer.append(row)
+        if len(self._buffer) >= self.flush_rows:
+            self.flush()
+
+    def write_all(self, rows):
+        """
+        @param rows: Iterable of sessions
+        @return: None
+        """
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        if self._buffer:
+            self.write_rows(self._buffer)
+            self.rows += len(self._buffer)
+            self._buffer = []
+
+    def write_rows(self, rows):
+        """
+        Write a chunk of buffered rows to the file
+        @param rows: List of sessions
+        @return: None
+        """
+        data = ''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows).encode('utf-8')
+        self._file.write(data)
+        self.bytes += len(data)
+
+    def close(self):
+        """
+        Write any remaining rows and close the file
+        @return: The file statistics
+        """
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+        return self.stats
+
+    @property
+    def stats(self):
+        """
+        @return: Rows written, uncompressed bytes and the size of the file on disk
+        """
+        file_bytes = os.path.getsize(self.path) if self._file is None and os.path.exists(self.path) else None
+        return {'rows': self.rows, 'bytes': self.bytes or file_bytes, 'file_bytes': file_bytes}
+
+
+class AvroSink(JsonlSink):
+    """
+    Writes sessions to an Avro container file with the export schema, each flush is written as Avro blocks.
+    Compression is the Avro codec, deflate by default.
+    """
+
+    def __init__(self, path, fields, compression=None, flush_rows=DEFAULT_FLUSH_ROWS):
+        """
+        @param path: Output file path
+        @param fields: List of BigQuery SchemaFields the rows are written with
+        @param compression: Avro codec, 'null' or 'deflate'
+        @param flush_rows: Number of rows buffered between writes
+        """
+        super().__init__(path, flush_rows=flush_rows)
+        self.fields = fields
+        self.codec = compression or 'deflate'
+        if self.codec not in AVRO_CODECS:
+            raise ValueError('Unsupported Avro codec: {}'.format(self.codec))
+        self._writer = None
+
+    def open(self):
+        self._file = open(self.path, 'wb')
+        self._writer = Writer(self._file, parse_schema(avro_schema(self.fields)), codec=self.codec)
+        return self
+
+    def write_rows(self, rows):
+        for row in rows:
+            self._writer.write(conform(row, self.fields))
+        self._writer.flush()
+
+    def close(self):
+        if self._writer is not None:
+            self.flush()
+            self._writer.flush()
+            self._writer = None
+        return super().close()
+
+
+class ParquetSink(JsonlSink):
+    """
+    Writes sessions to a Parquet file with the export schema, each flush is written as one row group.
+    Compression is the Parquet codec, snappy by default.
+    """
+
+    def __init__(self, path, fields, compression=None, flush_rows=DEFAULT_FLUSH_ROWS):
+        """
+        @param path: Output file path
+        @param fields: List of BigQuery SchemaFields the rows are written with
+        @param compression: Parquet codec, 'none', 'snappy' or 'gzip'
+        @param flush_rows: Number of rows buffered between writes
+        """
+        super().__init__(path, flush_rows=flush_rows)
+        self.fields = fields
+        self.schema = arrow_schema(fields)
+        self.codec = compression or 'snappy'
+
+    def open(self):
+        self._file = pq.ParquetWriter(self.path, self.schema, compression=self.codec)
+        return self
+
+    def write_rows(self, rows):
+        rows = pa.array([conform(row, self.fields) for row in rows], type=pa.struct(list(self.schema)))
+        self._file.write_table(pa.Table.from_arrays(rows.flatten(), schema=self.schema))
+
+
+SINKS = {'json': JsonlSink, 'avro': AvroSink, 'parquet': ParquetSink}
+
+EXTENSIONS = {'json': '.jsonl', 'avro': '.avro', 'parquet': '.parquet'}
+
+
+def create_sink(path, output_format='json', fields=None, compression=None, flush_rows=DEFAULT_FLUSH_ROWS):
+    """
+    @param path: Output file path
+    @param output_format: 'json', 'avro' or 'parquet'
+    @param fields: List of BigQuery SchemaFields, required for Avro and Parquet
+    @param compression: Compression for the format
+    @param flush_rows: Number of rows buffered between writes
+    @return: An unopened sink
+    """
+    if output_format not in SINKS:
+        raise ValueError('Unsupported output format: {}'.format(output_format))
+    if output_format == 'json':
+        return JsonlSink(path, compression=compression, flush_rows=flush_rows)
+    return SINKS[output_format](path, fields, compression=compression, flush_rows=flush_rows)
@@ -0,0 +1,217 @@
+import glob
+import gzip
+import json
+import pandas as pd
+import pyarrow.parquet as pq
+
+# Hit types left out of the day's hits, as the queries' HIT_CONDITION does
+EXCLUDED_HIT_TYPES = ['timing', 'adtiming']
+
+# File format of each file extension, before any .gz
+FORMATS = {'.json': 'ndjson', '.jsonl': 'ndjson', '.ndjson': 'ndjson', '.parquet': 'parquet', '.parq': 'parquet'}
+
+PAYLOAD = 'jsonPayload'
+
+
+def missing_as_none(df):
+    """
+    Turn the NaN pandas gives missing values of rows built into a dataframe back into None, as the table's query
+    returns them, so a missing value is never read as a set one
+    @param df: Dataframe of hits
+    @return: The dataframe with the hit parameters as objects
+    """
+    columns = [column for column in df.columns if column != 'timestamp']
+    df[columns] = df[columns].astype(object).where(df[columns].notnull(), None)
+    return df
+
+
+class BigQuerySource:
+    """
+    Reads the day's hits from its BigQuery table, with the queries built by the pipeline, see PIPELINE.build_query
+    """
+
+    def __init__(self, pipeline):
+        """
+        @param pipeline: The PIPELINE whose BigQuery client, queries and metrics are used
+        """
+        self.pipeline = pipeline
+
+    def query(self, after=None, until=None):
+        """
+        @param after: Only read the hits after this timestamp
+        @param until: Only read the hits up to this timestamp
+        @return: The query the hits are read with
+        """
+        conditions = []
+        if after is not None:
+            conditions.append("timestamp > TIMESTAMP('{}')".format(after.isoformat()))
+        if until is not None:
+            conditions.append("timestamp <= TIMESTAMP('{}')".format(until.isoformat()))
+        return self.pipeline.build_query(condition=' AND '.join(conditions) or None)
+
+    def read(self, after=None, until=None):
+        """
+        @param after: Only read the hits after this timestamp
+        @param until: Only read the hits up to this timestamp
+        @return: Dataframe of hits, in no particular order
+        """
+        query = self.query(after=after, until=until)
+        if self.pipeline.source.get('dry_run_report'):
+            self.pipeline.query_report(query)
+        df = self.pipeline.bq_client.query(query).result().to_dataframe()
+        self.pipeline.metrics.count('bigquery_queries')
+        return df
+
+    def read_sessions(self, session_key):
+        """
+        Read the day's sessions grouped in BigQuery, see PIPELINE.build_session_query
+        @param session_key: The session id field
+        @return: Dataframe of hits with each session's hits together in timestamp order, in the order of the
+        sessions' first hits, with None for missing values
+        """
+        rows = self.pipeline.bq_client.query(self.pipeline.build_session_query()).result()
+        sessions = sorted(((row['first_hit'], row['hits']) for row in rows), key=lambda session: session[0])
+        self.pipeline.metrics.count('bigquery_queries')
+        return missing_as_none(pd.DataFrame([hit for _, hits in sessions for hit in hits]))
+
+    def stream(self, session_key, page_size):
+        """
+        Query the hits ordered by session id and timestamp and read them a page at a time
+        @param session_key: The session id field
+        @param page_size: Rows read from BigQuery at a time
+        @return: Generator of hits, as dictionaries
+        """
+        query = self.pipeline.build_query(order_by='jsonPayload.{}, timestamp'.format(session_key),
+                                          condition='jsonPayload.{} IS NOT NULL'.format(session_key))
+        rows = self.pipeline.bq_client.query(query).result(page_size=page_size)
+        self.pipeline.metrics.count('bigquery_queries')
+        for row in rows:
+            yield dict(row.items())
+
+
+class FileSource:
+    """
+    Reads the day's hits from local newline delimited JSON or Parquet files, such as an export of the day's table, so
+    a day can be replayed without BigQuery. Rows either have the table's shape, the hit parameters in a jsonPayload
+    record and a timestamp, or are flat with a column for each hit parameter and a timestamp. JSON files may be
+    gzipped. The files are read whole, so streaming only saves memory in the transformation.
+
+        source = FileSource('replay/hits_{date}*.parquet', '20200101')
+        df = source.read()
+    """
+
+    def __init__(self, path, date, file_format=None, field_filter=None, fields=()):
+        """
+        @param path: File path or glob pattern, {date} is replaced with the date
+        @param date: Date of the day, YYYYMMDD
+        @param file_format: 'ndjson' or 'parquet', found from each file's extension unless set
+        @param field_filter: Function returning True for the hit parameters to read, all of them unless set
+        @param fields: Hit parameters every hit has, None if the files don't have them, as the table's schema has
+        """
+        self.path = path
+        self.date = date
+        self.file_format = file_format
+        self.field_filter = field_filter
+        self.fields = list(fields)
+
+    @property
+    def files(self):
+        """
+        :return: The day's files, in name order
+        """
+        pattern = self.path.format(date=self.date)
+        files = sorted(glob.glob(pattern))
+        if not files:
+            raise FileNotFoundError('No hits files match {}'.format(pattern))
+        return files
+
+    def format_of(self, file):
+        """
+        @param file: File name
+        @return: 'ndjson' or 'parquet'
+        """
+        if self.file_format is not None:
+            if self.file_format not in FORMATS.values():
+                raise ValueError('Unsupported source format: {}'.format(self.file_format))
+            return self.file_format
+        name = file[:-len('.gz')] if file.endswith('.gz') else file
+        extension = name[name.rfind('.'):]
+        if extension not in FORMATS:
+            raise ValueError('Unknown source file format: {}'.format(file))
+        return FORMATS[extension]
+
+    def keep(self, field):
+        return field == 'timestamp' or self.field_filter is None or self.field_filter(field)
+
+    def read_parquet(self, file):
+        names = pq.read_schema(file).names
+        if PAYLOAD in names:
+            table = pq.read_table(file, columns=[PAYLOAD, 'timestamp']).flatten()
+            table = table.rename_columns([name[len(PAYLOAD) + 1:] if name.startswith(PAYLOAD + '.') else name
+                                          for name in table.column_names])
+            df = table.to_pandas()
+            return df[[column for column in df.columns if self.keep(column)]]
+        return pq.read_table(file, columns=[name for name in names if self.keep(name)]).to_pandas()
+
+    def read_ndjson(self, file):
+        rows = []
+        with (gzip.open(file, 'rt') if file.endswith('.gz') else open(file)) as lines:
+            for line in lines:
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                hit = row.get(PAYLOAD)
+                if hit is not None:
+                    hit = dict(hit, timestamp=row.get('timestamp'))
+                else:
+                    hit = row
+                rows.append({field: value for field, value in hit.items() if self.keep(field)})
+        return pd.DataFrame(rows)
+
+    def read(self, after=None, until=None):
+        """
+        @param after: Only read the hits after this timestamp
+        @param until: Only read the hits up to this timestamp
+        @return: Dataframe of hits in file order, strings with None for missing values and a UTC timestamp, as the
+        table's query returns them
+        """
+        frames = [self.read_parquet(file) if self.format_of(file) == 'parquet' else self.read_ndjson(file)
+                  for file in self.files]
+        df = pd.concat(frames, ignore_index=True, sort=False)
+        for field in self.fields:
+            if field not in df:
+                df[field] = None
+        df = missing_as_none(df)
+        df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True)
+
+        keep = pd.Series(True, index=df.index)
+        if 't' in df:
+            keep &= ~df['t'].isin(EXCLUDED_HIT_TYPES)
+        if after is not None:
+            keep &= df['timestamp'] > after
+        if until is not None:
+            keep &= df['timestamp'] <= until
+        return df[keep].reset_index(drop=True)
+
+    def read_sessions(self, session_key):
+        """
+        @param session_key: The session id field
+        @return: Dataframe of hits with each session's hits together in timestamp order, in the order of the
+        sessions' first hits
+        """
+        df = self.read()
+        df = df[df[session_key].notnull()].sort_values('timestamp', kind='mergesort')
+        first_hit = df.groupby(session_key, sort=False)['timestamp'].transform('min')
+        order = pd.DataFrame({'first_hit': first_hit, 'session': df[session_key]})
+        return df.loc[order.sort_values(['first_hit', 'session'], kind='mergesort').index].reset_index(drop=True)
+
+    def stream(self, session_key, page_size=None):
+        """
+        @param session_key: The session id field
+        @param page_size: Unused, the files are read whole
+        @return: Generator of hits ordered by session id and timestamp, as dictionaries
+        """
+        df = self.read()
+        df = df[df[session_key].notnull()].sort_values([session_key, 'timestamp'], kind='mergesort')
+        for hit in df.to_dict('records'):
+            yield hit
@@ -0,0 +1,572 @@
+"""
+The session transformation compiled to a single BigQuery script, an INSERT ... SELECT from the day's hits table into
+the destination table.
+
+Everything PIPELINE.session_func derives from the hit columns is done in SQL. The Full Visitor Id and the device need
+the Analytics API and user agent parsing, so Python loads them into a side table of one row per session, which the
+script joins on. Sessions missing from the side table, the bots, are left out.
+
+Records and arrays are built in the order of the export schema, so the rows match the destination table by position.
+"""
+import re
+from google.cloud import bigquery
+from ga_bq_pipeline.schema.array_fields import hitType, ecommerce_action_type
+from ga_bq_pipeline.schema.tables import export_schema
+
+# Python's urllib.parse.unquote, each run of escaped bytes is decoded as UTF-8 and each maximal invalid sequence in it
+# is replaced with U+FFFD, as Python's decoder does
+UNQUOTE_FUNCTION = '''CREATE TEMP FUNCTION unquote(value STRING) RETURNS STRING LANGUAGE js AS r"""
+  return value.replace(/(%[0-9A-Fa-f]{2})+/g, function (escaped) {
+    var bytes = escaped.match(/%[0-9A-Fa-f]{2}/g).map(function (byte) {
+      return parseInt(byte.substring(1), 16);
+    });
+    var result = '';
+    var i = 0;
+    while (i < bytes.length) {
+      var first = bytes[i++];
+      if (first < 0x80) {
+        result += String.fromCharCode(first);
+        continue;
+      }
+      // Continuation bytes of the lead byte, and the range of the first of them, 0 for a byte that can't lead
+      var needed = first >= 0xF0 && first <= 0xF4 ? 3 : first >= 0xE0 ? (first <= 0xEF ? 2 : 0) :
+        (first >= 0xC2 && first <= 0xDF ? 1 : 0);
+      var lower = first === 0xE0 ? 0xA0 : (first === 0xF0 ? 0x90 : 0x80);
+      var upper = first === 0xED ? 0x9F : (first === 0xF4 ? 0x8F : 0xBF);
+      var code = first & (0x3F >> needed);
+      var valid = needed > 0;
+      while (needed > 0) {
+        if (i >= bytes.length || bytes[i] < lower || bytes[i] > upper) {
+          valid = false;
+          break;
+        }
+        code = (code << 6) | (bytes[i++] & 0x3F);
+        lower = 0x80;
+        upper = 0xBF;
+        needed--;
+      }
+      result += valid ? String.fromCodePoint(code) : String.fromCharCode(0xFFFD);
+    }
+    return result;
+  });
+""";'''
+
+# urllib3's removal of the dot segments from the path, see RFC 3986 section 5.2.4. An empty path is NULL, as urllib3
+# has None for it
+DOT_SEGMENTS_FUNCTION = '''CREATE TEMP FUNCTION remove_dot_segments(path STRING) RETURNS STRING LANGUAGE js AS r"""
+  if (path === null) {
+    return null;
+  }
+  var output = [];
+  path.split('/').forEach(function (segment) {
+    if (segment === '..') {
+      output.pop();
+    } else if (segment !== '.') {
+      output.push(segment);
+    }
+  });
+  if (path.charAt(0) === '/' && (output.length === 0 || output[0] !== '')) {
+    output.unshift('');
+  }
+  if (path.slice(-2) === '/.' || path.slice(-3) === '/..') {
+    output.push('');
+  }
+  return output.join('/') || null;
+""";'''
+
+# urllib3's parse_url normalisation of the path and query, characters outside allowed are percent encoded and
+# existing escapes are kept if every % in the value is one
+ENCODE_FUNCTION = '''CREATE TEMP FUNCTION encode_invalid(value STRING, allowed STRING)
+RETURNS STRING LANGUAGE js AS r"""
+  if (value === null) {
+    return null;
+  }
+  var escapes = 0;
+  value = value.replace(/%[a-fA-F0-9]{2}/g, function (escaped) {
+    escapes++;
+    return escaped.toUpperCase();
+  });
+  var bytes = unescape(encodeURIComponent(value));
+  var encoded = escapes === bytes.split('%').length - 1;
+  var result = '';
+  for (var i = 0; i < bytes.length; i++) {
+    var c = bytes.charAt(i);
+    var code = bytes.charCodeAt(i);
+    if ((encoded && c === '%') || (code < 128 && allowed.indexOf(c) >= 0)) {
+      result += c;
+    } else {
+      result += '%' + (code < 16 ? '0' : '') + code.toString(16).toUpperCase();
+    }
+  }
+  return result;
+""";'''
+
+PATH_CHARS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~!$&\'()*+,;=:@/'
+QUERY_CHARS = PATH_CHARS + '?'
+
+# The parts of urllib3's URI regex used for the page and the traffic source
+SCHEME_RE = r'^(?:[a-zA-Z][a-zA-Z0-9+.-]*:)?'
+HOST_RE = SCHEME_RE + r'//(?:[^\\/?#]*@)?([^\\/?#:]*)'
+PATH_RE = SCHEME_RE + r'(?://[^\\/?#]*)?([^?#]*)'
+QUERY_RE = SCHEME_RE + r'(?://[^\\/?#]*)?[^?#]*\?([^#]*)'
+
+SQL_TYPES = {'STRING': 'STRING', 'INTEGER': 'INT64', 'INT64': 'INT64', 'FLOAT': 'FLOAT64', 'FLOAT64': 'FLOAT64',
+             'BOOLEAN': 'BOOL', 'BOOL': 'BOOL', 'DATE': 'DATE'}
+
+# Querystring parameters of the landing page used for the traffic source, see PIPELINE.query_string
+QUERY_STRING_KEYS = {'cs': ['utm_source'], 'cm': ['utm_medium'], 'cn': ['utm_campaign'],
+                     'ck': ['utm_keyword', 'utm_term'], 'ct': ['utm_content'], 'gclid': ['gclid']}
+
+# Python's empty_cmd
+EMPTY_DEFINITION = '[STRUCT(CAST(NULL AS INT64) AS index, CAST(NULL AS STRING) AS value)]'
+
+# Hit parameters read without checking the source table has them
+REQUIRED_FIELDS = ['t', 'pa']
+
+
+def schema_field(path, fields=export_schema):
+    """
+    @param path: Dotted field path, e.g. 'hits.product'
+    @param fields: List of SchemaFields to look in
+    @return: The SchemaField
+    """
+    name, _, rest = path.partition('.')
+    field = next(f for f in fields if f.name.lower() == name.lower())
+    return schema_field(rest, field.fields) if rest else field
+
+
+def sql_type(field, repeated=True):
+    """
+    @param field: SchemaField
+    @param repeated: Include the ARRAY of repeated fields
+    @return: BigQuery standard SQL type of the field
+    """
+    if field.field_type in ('RECORD', 'STRUCT'):
+        field_type = 'STRUCT<{}>'.format(', '.join('{} {}'.format(f.name, sql_type(f)) for f in field.fields))
+    else:
+        field_type = SQL_TYPES[field.field_type]
+    return 'ARRAY<{}>'.format(field_type) if repeated and field.mode == 'REPEATED' else field_type
+
+
+def null_sql(field):
+    return 'CAST(NULL AS {})'.format(sql_type(field))
+
+
+def struct_sql(field, values):
+    """
+    A record of the schema, with its fields in schema order
+    @param field: Record SchemaField
+    @param values: Dictionary of field name to SQL expression, matched case insensitively. Missing fields are NULL.
+    @return: STRUCT expression
+    """
+    values = {k.lower(): v for k, v in values.items()}
+    return 'STRUCT({})'.format(', '.join('{} AS {}'.format(values.get(f.name.lower()) or null_sql(f), f.name)
+                                         for f in field.fields))
+
+
+def string_sql(value):
+    return "'{}'".format(value.replace('\\', '\\\\').replace("'", "\\'"))
+
+
+def not_empty_sql(value):
+    """
+    @param value: SQL expression
+    @return: The value, or NULL where it's an empty string, as Python's `or` treats them
+    """
+    return "NULLIF({}, '')".format(value)
+
+
+def int_sql(value):
+    """
+    @return: int(float(value)), as the output schema casts the values Python leaves as strings
+    """
+    return 'CAST(TRUNC(SAFE_CAST({} AS FLOAT64)) AS INT64)'.format(value)
+
+
+def price_sql(value):
+    """
+    @return: int(float(value) * 10 ** 6)
+    """
+    return 'CAST(TRUNC(CAST({} AS FLOAT64) * 1000000) AS INT64)'.format(value)
+
+
+class SqlTransform:
+    """
+    Compiles the transformation for the hit parameters of one day's table.
+
+        transform = SqlTransform(fields, session_key='cd5', user_agent_key='cd30', condition=HIT_CONDITION)
+        bq_client.query(transform.compile(source_table, destination_table, side_table)).result()
+    """
+
+    def __init__(self, fields, session_key, user_agent_key, condition, offset=100):
+        """
+        @param fields: The jsonPayload fields of the source table that the transformation reads
+        @param session_key: Session id hit parameter
+        @param user_agent_key: User agent hit parameter
+        @param condition: WHERE condition for the hits that make up sessions
+        @param offset: Offset of the custom definitions' scope parameters, custom definitions with a higher index aren't
+        read
+        """
+        self.fields = list(fields)
+        self.session_key = session_key
+        self.user_agent_key = user_agent_key
+        self.condition = condition
+        self.offset = int(offset)
+
+    def column(self, name, default=None):
+        """
+        @param name: Hit parameter
+        @param default: SQL expression used if the source table doesn't have the parameter
+        @return: The column, or the default
+        """
+        return name if name in self.fields else (default or 'CAST(NULL AS STRING)')
+
+    @property
+    def side_table_schema(self):
+        """
+        :return: Schema of the side table loaded from Python
+        """
+        return [bigquery.SchemaField('visitId', 'STRING', mode='NULLABLE'),
+                bigquery.SchemaField('clientId', 'STRING', mode='NULLABLE'),
+                bigquery.SchemaField('fullVisitorId', 'STRING', mode='NULLABLE'),
+                schema_field('device')]
+
+    def first_hits_query(self, source_table):
+        """
+        The first hit of each session, with the parameters Python needs for the side table
+        @param source_table: The day's hits table
+        @return: Query string
+        """
+        keys = [self.session_key, 'cid', 'tid', self.user_agent_key, 'sr', 'vp', 'ul']
+        columns = ', '.join('jsonPayload.{0} AS {0}'.format(key) for key in keys if key in self.fields)
+        return 'SELECT first_hit.* FROM (SELECT ARRAY_AGG(STRUCT({columns}) ORDER BY timestamp LIMIT 1)[OFFSET(0)] ' \
+               'AS first_hit FROM `{table}` WHERE {condition} AND jsonPayload.{key} IS NOT NULL ' \
+               'GROUP BY jsonPayload.{key})'.format(columns=columns, table=source_table, condition=self.condition,
+                                                    key=self.session_key)
+
+    def custom_definitions_sql(self, prefix, scopes, metric=False, hit_number=False, empty=True):
+        """
+        The custom dimensions or metrics of a hit, see PIPELINE.add_custom_definitions
+        @param prefix: Parameter prefix, e.g. 'cd' or 'pr1cd'
+        @param scopes: Scopes included
+        @param metric: Metric values are integers
+        @param hit_number: Include the hit number, for collapsing the session's values
+        @param empty: An empty definition rather than an empty array when there are no values
+        @return: ARRAY expression
+        """
+        entries = []
+        for i in range(1, self.offset + 1):
+            value, scope = prefix + str(i), prefix + str(i + self.offset)
+            if value in self.fields and scope in self.fields:
+                entries.append('STRUCT({} AS index, {} AS value, {} AS scope)'.format(i, value, scope))
+        value = 'CAST(CAST(value AS INT64) AS STRING)' if metric else 'value'
+        columns = 'hit_number, index, {} AS value'.format(value) if hit_number else 'index, {} AS value'.format(value)
+        if not entries:
+            if empty:
+                return EMPTY_DEFINITION
+            return 'ARRAY<STRUCT<hit_number INT64, index INT64, value STRING>>[]'
+        definitions = 'ARRAY(SELECT AS STRUCT {} FROM UNNEST([{}]) WHERE value IS NOT NULL AND scope IN ({}) ' \
+                      'ORDER BY index)'.format(columns, ', '.join(entries), ', '.join(map(string_sql, scopes)))
+        if not empty:
+            return definitions
+        return '(SELECT IF(ARRAY_LENGTH(definitions) > 0, definitions, {}) FROM (SELECT {} AS definitions))'.format(
+            EMPTY_DEFINITION, definitions)
+
+    def collapse_sql(self, definitions):
+        """
+        The session's custom definitions, the last value of each index in order of first appearance, see
+        PIPELINE.add_custom_definitions
+        @param definitions: Column of the session's definitions, with hit numbers
+        @return: ARRAY expression
+        """
+        return '(SELECT IF(COUNT(*) > 0, ARRAY_AGG(STRUCT(index, value) ORDER BY first_hit, index), {}) FROM (' \
+               'SELECT index, ARRAY_AGG(value ORDER BY hit_number DESC LIMIT 1)[OFFSET(0)] AS value, ' \
+               'MIN(hit_number) AS first_hit FROM UNNEST({}) GROUP BY index))'.format(EMPTY_DEFINITION, definitions)
+
+    def products_sql(self, entries, condition):
+        """
+        @param entries: List of (position, condition, product STRUCT) tuples
+        @param condition: Condition for the hit to have any of the products
+        @return: ARRAY of the products that are present, in position order
+        """
+        product = schema_field('hits.product')
+        if not entries:
+            return 'ARRAY<{}>[]'.format(sql_type(product, repeated=False))
+        structs = ', '.join('STRUCT({} AS position, {} AS present, {} AS product)'.format(*entry) for entry in entries)
+        return 'ARRAY(SELECT product FROM UNNEST([{}]) WHERE present AND ({}) ORDER BY position)'.format(
+            structs, condition)
+
+    def product_sql(self, i, position, is_click):
+        """
+        A product of the product action, see PIPELINE.product_obj
+        """
+        product = schema_field('hits.product')
+        i = str(i)
+        return struct_sql(product, {
+            'productSKU': self.column('pr' + i + 'id'),
+            'productListPosition': position,
+            'productBrand': self.column('pr' + i + 'br'),
+            'productPrice': price_sql(self.column('pr' + i + 'pr', "'0'")),
+            'productVariant': self.column('pr' + i + 'va'),
+            'v2ProductName': self.column('pr' + i + 'id'),
+            'productListName': self.column('pr' + i + 'nm'),
+            'isImpression': 'CAST(NULL AS BOOL)',
+            'isClick': is_click,
+            'customDimensions': self.custom_definitions_sql('pr1cd', ['P']),
+            'customMetrics': self.custom_definitions_sql('pr1cm', ['P'])
+        })
+
+    def impressions_sql(self):
+        """
+        The product impressions of a hit, in list order then impression order, see PIPELINE.product_func
+        @return: ARRAY expression
+        """
+        product = schema_field('hits.product')
+        entries = []
+        lists = [re.match(r'il(\d+)nm$', field).group(1) for field in self.fields if re.match(r'il(\d+)nm$', field)]
+        for key in lists:
+            impressions = [re.match(r'il' + key + r'pi(\d+)id$', field) for field in self.fields]
+            # Impressions are in the order of their index as a string
+            for i in sorted(match.group(1) for match in impressions if match):
+                prefix = 'il' + key + 'pi' + i
+                entries.append((len(entries), 'il{}nm IS NOT NULL AND {}id IS NOT NULL'.format(key, prefix),
+                                struct_sql(product, {
+                                    'productSKU': prefix + 'id',
+                                    'productListPosition': i,
+                                    'productBrand': self.column(prefix + 'br'),
+                                    'productPrice': price_sql(self.column(prefix + 'pr')),
+                                    'productVariant': self.column(prefix + 'va'),
+                                    'v2ProductName': self.column(prefix + 'nm'),
+                                    'v2ProductCategory': self.column(prefix + 'ca'),
+                                    'productListName': 'il' + key + 'nm',
+                                    'isImpression': 'TRUE',
+                                    'isClick': 'IF({}id = click_id, TRUE, NULL)'.format(prefix),
+                                    'customDimensions': self.custom_definitions_sql(prefix + 'cd', ['P']),
+                                    # Python reads the metrics from a misspelt key, so they're always empty
+                                    'customMetrics': EMPTY_DEFINITION
+                                })))
+        return self.products_sql(entries, "pa = 'click' OR pa IS NULL")
+
+    def hit_products_sql(self):
+        """
+        @return: ARRAY of all the products of a hit, see PIPELINE.product_func
+        """
+        product = schema_field('hits.product')
+        action = self.products_sql(
+            [(0, 'TRUE', self.product_sql(1, int_sql(self.column('pr1ps')), "IF(pa = 'click', TRUE, NULL)"))],
+            "(pa = 'click' AND NOT EXISTS(SELECT 1 FROM UNNEST(impressions) WHERE isClick)) "
+            "OR pa IN ('detail', 'add', 'remove')")
+        indexes = sorted({int(match.group(1)) for match in (re.match(r'pr(\d+)(id|nm)$', field)
+                                                             for field in self.fields) if match})
+        checkout = self.products_sql(
+            [(i, '{} IS NOT NULL OR {} IS NOT NULL'.format(self.column('pr{}id'.format(i)),
+                                                         self.column('pr{}nm'.format(i))),
+              self.product_sql(i, 'CAST(NULL AS INT64)', 'CAST(NULL AS BOOL)')) for i in indexes],
+            "pa IN ('checkout', 'purchase')")
+        empty_product = struct_sql(product, {'customDimensions': EMPTY_DEFINITION, 'customMetrics': EMPTY_DEFINITION})
+        return '(SELECT IF(ARRAY_LENGTH(products) > 0, products, [{}]) ' \
+               'FROM (SELECT ARRAY_CONCAT(impressions, {}, {}) AS products))'.format(empty_product, action, checkout)
+
+    def hit_sql(self):
+        """
+        @return: The hit record, see PIPELINE.process_hit
+        """
+        hits = schema_field('hits')
+        content_groups = {}
+        for k in range(1, 6):
+            content_groups['contentGroup{}'.format(k)] = "IFNULL({}, '(not set)')".format(
+                not_empty_sql(self.column('cg{}'.format(k))))
+            content_groups['previousContentGroup{}'.format(k)] = \
+                "IF(hit_number = 1, '(entrance)', IFNULL(NULLIF(previous_cg{}, ''), '(not set)'))".format(k)
+        hit_type = 'CASE t {} ELSE t END'.format(' '.join('WHEN {} THEN {}'.format(string_sql(k), string_sql(v))
+                                                         for k, v in hitType.items()))
+        action_type = 'CASE pa {} ELSE \'0\' END'.format(' '.join(
+            'WHEN {} THEN {}'.format(string_sql(k), string_sql(v)) for k, v in ecommerce_action_type.items()))
+        path_level = "IFNULL((SELECT CONCAT('/', level, IF(level != '', '/', '')) " \
+                     "FROM (SELECT SPLIT(path, '/')[SAFE_OFFSET({})] AS level)), '')"
+        purchase = "IF(pa = 'purchase', {}, NULL)"
+        return struct_sql(hits, {
+            'hitNumber': 'hit_number',
+            'time': 'CAST(ROUND(TIMESTAMP_DIFF(timestamp, first_hit, MICROSECOND) / 1000) AS INT64)',
+            'hour': 'EXTRACT(HOUR FROM timestamp)',
+            'minute': 'EXTRACT(MINUTE FROM timestamp)',
+            'isInteraction': 'is_interaction',
+            'isEntrance': 'IF(hit_number = 1, TRUE, NULL)',
+            'isExit': 'is_exit',
+            'type': hit_type,
+            'page': struct_sql(schema_field('hits.page'), {
+                'pagePath': 'path',
+                'hostname': 'host',
+                'pageTitle': self.column('dt'),
+                'pagePathLevel1': path_level.format(1),
+                'pagePathLevel2': path_level.format(2),
+                'pagePathLevel3': path_level.format(3),
+                'pagePathLevel4': path_level.format(4)
+            }),
+            'transaction': struct_sql(schema_field('hits.transaction'), {
+                'transactionId': purchase.format(self.column('ti')),
+                'affiliation': purchase.format(self.column('ta')),
+                'transactionTax': purchase.format(int_sql(self.column('tt'))),
+                'transactionShipping': purchase.format(int_sql(self.column('ts'))),
+                'currencyCode': purchase.format(self.column('cu'))
+            }),
+            'eventInfo': struct_sql(schema_field('hits.eventInfo'), {
+                'eventCategory': self.column('ec'),
+                'eventAction': self.column('ea'),
+                'eventLabel': self.column('el'),
+                'eventValue': 'CAST({} AS INT64)'.format(not_empty_sql(self.column('ev')))
+            }),
+            'product': self.hit_products_sql(),
+            'promotion': '[{}]'.format(struct_sql(schema_field('hits.promotion'), {
+                'promotionActionInfo': struct_sql(schema_field('hits.promotion.promotionActionInfo'), {})
+            })),
+            'eCommerceAction': '[{}]'.format(struct_sql(schema_field('hits.eCommerceAction'), {
+                'action_type': action_type,
+                'option': self.column('col'),
+                'step': 'CAST({} AS INT64)'.format(not_empty_sql(self.column('cos')))
+            })),
+            'experiment': '[{}]'.format(struct_sql(schema_field('hits.experiment'), {
+                'experimentId': r"REGEXP_EXTRACT({}, r'(.*)\.\d+')".format(self.column('exp')),
+                'experimentVariant': r"REGEXP_EXTRACT({}, r'.*\.(\d+)')".format(self.column('exp'))
+            })),
+            'customDimensions': self.custom_definitions_sql('cd', ['H']),
+            'customMetrics': self.custom_definitions_sql('cm', ['H'], metric=True),
+            'contentGroup': struct_sql(schema_field('hits.contentGroup'), content_groups)
+        })
+
+    def query_string_sql(self, key):
+        """
+        @param key: Traffic source parameter, see QUERY_STRING_KEYS
+        @return: The last value of the parameter in the landing page querystring
+        """
+        return "(SELECT NULLIF(SPLIT(param, '=')[SAFE_OFFSET(1)], '') FROM UNNEST(SPLIT(landing.query, '&')) " \
+               "AS param WITH OFFSET position WHERE ARRAY_LENGTH(SPLIT(param, '=')) = 2 " \
+               "AND SPLIT(param, '=')[OFFSET(0)] IN ({}) ORDER BY position DESC LIMIT 1)".format(
+                   ', '.join(map(string_sql, QUERY_STRING_KEYS[key])))
+
+    def traffic_source_sql(self):
+        """
+        @return: The trafficSource record, see PIPELINE.traffic_func
+        """
+        traffic_source = schema_field('trafficSource')
+        return '[{}]'.format(struct_sql(traffic_source, {
+            'referralPath': 'landing.dr',
+            'campaign': 'COALESCE({}, qs_cn)'.format(not_empty_sql('landing.cn')),
+            'source': "IF(qs_gclid IS NOT NULL, 'google', COALESCE({}, qs_cs, {}, 'direct'))".format(
+                not_empty_sql('landing.cs'), not_empty_sql('landing.dr')),
+            'medium': "IF(qs_gclid IS NOT NULL, 'cpc', COALESCE({}, qs_cm, IF({} IS NOT NULL, 'referral', 'none')))"
+                      .format(not_empty_sql('landing.cm'), not_empty_sql('landing.dr')),
+            'keyword': 'COALESCE({}, qs_ck)'.format(not_empty_sql('landing.ck')),
+            'adContent': 'COALESCE({}, qs_ct)'.format(not_empty_sql('landing.ct')),
+            'adwordsClickInfo': '[{}]'.format(struct_sql(schema_field('trafficSource.adwordsClickInfo'), {}))
+        }))
+
+    def totals_sql(self):
+        """
+        @return: The totals record, see PIPELINE.session_totals
+        """
+        purchased = 'purchases > 0' if 'tr' in self.fields else 'FALSE'
+        return '[{}]'.format(struct_sql(schema_field('totals'), {
+            'hits': 'pageviews + events',
+            'pageviews': 'pageviews',
+            'timeOnSite': 'TIMESTAMP_DIFF(last_hit, first_hit, SECOND)',
+            # A session whose first hit is also its exit is a bounce, see PIPELINE.session_func
+            'bounces': 'IF(pageviews + events - ni_hits <= 1 OR IFNULL(landing.is_exit, FALSE), 1, NULL)',
+            'transactions': 'IF({}, purchases, NULL)'.format(purchased),
+            'totalTransactionRevenue': 'IF({}, revenue_hits * 1000000, NULL)'.format(purchased)
+        }))
+
+    def compile(self, source_table, destination_table, side_table):
+        """
+        @param source_table: The day's hits table
+        @param destination_table: Table the sessions are inserted into
+        @param side_table: Table with the visitId, clientId, fullVisitorId and device of each session to include
+        @return: BigQuery script
+        """
+        decoded = ', '.join(["IF(STRPOS(jsonPayload.{0}, '%') > 0, unquote(jsonPayload.{0}), jsonPayload.{0}) AS {0}"
+                             .format(field) for field in self.fields] +
+                            ['CAST(NULL AS STRING) AS {}'.format(field) for field in REQUIRED_FIELDS
+                             if field not in self.fields])
+        previous = ', '.join('LAG({}) OVER session_hits AS previous_cg{}'.format(self.column('cg{}'.format(k)), k)
+                             for k in range(1, 6))
+        landing = ', '.join('{} AS {}'.format(self.column(key), key) for key in ['cs', 'cm', 'cn', 'ck', 'ct', 'dr'])
+        query_strings = ', '.join('{} AS qs_{}'.format(self.query_string_sql(key), key) for key in QUERY_STRING_KEYS)
+        session = {
+            'clientId': 'side.clientId',
+            'fullVisitorId': 'side.fullVisitorId',
+            'visitId': 'sessions.session_id',
+            'visitStartTime': 'UNIX_SECONDS(first_hit)',
+            'date': 'DATE(first_hit)',
+            'totals': self.totals_sql(),
+            'trafficSource': self.traffic_source_sql(),
+            'device': 'side.device',
+            'customDimensions': self.collapse_sql('session_dimensions'),
+            'customMetrics': self.collapse_sql('session_metrics'),
+            'geoNetwork': struct_sql(schema_field('geoNetwork'), {}),
+            'hits': 'hits'
+        }
+        session = {k.lower(): v for k, v in session.items()}
+        columns = ',\n  '.join('{} AS {}'.format(session.get(field.name.lower()) or null_sql(field), field.name)
+                               for field in export_schema)
+
+        return '\n'.join([
+            UNQUOTE_FUNCTION,
+            DOT_SEGMENTS_FUNCTION,
+            ENCODE_FUNCTION,
+            'INSERT INTO `{}` ({})'.format(destination_table, ', '.join(field.name for field in export_schema)),
+            'WITH source AS (',
+            '  SELECT {}, timestamp'.format(decoded),
+            '  FROM `{}`'.format(source_table),
+            '  WHERE {} AND jsonPayload.{} IS NOT NULL'.format(self.condition, self.session_key),
+            '), numbered AS (',
+            '  SELECT *, {} AS session_id,'.format(self.session_key),
+            '    ROW_NUMBER() OVER session_hits AS hit_number,',
+            '    MIN(timestamp) OVER (PARTITION BY {}) AS first_hit,'.format(self.session_key),
+            "    IFNULL({}, '') != '1' AS is_interaction,".format(self.column('ni')),
+            "    IF({0} = 'click', {1}, NULL) AS click_id,".format(self.column('pa'), self.column('pr1id')),
+            "    LOWER(REGEXP_EXTRACT({}, r'{}')) AS host,".format(self.column('dl'), HOST_RE),
+            "    encode_invalid(remove_dot_segments(REGEXP_EXTRACT({}, r'{}')), {}) AS path,".format(
+                self.column('dl'), PATH_RE, string_sql(PATH_CHARS)),
+            "    encode_invalid(REGEXP_EXTRACT({}, r'{}'), {}) AS query,".format(
+                self.column('dl'), QUERY_RE, string_sql(QUERY_CHARS)),
+            '    {}'.format(previous),
+            '  FROM source',
+            '  WINDOW session_hits AS (PARTITION BY {} ORDER BY timestamp)'.format(self.session_key),
+            '), exits AS (',
+            '  SELECT *, IF(is_interaction AND COUNTIF(is_interaction) OVER (PARTITION BY session_id ORDER BY '
+            'hit_number ROWS BETWEEN CURRENT ROW AND UNBOUNDED FOLLOWING) = 1, TRUE, NULL) AS is_exit,',
+            '    {} AS impressions'.format(self.impressions_sql()),
+            '  FROM numbered',
+            '), hit_records AS (',
+            '  SELECT session_id, hit_number, timestamp, first_hit, is_exit, query, {},'.format(landing),
+            "    {t} = 'pageview' AS is_pageview, {t} = 'event' AS is_event, {ni} = '1' AS is_non_interaction,".format(
+                t=self.column('t'), ni=self.column('ni')),
+            "    {} = 'purchase' AS is_purchase, {} IS NOT NULL AS has_revenue,".format(self.column('pa'),
+                                                                                     self.column('tr')),
+            '    {} AS session_dimensions,'.format(self.custom_definitions_sql('cd', ['S', 'U'], hit_number=True,
+                                                                               empty=False)),
+            '    {} AS session_metrics,'.format(self.custom_definitions_sql('cm', ['S', 'U'], metric=True,
+                                                                            hit_number=True, empty=False)),
+            '    {} AS hit'.format(self.hit_sql()),
+            '  FROM exits',
+            '), sessions AS (',
+            '  SELECT session_id, MIN(first_hit) AS first_hit, MAX(timestamp) AS last_hit,',
+            '    COUNTIF(is_pageview) AS pageviews, COUNTIF(is_event) AS events,',
+            '    COUNTIF(is_non_interaction) AS ni_hits, COUNTIF(is_purchase) AS purchases,',
+            '    COUNTIF(has_revenue) AS revenue_hits,',
+            '    ARRAY_AGG(STRUCT(query, cs, cm, cn, ck, ct, dr, is_exit) ORDER BY hit_number LIMIT 1)[OFFSET(0)] '
+            'AS landing,',
+            '    ARRAY_CONCAT_AGG(session_dimensions ORDER BY hit_number) AS session_dimensions,',
+            '    ARRAY_CONCAT_AGG(session_metrics ORDER BY hit_number) AS session_metrics,',
+            '    ARRAY_AGG(hit ORDER BY hit_number) AS hits',
+            '  FROM hit_records',
+            '  GROUP BY session_id',
+            '), traffic AS (',
+            '  SELECT *, {}'.format(query_strings),
+            '  FROM sessions',
+            ')',
+            'SELECT',
+            '  {}'.format(columns),
+            'FROM traffic AS sessions',
+            'JOIN `{}` AS side ON side.visitId = sessions.session_id;'.format(side_table)
+        ])
@@ -0,0 +1,401 @@
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from google.oauth2 import service_account
+from ga_bq_pipeline.ETL import ROOT
+from ga_bq_pipeline.rate_limit import TokenBucket
+
+ANALYTICS_SCOPES = ['https://www.googleapis.com/auth/analytics.edit']
+
+# Default location of the clientId > hashedClientId store, shared by every run on this machine
+DEFAULT_CACHE_PATH = os.path.join(ROOT, 'cache', 'client_ids.db')
+
+# Number of hashClientId calls sent in a single batch HTTP request
+DEFAULT_BATCH_SIZE = 50
+
+# Number of batch requests in flight at once
+DEFAULT_WORKERS = 4
+
+# Management API quota, every call in a batch counts as one request
+DEFAULT_REQUESTS_PER_SECOND = 10
+
+# Retries for calls rejected by the rate limiter, waiting RETRY_BASE_DELAY * 2^attempt seconds between each
+DEFAULT_MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1
+
+RATE_LIMIT_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded']
+
+
+class ClientIdCache:
+    """
+    Persistent clientId > hashedClientId store.
+
+    The hash only depends on the client id and the property, so once a visitor has been resolved it never needs to be
+    requested again. Values are kept in a SQLite file so they survive between daily runs.
+    """
+
+    def __init__(self, path):
+        """
+        @param path: SQLite database file path, ':memory:' keeps the store in memory only
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def conn(self):
+        """
+        Open the database on first use
+        @return: SQLite connection
+        """
+        if self._conn is None:
+            if self.path != ':memory:':
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('CREATE TABLE IF NOT EXISTS client_ids ('
+                               'property_id TEXT NOT NULL, '
+                               'client_id TEXT NOT NULL, '
+                               'hashed_client_id TEXT NOT NULL, '
+                               'PRIMARY KEY (property_id, client_id))')
+            self._conn.commit()
+        return self._conn
+
+    def get_many(self, property_id, client_ids):
+        """
+        @param property_id: Property Id
+        @param client_ids: Client Ids to look up
+        @return: Dictionary of the client ids found in the store and their hashed client id
+        """
+        client_ids = list(client_ids)
+        found = {}
+        with self._lock:
+            # Stay well below SQLite's bound parameter limit
+            for start in range(0, len(client_ids), 500):
+                chunk = client_ids[start:start + 500]
+                rows = self.conn.execute(
+                    'SELECT client_id, hashed_client_id FROM client_ids WHERE property_id = ? AND client_id IN ({})'
+                    .format(','.join('?' * len(chunk))), [property_id] + chunk)
+                found.update(rows.fetchall())
+        return found
+
+    def put_many(self, property_id, hashed_ids):
+        """
+        @param property_id: Property Id
+        @param hashed_ids: Dictionary of client id to hashed client id
+        @return: None
+        """
+        with self._lock:
+            self.conn.executemany('INSERT OR REPLACE INTO client_ids VALUES (?, ?, ?)',
+                                  [(property_id, k, v) for k, v in hashed_ids.items()])
+            self.conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __getstate__(self):
+        # Connections and locks can't be sent to worker processes, each process opens its own
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class VisitorIdResolver:
+    """
+    Resolves client ids to the Full Visitor Id using the Management API hashClientId method.
+
+    The API client is built once, lookups that aren't already stored are sent in batch HTTP requests and every
+    successful response is saved in the ClientIdCache. Batches are sent from a bounded thread pool, throttled by a
+    token bucket matching the Management API quota, and calls rejected with a rate limit error are retried with
+    exponential backoff. A pair that another thread is already requesting, e.g. for a concurrent day of a backfill,
+    is waited for rather than requested again.
+    """
+
+    def __init__(self, service_account_file, logger, cache_path=DEFAULT_CACHE_PATH, batch_size=DEFAULT_BATCH_SIZE,
+                 workers=DEFAULT_WORKERS, requests_per_second=DEFAULT_REQUESTS_PER_SECOND, burst=None,
+                 max_retries=DEFAULT_MAX_RETRIES):
+        """
+        @param service_account_file: Service account json file with edit access to the Analytics properties
+        @param logger: Pipeline logger
+        @param cache_path: Location of the SQLite store
+        @param batch_size: Number of lookups sent in each batch request
+        @param workers: Number of batch requests sent concurrently
+        @param requests_per_second: Sustained API request rate
+        @param burst: Number of requests that can be sent at once, defaults to requests_per_second
+        @param max_retries: Number of times a rate limited call is retried before giving up
+        """
+        self.service_account_file = service_account_file
+        self.logger = logger
+        self.batch_size = int(batch_size)
+        self.workers = int(workers)
+        self.max_retries = int(max_retries)
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self.cache = ClientIdCache(cache_path)
+        self._resolved = {}
+        self._pending = {}
+        self._api = None
+        self._credentials = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+        self.requests = 0
+
+    @property
+    def api(self):
+        """
+        Build the Analytics Management API client on first use
+        @return: Analytics v3 service
+        """
+        if self._api is None:
+            self._credentials = service_account.Credentials.from_service_account_file(self.service_account_file,
+                                                                                      scopes=ANALYTICS_SCOPES)
+            self._api = build('analytics', 'v3', credentials=self._credentials, cache_discovery=False)
+        return self._api
+
+    @property
+    def http(self):
+        """
+        httplib2 isn't thread safe, so each worker thread sends its requests through its own authorised connection.
+        @return: The current thread's http object, None if the API client wasn't built from credentials
+        """
+        if self._credentials is None:
+            return None
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = AuthorizedHttp(self._credentials, http=httplib2.Http())
+            self._local.http = http
+        return http
+
+    @property
+    def stats(self):
+        """
+        @return: Store hit and miss counts, the client ids found in the store and those requested from the API, and
+        the number of batch requests and hashClientId calls sent
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'batches': self.batches, 'requests': self.requests}
+
+    def resolve(self, client_id, property_id):
+        """
+        @param client_id: Client Id
+        @param property_id: Property Id
+        @return: The hashed client id, or an empty string if it couldn't be fetched
+        """
+        return self.resolve_many([(client_id, property_id)]).get((client_id, property_id), '')
+
+    def resolve_many(self, pairs):
+        """
+        Resolve a collection of client id/property id pairs, only requesting the ones that aren't stored.
+        @param pairs: Iterable of (client id, property id) tuples
+        @return: Dictionary of (client id, property id) to hashed client id
+        """
+        pairs = set(pairs)
+        # Days of a backfill resolve on their own threads with a shared resolver
+        with self._lock:
+            results = {pair: self._resolved[pair] for pair in pairs if pair in self._resolved}
+        missing = pairs.difference(results)
+
+        by_property = {}
+        for client_id, property_id in missing:
+            by_property.setdefault(property_id, []).append(client_id)
+        stored = {}
+        for property_id, client_ids in by_property.items():
+            stored.update({(k, property_id): v for k, v in self.cache.get_many(property_id, client_ids).items()})
+        results.update(stored)
+
+        # Hits are lookups answered by the store and misses are lookups sent to the API, pairs already resolved
+        # during the run, e.g. by the day's prefetch, aren't counted again. Pairs another call has resolved or is
+        # requesting since the memo was read are taken from it rather than sent again.
+        missing = pairs.difference(results)
+        with self._lock:
+            self._resolved.update(stored)
+            self.hits += len(stored)
+            results.update({pair: self._resolved[pair] for pair in missing if pair in self._resolved})
+            waiting = {pair: self._pending[pair] for pair in missing if pair in self._pending}
+            missing = [pair for pair in missing if pair not in results and pair not in waiting]
+            self._pending.update({pair: Future() for pair in missing})
+            self.misses += len(missing)
+        if missing:
+            try:
+                fetched = self.fetch(missing)
+            except Exception as ex:
+                self.abandon(missing, ex)
+                raise
+            self.store(fetched)
+            results.update(fetched)
+        results.update({pair: future.result() for pair, future in waiting.items()})
+        return results
+
+    def store(self, fetched):
+        """
+        Save lookups in memory for the rest of the run, and hand them to the calls waiting for them. Only successful
+        ones are persisted.
+        @param fetched: Dictionary of (client id, property id) to hashed client id
+        @return: None
+        """
+        with self._lock:
+            self._resolved.update(fetched)
+            waiting = [(self._pending.pop(pair), hashed_id) for pair, hashed_id in fetched.items()
+                       if pair in self._pending]
+        for future, hashed_id in waiting:
+            future.set_result(hashed_id)
+        fetched = {k: v for k, v in fetched.items() if v}
+        by_property = {}
+        for (client_id, property_id), hashed_id in fetched.items():
+            by_property.setdefault(property_id, {})[client_id] = hashed_id
+        for property_id, hashed_ids in by_property.items():
+            self.cache.put_many(property_id, hashed_ids)
+
+    def abandon(self, pairs, ex):
+        """
+        Pass the exception a request failed with on to the calls waiting for its pairs
+        @param pairs: List of (client id, property id) tuples that were being requested
+        @param ex: Exception
+        @return: None
+        """
+        with self._lock:
+            waiting = [self._pending.pop(pair) for pair in pairs if pair in self._pending]
+        for future in waiting:
+            future.set_exception(ex)
+
+    def fetch(self, pairs):
+        """
+        Request the hashed client ids from the Management API, batch_size lookups per HTTP request, with up to
+        `workers` batches in flight.
+        @param pairs: List of (client id, property id) tuples
+        @return: Dictionary of (client id, property id) to hashed client id, empty for failed lookups
+        """
+        # Build the client before the worker threads share it
+        api = self.api
+        batches = [pairs[start:start + self.batch_size] for start in range(0, len(pairs), self.batch_size)]
+        results = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(batches)))) as pool:
+            for fetched in pool.map(lambda batch: self.fetch_with_retry(api, batch), batches):
+                results.update(fetched)
+        return results
+
+    def fetch_with_retry(self, api, pairs):
+        """
+        Send a batch, retrying the calls that were rate limited with exponential backoff.
+        @param api: Analytics v3 service
+        @param pairs: List of (client id, property id) tuples, at most batch_size long
+        @return: Dictionary of (client id, property id) to hashed client id, empty for failed lookups
+        """
+        results = {}
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                delay = RETRY_BASE_DELAY * 2 ** (attempt - 1)
+                time.sleep(delay + random.uniform(0, delay))
+            self.bucket.acquire(len(pairs))
+            fetched, pairs = self.fetch_batch(api, pairs)
+            results.update(fetched)
+            if not pairs:
+                break
+        if pairs:
+            self.logger.error('hashClientId Error: {} client ids still rate limited after {} retries'.format(
+                len(pairs), self.max_retries))
+            results.update({pair: '' for pair in pairs})
+        return results
+
+    def fetch_batch(self, api, pairs):
+        """
+        Send a single batch request
+        @param api: Analytics v3 service
+        @param pairs: List of (client id, property id) tuples, at most batch_size long
+        @return: Dictionary of (client id, property id) to hashed client id, empty for failed lookups, and the list
+        of pairs that were rate limited
+        """
+        results = {}
+        rate_limited = []
+
+        def callback(request_id, response, exception):
+            pair = pairs[int(request_id)]
+            if exception is None:
+                results[pair] = response.get('hashedClientId', '')
+            elif self.is_rate_limited(exception):
+                rate_limited.append(pair)
+            else:
+                self.log_error(exception)
+                results[pair] = ''
+
+        with self._lock:
+            self.batches += 1
+            self.requests += len(pairs)
+        batch = api.new_batch_http_request(callback=callback)
+        for i, (client_id, property_id) in enumerate(pairs):
+            body = {'kind': 'analytics#hashClientIdRequest', 'clientId': client_id, 'webPropertyId': property_id}
+            batch.add(api.management().clientId().hashClientId(body=body), request_id=str(i))
+        try:
+            batch.execute(http=self.http)
+        except HttpError as ex:
+            if self.is_rate_limited(ex):
+                return {}, list(pairs)
+            self.log_error(ex)
+            return {pair: '' for pair in pairs}, []
+        return results, rate_limited
+
+    @staticmethod
+    def error_details(ex):
+        """
+        @param ex: HttpError
+        @return: The reason and message of the first error in the response
+        """
+        try:
+            error = json.loads(ex.content)['error']['errors'][0]
+            return error.get('reason'), error.get('message')
+        except (ValueError, KeyError, IndexError, TypeError):
+            return None, ex.content
+
+    def is_rate_limited(self, ex):
+        """
+        @param ex: Exception raised by a hashClientId request
+        @return: True if the request was rejected by the API's rate limiter and can be retried
+        """
+        if not isinstance(ex, HttpError):
+            return False
+        if ex.resp.status == 429:
+            return True
+        return ex.resp.status == 403 and self.error_details(ex)[0] in RATE_LIMIT_REASONS
+
+    def log_error(self, ex):
+        """
+        @param ex: Exception raised by a hashClientId request
+        @return: None
+        """
+        if isinstance(ex, HttpError):
+            self.logger.error('{} Error: {}'.format(ex.resp.status, self.error_details(ex)[1]))
+        else:
+            self.logger.error('hashClientId Error: {}'.format(ex))
+
+    def close(self):
+        self.cache.close()
+
+    def __getstate__(self):
+        # The API client and http connections are rebuilt on first use in each process, resolved ids are kept
+        state = self.__dict__.copy()
+        state['_api'] = None
+        state['_credentials'] = None
+        state['_pending'] = {}
+        del state['_local']
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._lock = threading.Lock()
@@ -0,0 +1,130 @@
+"""
+Runs the pipeline's BigQuery queries and scripts on DuckDB, for the tests: sqlglot translates them and the JavaScript
+functions are run on Node.js. Imported by the tests once they've checked duckdb, sqlglot and pyarrow are installed.
+"""
+import inspect
+import json
+import subprocess
+import duckdb
+import pyarrow as pa
+import sqlglot
+from benchmarks.fakes import FakeBigQueryClient, FakeJob, FakeRowIterator
+from ga_bq_pipeline.schema.tables import export_schema
+from ga_bq_pipeline.sql_transform import sql_type
+
+exp = sqlglot.exp
+
+DESTINATION = 'offline.analytics.sessions'
+
+# Calls a JavaScript function with each row of arguments read from stdin, as BigQuery calls a JS UDF
+NODE_SCRIPT = '''
+const f = new Function(...{params}, {body});
+let input = '';
+process.stdin.on('data', chunk => input += chunk);
+process.stdin.on('end', () => process.stdout.write(JSON.stringify(JSON.parse(input).map(args => f(...args)))));
+'''
+
+def javascript_udf(statement):
+    """
+    @param statement: Parsed CREATE TEMP FUNCTION statement of a JavaScript function
+    @return: The function name, its parameter names and an Arrow UDF for DuckDB calling it on Node.js once for each
+    batch of rows
+    """
+    params = [param.name for param in statement.this.expressions]
+    script = NODE_SCRIPT.format(params=json.dumps(params), body=json.dumps(statement.expression.this))
+
+    def call(*columns):
+        rows = list(zip(*(column.to_pylist() for column in columns)))
+        result = subprocess.run(['node', '-e', script], input=json.dumps(rows).encode('utf-8'),
+                                stdout=subprocess.PIPE, check=True)
+        return pa.array(json.loads(result.stdout.decode('utf-8')), pa.string())
+    # DuckDB checks the number of parameters
+    call.__signature__ = inspect.Signature([inspect.Parameter(param, inspect.Parameter.POSITIONAL_ONLY)
+                                            for param in params])
+    return statement.this.this.name, params, call
+
+
+def duckdb_type(field):
+    cast = sqlglot.transpile('CAST(NULL AS {})'.format(sql_type(field)), read='bigquery', write='duckdb')[0]
+    return cast[len('CAST(NULL AS '):-1]
+
+
+def table_name(table):
+    return exp.to_identifier('.'.join(part.name for part in table.parts), quoted=True)
+
+
+def duckdb_equivalent(node):
+    """
+    Rewrite the parts of a BigQuery statement that sqlglot doesn't turn into DuckDB with the same result
+    """
+    if isinstance(node, exp.Table) and node.args.get('db'):
+        node.set('this', table_name(node))
+        node.set('db', None)
+        node.set('catalog', None)
+    # Both truncate, DuckDB's EPOCH rounds and its DATE_DIFF counts the second boundaries crossed
+    elif isinstance(node, exp.UnixSeconds):
+        return exp.IntDiv(this=exp.UnixMicros(this=node.this), expression=exp.Literal.number(1000000))
+    elif isinstance(node, exp.TimestampDiff) and node.unit.name.upper() == 'SECOND':
+        microseconds = exp.TimestampDiff(this=node.this, expression=node.expression, unit=exp.var('MICROSECOND'))
+        return exp.IntDiv(this=microseconds, expression=exp.Literal.number(1000000))
+    # BigQuery's is NULL where the pattern doesn't match, DuckDB's is empty
+    elif isinstance(node, exp.RegexpExtract):
+        return exp.If(this=exp.RegexpLike(this=node.this.copy(), expression=node.expression.copy()), true=node.copy())
+    # Only the first element is read, [OFFSET(0)]. The nodes a node is replaced with aren't transformed, so their
+    # children are transformed here
+    elif isinstance(node, exp.Limit) and isinstance(node.parent, exp.ArrayAgg):
+        return node.this.transform(duckdb_equivalent)
+    # The fields of an array of records are columns in BigQuery
+    elif isinstance(node, exp.Unnest) and isinstance(node.parent, exp.From) and not node.args.get('alias'):
+        unnest = exp.Anonymous(this='UNNEST', expressions=[node.expressions[0].transform(duckdb_equivalent), exp.Kwarg(
+            this=exp.var('max_depth'), expression=exp.Literal.number(2))])
+        return exp.Subquery(this=exp.Select(expressions=[unnest]))
+    return node
+
+
+class DuckDbClient(FakeBigQueryClient):
+    """
+    FakeBigQueryClient that runs the queries and scripts on DuckDB, with the day's hits in the source table and
+    the destination table created from the export schema
+    """
+
+    def __init__(self, hits, source_table):
+        super().__init__(hits)
+        self.db = duckdb.connect()
+        self.db.execute("SET TimeZone = 'UTC'")
+        self.db.register('hits', hits)
+        payload = ', '.join('"{0}" := CAST("{0}" AS VARCHAR)'.format(field) for field in self.payload_fields)
+        self.db.execute('CREATE TABLE "{}" AS SELECT struct_pack({}) AS jsonPayload, "timestamp" FROM hits'.format(
+            source_table, payload))
+        self.db.execute('CREATE TABLE "{}" ({})'.format(DESTINATION, ', '.join(
+            '"{}" {}'.format(field.name, duckdb_type(field)) for field in export_schema)))
+
+    def query(self, query, job_config=None):
+        frame = None
+        for statement in sqlglot.parse(query, read='bigquery'):
+            if isinstance(statement, exp.Create) and statement.kind == 'FUNCTION':
+                # Called with NULL arguments too, as BigQuery calls them
+                name, params, function = javascript_udf(statement)
+                self.db.create_function(name, function, ['VARCHAR'] * len(params), 'VARCHAR', type='arrow',
+                                        null_handling='special')
+                continue
+            result = self.db.execute(statement.transform(duckdb_equivalent).sql('duckdb'))
+            if isinstance(statement, exp.Select):
+                # Through Arrow, DuckDB's own conversion of nested timestamps needs pytz
+                table = result.arrow()
+                frame = (table.read_all() if isinstance(table, pa.RecordBatchReader) else table).to_pandas()
+        return FakeJob(FakeRowIterator(frame=frame))
+
+    def load_table_from_file(self, file_obj, destination, project=None, job_config=None, location=None, **kwargs):
+        columns = {field.name: duckdb_type(field) for field in job_config.schema}
+        self.db.execute('CREATE OR REPLACE TABLE "{}" AS SELECT * FROM read_json(?, format = \'newline_delimited\', '
+                        'columns = {})'.format(destination, json.dumps(columns).replace('"', "'")), [file_obj.name])
+        return FakeJob()
+
+    def delete_table(self, table, not_found_ok=False):
+        self.db.execute('DROP TABLE IF EXISTS "{}"'.format(table))
+
+    def sessions(self):
+        result = self.db.execute('SELECT * FROM "{}"'.format(DESTINATION))
+        columns = [column[0] for column in result.description]
+        return [dict(zip(columns, row)) for row in result.fetchall()]
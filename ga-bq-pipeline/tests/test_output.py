@@ -0,0 +1,99 @@
+"""
+Writing and loading the output against the Cloud Storage and BigQuery fakes of benchmarks.fakes, on a synthetic day
+from benchmarks.hits.
+
+    cd ga-bq-pipeline && python -m pytest tests/test_output.py
+"""
+import os
+import pytest
+import yaml
+from benchmarks.fakes import FakeServices, offline_pipeline
+from benchmarks.hits import generate_hits
+from ga_bq_pipeline.bq_etl import CONF_FILE_PATH, load_job_configs
+from ga_bq_pipeline.schema.tables import export_schema
+
+DATE = '20200101'
+
+
+@pytest.fixture(scope='module')
+def hits():
+    return generate_hits(sessions=60, impressions=3, custom_dimensions=4, custom_metrics=2, seed=13)
+
+
+@pytest.fixture(scope='module')
+def template():
+    with open(os.path.join(CONF_FILE_PATH, 'ENV-TEMPLATE.yaml')) as conf:
+        return yaml.safe_load(conf)
+
+
+@pytest.mark.parametrize('output_format, extension, source_format', [('json', '.jsonl.gz', 'NEWLINE_DELIMITED_JSON'),
+                                                                     ('avro', '.avro', 'AVRO'),
+                                                                     ('parquet', '.parquet', 'PARQUET')])
+def test_each_format_with_the_template_output(hits, template, tmp_path, monkeypatch, output_format, extension,
+                                              source_format):
+    monkeypatch.chdir(tmp_path)
+    services = FakeServices(hits)
+    output = dict(template['output'], format=output_format)
+    pipeline = offline_pipeline(services, env={'output': output}, date=DATE)
+    pipeline.pipeline()
+    assert pipeline.output_file == 'output{}{}'.format(DATE, extension)
+    assert [load['format'] for load in services.bigquery.loads] == [source_format]
+
+
+def storage_pipeline(hits, **storage):
+    return offline_pipeline(FakeServices(hits), env={'storage': storage}, date=DATE)
+
+
+def write_file(name, size):
+    with open(name, 'wb') as file:
+        file.write(os.urandom(size))
+    return name
+
+
+def test_upload_in_chunks(hits, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pipeline = storage_pipeline(hits, chunk_size_mb=0.5)
+    file = write_file('output{}.jsonl.gz'.format(DATE), 3 * 1024 * 1024)
+    assert pipeline.upload_to_gs(file) == 'gs://offline-sessions/{}'.format(file)
+    storage = pipeline.services.storage
+    assert storage.uploads == [{'name': file, 'bytes': 3 * 1024 * 1024, 'chunk_size': 512 * 1024}]
+    assert storage.composes == []
+    assert storage.objects == {('offline-sessions', file): 3 * 1024 * 1024}
+
+
+def test_large_files_are_uploaded_in_parts_and_composed(hits, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pipeline = storage_pipeline(hits, chunk_size_mb=0.25, composite_threshold_mb=1, composite_parts=4)
+    size = 3 * 1024 * 1024 + 1000
+    file = write_file('output{}.jsonl.gz'.format(DATE), size)
+    assert pipeline.upload_to_gs(file) == 'gs://offline-sessions/{}'.format(file)
+    storage = pipeline.services.storage
+    # Whole chunks in every part but the last, covering the file once
+    parts = ['{}.part{}'.format(file, n) for n in range(4)]
+    uploads = sorted(storage.uploads, key=lambda upload: upload['name'])
+    assert [upload['name'] for upload in uploads] == parts
+    assert [upload['bytes'] for upload in uploads] == [1024 * 1024] * 3 + [1000]
+    assert {upload['chunk_size'] for upload in uploads} == {256 * 1024}
+    assert storage.composes == [{'name': file, 'sources': parts}]
+    # The parts are deleted once they're composed
+    assert storage.objects == {('offline-sessions', file): size}
+
+
+def test_output_loaded_from_storage(hits, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    services = FakeServices(hits)
+    pipeline = offline_pipeline(services, env={'output': {'load_from': 'storage'}}, date=DATE)
+    pipeline.pipeline()
+    file = 'output{}.jsonl.gz'.format(DATE)
+    assert [upload['name'] for upload in services.storage.uploads] == [file]
+    load, = services.bigquery.loads
+    assert load['source'] == 'gs://offline-sessions/{}'.format(file)
+    assert load['destination'] == 'offline.analytics.sessions'
+    assert load['bytes'] == os.path.getsize(file)
+    assert load['job_config'] is load_job_configs['json']
+    assert load['job_config'].source_format == 'NEWLINE_DELIMITED_JSON'
+    assert load['job_config'].schema == export_schema
+    # Already in the bucket, the file isn't uploaded again once the day is done
+    pipeline.upload_output_files()
+    assert len(services.storage.uploads) == 1
+    assert not os.path.exists(file)
@@ -0,0 +1,109 @@
+"""
+The process pool transformation against a single process, on a synthetic day from benchmarks.hits with the service
+fakes of benchmarks.fakes: the sessions of every worker count and start method are the same, and sharded output
+splits them across the shards by session id.
+
+    cd ga-bq-pipeline && python -m pytest tests/test_parallel.py
+"""
+import fnmatch
+import gzip
+import json
+import multiprocessing
+import os
+import pickle
+import pytest
+from benchmarks.fakes import FakeServices, offline_pipeline
+from benchmarks.hits import generate_hits
+from ga_bq_pipeline import bq_etl
+from ga_bq_pipeline.bq_etl import session_shard
+
+DATE = '20200101'
+
+
+@pytest.fixture(scope='module')
+def hits():
+    return generate_hits(sessions=120, impressions=3, custom_dimensions=6, custom_metrics=2, seed=5)
+
+
+def read_sessions(file):
+    with gzip.open(file, 'rt', encoding='utf-8') as lines:
+        return [json.loads(line) for line in lines]
+
+
+def run(hits, workers, env=None, services=None):
+    """
+    Run the day's pipeline in the working directory
+    @return: The pipeline, and the sessions of each of its output files
+    """
+    services = services or FakeServices(hits)
+    services.storage.create_bucket('offline-sessions')
+    pipeline = offline_pipeline(services, env=env, date=DATE, workers=workers)
+    pipeline.pipeline()
+    return pipeline, {file: read_sessions(file) for file in pipeline.output_files}
+
+
+@pytest.fixture(scope='module')
+def single_process(hits, tmp_path_factory):
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(tmp_path_factory.mktemp('single_process'))
+        _, output = run(hits, workers=1)
+    return output['output{}.jsonl.gz'.format(DATE)]
+
+
+def test_workers_write_the_same_sessions(hits, single_process, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    _, output = run(hits, workers=3)
+    assert output['output{}.jsonl.gz'.format(DATE)] == single_process
+
+
+def test_workers_started_with_spawn(hits, single_process, tmp_path, monkeypatch):
+    # The pipeline is pickled to each worker rather than inherited
+    monkeypatch.setattr(bq_etl, 'Pool', multiprocessing.get_context('spawn').Pool)
+    monkeypatch.chdir(tmp_path)
+    pipeline, output = run(hits, workers=2)
+    assert output['output{}.jsonl.gz'.format(DATE)] == single_process
+    # Each task's metrics are merged into the run's
+    assert pipeline.metrics.stages['prepare_data']['calls'] == 2
+
+
+def test_pickled_pipeline_leaves_the_run_resources(hits):
+    pipeline = offline_pipeline(FakeServices(hits), date=DATE, workers=2)
+    pipeline.metrics.count('hits', 10)
+    pipeline.visitor_ids.resolve_many([('1.1', 'UA-12345678-1')])
+    copy = pickle.loads(pickle.dumps(pipeline))
+    assert copy.metrics.counters == {}
+    assert copy.visitor_ids.resolve_many([('1.1', 'UA-12345678-1')]) == \
+        pipeline.visitor_ids.resolve_many([('1.1', 'UA-12345678-1')])
+    assert copy.visitor_ids.stats['requests'] == 1
+
+
+def visit_ids(sessions):
+    return sorted(session['visitId'] for session in sessions)
+
+
+@pytest.mark.parametrize('start_method', [None, 'spawn'])
+def test_shards_split_the_sessions(hits, single_process, tmp_path, monkeypatch, start_method):
+    if start_method is not None:
+        monkeypatch.setattr(bq_etl, 'Pool', multiprocessing.get_context(start_method).Pool)
+    monkeypatch.chdir(tmp_path)
+    services = FakeServices(hits)
+    # Left in the bucket by a run with another shard count
+    services.storage.put('offline-sessions', 'output{}-00000-of-00002.jsonl.gz'.format(DATE), 10 ** 6)
+    pipeline, output = run(hits, workers=2, env={'output': {'shards': 3}}, services=services)
+    files = pipeline.output_files
+    assert sorted(output) == files == ['output{}-0000{}-of-00003.jsonl.gz'.format(DATE, shard) for shard in range(3)]
+    for shard, file in enumerate(files):
+        assert output[file]
+        assert {session_shard(session['visitId'], 3) for session in output[file]} == {shard}
+    # Every session once, as the single process wrote it
+    sessions = {session['visitId']: session for file in files for session in output[file]}
+    assert visit_ids(sessions.values()) == visit_ids(single_process)
+    assert sum(len(output[file]) for file in files) == len(single_process)
+    assert all(sessions[session['visitId']] == session for session in single_process)
+
+    # One load job, its wildcard matches each of this run's shards and no other file
+    load, = services.bigquery.loads
+    bucket, _, pattern = load['source'][len('gs://'):].partition('/')
+    assert bucket == 'offline-sessions'
+    assert [file for file in files if fnmatch.fnmatchcase(file, pattern)] == files
+    assert load['bytes'] == sum(os.path.getsize(file) for file in files)
@@ -0,0 +1,70 @@
+"""
+The sessionize mode against a batch run: the query of build_session_query is run on DuckDB over a synthetic day from
+benchmarks.hits, read by BigQuerySource.read_sessions, and the sessions written from it are compared with the batch
+run's.
+
+    cd ga-bq-pipeline && python -m pytest tests/test_sessionize.py
+"""
+import gzip
+import json
+import pytest
+from benchmarks.fakes import FakeServices, offline_pipeline
+from benchmarks.hits import generate_hits
+from ga_bq_pipeline.bq_etl import SESSION_ID_CD
+
+pytest.importorskip('duckdb')
+pytest.importorskip('sqlglot')
+pytest.importorskip('pyarrow')
+from duckdb_client import DuckDbClient  # noqa: E402
+
+DATE = '20200101'
+
+
+@pytest.fixture(scope='module')
+def hits():
+    return generate_hits(sessions=120, impressions=3, custom_dimensions=6, custom_metrics=2, seed=17)
+
+
+def sessionize_pipeline(hits):
+    pipeline = offline_pipeline(FakeServices(hits), env={'source': {'sessionize': True}}, date=DATE)
+    pipeline.services.bigquery = DuckDbClient(hits, pipeline.source_table)
+    return pipeline
+
+
+def read_sessions(file):
+    with gzip.open(file, 'rt', encoding='utf-8') as lines:
+        return [json.loads(line) for line in lines]
+
+
+@pytest.fixture(scope='module')
+def batch_sessions(hits, tmp_path_factory):
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(tmp_path_factory.mktemp('batch'))
+        pipeline = offline_pipeline(FakeServices(hits), date=DATE)
+        pipeline.pipeline()
+        return read_sessions(pipeline.output_file)
+
+
+def test_sessionize_writes_the_batch_sessions(hits, batch_sessions, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    pipeline = sessionize_pipeline(hits)
+    pipeline.pipeline()
+    sessions = read_sessions(pipeline.output_file)
+    # In the order of the sessions' first hits, sessions starting in the same second in any order
+    assert [session['visitStartTime'] for session in sessions] == \
+        sorted(session['visitStartTime'] for session in sessions)
+    assert len(sessions) == len(batch_sessions)
+    assert {session['visitId']: session for session in sessions} == \
+        {session['visitId']: session for session in batch_sessions}
+
+
+def test_grouped_hits_keep_missing_values_as_none(hits):
+    session_key = 'cd' + SESSION_ID_CD
+    df = sessionize_pipeline(hits).hit_source.read_sessions(session_key)
+    assert len(df) == (~hits['t'].isin(['timing', 'adtiming']) & hits[session_key].notnull()).sum()
+    assert df['ev'].isnull().any()
+    values = df.drop(columns='timestamp').values.ravel()
+    assert all(value is None or isinstance(value, str) for value in values)
+    # Each session's hits together and in timestamp order
+    assert (df.groupby(session_key, sort=False).ngroup().diff().fillna(0) >= 0).all()
+    assert df.groupby(session_key, sort=False)['timestamp'].is_monotonic_increasing.all()
@@ -0,0 +1,132 @@
+"""
+The SQL transform against the Python transform: the compiled script is run by sql_pipeline on DuckDB, with its
+JavaScript functions run on Node.js, over a synthetic day from benchmarks.hits, and the sessions it inserts are compared
+with the sessions of transform_sessions.
+
+    cd ga-bq-pipeline && python -m pytest tests/test_sql_transform.py
+"""
+import json
+import random
+import shutil
+from urllib.parse import quote, unquote
+import pytest
+from urllib3.util import parse_url
+from benchmarks.fakes import FakeServices, offline_pipeline
+from benchmarks.hits import generate_hits
+from ga_bq_pipeline.schema.formats import conform
+from ga_bq_pipeline.schema.tables import export_schema
+from ga_bq_pipeline.sql_transform import DOT_SEGMENTS_FUNCTION, ENCODE_FUNCTION, PATH_CHARS, UNQUOTE_FUNCTION
+
+pytest.importorskip('duckdb')
+sqlglot = pytest.importorskip('sqlglot')
+pa = pytest.importorskip('pyarrow')
+from duckdb_client import DuckDbClient, javascript_udf  # noqa: E402
+
+pytestmark = pytest.mark.skipif(shutil.which('node') is None, reason='The JavaScript functions run on Node.js')
+
+DATE = '20200101'
+
+# Page URLs and titles the hits of the fixture are given, beyond the generated ones: dot segments, escapes that
+# aren't valid UTF-8 and characters urllib3 percent-encodes
+PAGES = [
+    ('https://shop.example.com/a/./b/../c?utm_source=x%2Fy&utm_medium=cpc', 'Caf%C3'),
+    ('https://shop.example.com/a/b/..', '%E2%82%AC%80 and %ED%A0%80'),
+    ('https://shop.example.com/../../x/./y/.', '%F0%9F%98%80 %F0%80 %C0%AF 100%'),
+    ('https://shop.example.com/caf%C3%A9/%E9t%E9?q=%FF%FE', 'Caf%C3%A9%20%E9%20%zz'),
+    ('https://shop.example.com/a b/%7Euser/<x>?q=a b&utm_campaign=%E9', 'Tab%09and%0Anewline'),
+    ('https://shop.example.com/a/%2E%2E/b', '%41%42%43%e2%82%ac'),
+]
+
+
+def run_javascript(function, *columns):
+    """
+    @param function: CREATE TEMP FUNCTION statement of sql_transform
+    @param columns: Lists of the values of each argument
+    @return: List of the results
+    """
+    _, _, call = javascript_udf(sqlglot.parse_one(function, read='bigquery'))
+    return call(*(pa.array(column, pa.string()) for column in columns)).to_pylist()
+
+
+def comparable(sessions):
+    """
+    @return: Dictionary of visitId to the session as it's loaded into the destination table
+    """
+    rows = (conform(json.loads(json.dumps(session, default=str)), export_schema) for session in sessions)
+    return {row['visitId']: row for row in rows}
+
+
+def differences(expected, actual, path=''):
+    """
+    @return: List of the paths where the values differ, with both values
+    """
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        return [difference for key in expected for difference in differences(expected[key], actual.get(key),
+                                                                               path + '.' + key)]
+    if isinstance(expected, list) and isinstance(actual, list) and len(expected) == len(actual):
+        return [difference for i, (a, b) in enumerate(zip(expected, actual))
+                for difference in differences(a, b, '{}[{}]'.format(path, i))]
+    return [] if expected == actual else [(path, expected, actual)]
+
+
+@pytest.fixture(scope='module')
+def hits():
+    hits = generate_hits(sessions=150, impressions=3, custom_dimensions=8, custom_metrics=3, bot_share=0.1, seed=7)
+    for i, (url, title) in enumerate(PAGES):
+        # Each page is the landing page of one session and a later hit of another
+        for position in hits.index[hits['t'] != 'timing'][[i * 7, i * 7 + 300]]:
+            hits.loc[position, 'dl'], hits.loc[position, 'dt'] = url, title
+    return hits
+
+
+@pytest.fixture(scope='module')
+def python_sessions(hits):
+    pipeline = offline_pipeline(FakeServices(hits), date=DATE)
+    data = pipeline.query_data()
+    pipeline.resolve_visitor_ids(data)
+    sessions, sids = pipeline.prepare_data(data)
+    return comparable(pipeline.process_data(sessions, sids, pipeline.session_totals(data)))
+
+
+@pytest.fixture(scope='module')
+def sql_sessions(hits):
+    pipeline = offline_pipeline(FakeServices(hits), env={'transform': 'sql'}, date=DATE)
+    client = pipeline.services.bigquery = DuckDbClient(hits, pipeline.source_table)
+    pipeline.pipeline()
+    return comparable(client.sessions())
+
+
+def test_same_sessions(python_sessions, sql_sessions):
+    assert sorted(sql_sessions) == sorted(python_sessions)
+
+
+def test_same_session_rows(python_sessions, sql_sessions):
+    found = [difference for visit_id, session in python_sessions.items()
+             for difference in differences(session, sql_sessions.get(visit_id), visit_id)]
+    assert found == []
+
+
+def test_fixture_covers_the_page_urls(sql_sessions):
+    paths = {hit['page']['pagePath'] for session in sql_sessions.values() for hit in session['hits']}
+    assert {'/a/c', '/a/', '/x/y/', '/caf%C3%A9/%EF%BF%BDt%EF%BF%BD'} <= paths
+
+
+def test_unquote_matches_python():
+    r = random.Random(3)
+    pieces = [lambda: '%{:02X}'.format(r.randint(0, 0x7F)), lambda: '%{:02x}'.format(r.randint(0x80, 0xBF)),
+              lambda: '%{:02X}'.format(r.randint(0xC0, 0xFF)), lambda: r.choice(['a', '/', '%', '%z', 'é']),
+              lambda: quote(chr(r.choice([r.randint(0x80, 0xD7FF), r.randint(0xE000, 0x10FFFF)])))]
+    values = [''.join(r.choice(pieces)() for _ in range(r.randint(1, 8))) for _ in range(3000)]
+    assert run_javascript(UNQUOTE_FUNCTION, values) == [unquote(value) for value in values]
+
+
+def test_dot_segments_match_urllib3():
+    r = random.Random(5)
+    paths = ['/' + '/'.join(r.choice(['', '.', '..', 'a', 'b', '.c', '..d']) for _ in range(r.randint(1, 6)))
+             for _ in range(1000)]
+    assert run_javascript(DOT_SEGMENTS_FUNCTION, paths) == [parse_url('https://h' + path).path for path in paths]
+
+
+def test_functions_keep_nulls():
+    assert run_javascript(DOT_SEGMENTS_FUNCTION, [None]) == [None]
+    assert run_javascript(ENCODE_FUNCTION, [None], [PATH_CHARS]) == [None]
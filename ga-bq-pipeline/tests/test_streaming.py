@@ -0,0 +1,54 @@
+"""
+The streaming mode against a batch run, on a synthetic day from benchmarks.hits with the service fakes of
+benchmarks.fakes: the sessions it writes are the same, only in session id order.
+
+    cd ga-bq-pipeline && python -m pytest tests/test_streaming.py
+"""
+import gzip
+import json
+import pytest
+from benchmarks.fakes import FakeServices, offline_pipeline
+from benchmarks.hits import generate_hits
+
+DATE = '20200101'
+
+
+@pytest.fixture(scope='module')
+def hits():
+    return generate_hits(sessions=120, impressions=3, custom_dimensions=6, custom_metrics=2, seed=11)
+
+
+def run(hits, source):
+    """
+    Run the day's pipeline in the working directory
+    @return: The sessions of the output file, in file order
+    """
+    pipeline = offline_pipeline(FakeServices(hits), env={'source': source}, date=DATE)
+    pipeline.pipeline()
+    with gzip.open(pipeline.output_file, 'rt', encoding='utf-8') as lines:
+        return [json.loads(line) for line in lines]
+
+
+@pytest.fixture(scope='module')
+def batch_sessions(hits, tmp_path_factory):
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(tmp_path_factory.mktemp('batch'))
+        return run(hits, {})
+
+
+def test_streaming_writes_the_batch_sessions(hits, batch_sessions, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sessions = run(hits, {'stream': True})
+    assert [session['visitId'] for session in sessions] == sorted(session['visitId'] for session in sessions)
+    assert sorted(sessions, key=lambda session: session['visitId']) == \
+        sorted(batch_sessions, key=lambda session: session['visitId'])
+
+
+def test_missing_values_are_none(hits):
+    pipeline = offline_pipeline(FakeServices(hits), env={'source': {'stream': True}}, date=DATE)
+    sessions = list(pipeline.stream_sessions())
+    # Read as strings or None, as the batch run reads them, rather than NaN
+    assert any(session['ev'].isnull().any() for session in sessions)
+    for session in sessions:
+        values = session.drop(columns='timestamp').values.ravel()
+        assert all(value is None or isinstance(value, str) for value in values)
@@ -0,0 +1,226 @@
+"""
+The Full Visitor Id lookups against the Analytics API fake of benchmarks.fakes: the request rate, the retries of rate
+limited calls and what's kept in the client id store.
+
+    cd ga-bq-pipeline && python -m pytest tests
+"""
+import json
+import logging
+import threading
+import time
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+from benchmarks.fakes import FakeAnalyticsApi, FakeBatchRequest
+from ga_bq_pipeline import visitor_id
+from ga_bq_pipeline.rate_limit import TokenBucket
+from ga_bq_pipeline.visitor_id import VisitorIdResolver
+
+PROPERTY_ID = 'UA-12345678-1'
+
+
+def http_error(status, reason=None):
+    content = {'error': {'errors': [{'reason': reason, 'message': 'Quota exceeded'}]}}
+    return HttpError(httplib2.Response({'status': status}), json.dumps(content).encode('utf-8'))
+
+
+class RejectingBatchRequest(FakeBatchRequest):
+    """
+    A batch request the API answers with the error the fake is set up to send, or answers normally
+    """
+
+    def execute(self, http=None):
+        error = self.api.next_error(self.requests)
+        if error is None:
+            return super().execute(http)
+        if error == 'batch':
+            raise http_error(429)
+        for request_id, _ in self.requests:
+            self.callback(request_id, None, error)
+
+
+class RejectingAnalyticsApi(FakeAnalyticsApi):
+    """
+    FakeAnalyticsApi that rejects its first batches with an error, every call of the batch, or the whole batch
+    request with 'batch'
+    """
+
+    def __init__(self, errors):
+        """
+        @param errors: Errors of the first batch requests, None answers a batch normally
+        """
+        super().__init__()
+        self.errors = list(errors)
+        self.attempts = 0
+        self.times = []
+
+    def new_batch_http_request(self, callback=None):
+        return RejectingBatchRequest(self, callback)
+
+    def next_error(self, requests):
+        with self._lock:
+            self.attempts += 1
+            self.times.append((time.monotonic(), len(requests)))
+            return self.errors.pop(0) if self.errors else None
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    # Retries wait milliseconds rather than seconds
+    monkeypatch.setattr(visitor_id, 'RETRY_BASE_DELAY', 0.001)
+
+
+def resolver(api, cache_path=':memory:', **kwargs):
+    kwargs.setdefault('requests_per_second', 10 ** 6)
+    resolver = VisitorIdResolver('offline.json', logging.getLogger('test'), cache_path=cache_path, **kwargs)
+    resolver._api = api
+    return resolver
+
+
+def pairs(count):
+    return [('{}.{}'.format(i, 1500000000), PROPERTY_ID) for i in range(count)]
+
+
+def expected(pairs):
+    return {pair: FakeAnalyticsApi.hashed_client_id(*pair) for pair in pairs}
+
+
+def test_token_bucket_holds_the_rate():
+    bucket = TokenBucket(50, 5)
+    start = time.monotonic()
+    for _ in range(30):
+        bucket.acquire()
+    # The first 5 tokens are in the bucket, the other 25 come at 50 a second
+    assert time.monotonic() - start >= 0.45
+
+
+def test_lookups_are_rate_limited():
+    api = RejectingAnalyticsApi([])
+    ids = resolver(api, requests_per_second=40, burst=10, batch_size=10, workers=4)
+    lookups = pairs(50)
+    start = time.monotonic()
+    assert ids.resolve_many(lookups) == expected(lookups)
+    # 10 calls go at once, the other 40 at 40 calls a second, even with 4 batches in flight
+    assert time.monotonic() - start >= 0.95
+    assert api.requests == 50
+
+
+@pytest.mark.parametrize('error', ['batch', http_error(429), http_error(403, 'userRateLimitExceeded')])
+def test_rate_limited_calls_are_retried(error):
+    api = RejectingAnalyticsApi([error, error])
+    ids = resolver(api, batch_size=10, workers=1)
+    lookups = pairs(10)
+    assert ids.resolve_many(lookups) == expected(lookups)
+    assert api.attempts == 3
+    assert ids.stats['batches'] == 3
+
+
+def test_backoff_grows_between_retries(monkeypatch):
+    monkeypatch.setattr(visitor_id, 'RETRY_BASE_DELAY', 0.05)
+    api = RejectingAnalyticsApi(['batch', 'batch', 'batch'])
+    ids = resolver(api, batch_size=10, workers=1)
+    ids.resolve_many(pairs(10))
+    times = [t for t, _ in api.times]
+    gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+    # Each wait is base * 2^attempt plus up to as much again of jitter
+    assert [gap >= 0.05 * 2 ** i for i, gap in enumerate(gaps)] == [True, True, True]
+
+
+def test_failed_lookups_are_not_persisted(tmp_path):
+    cache_path = str(tmp_path / 'client_ids.db')
+    lookups = pairs(10)
+    rate_limited = RejectingAnalyticsApi(['batch'] * 10)
+    ids = resolver(rate_limited, cache_path=cache_path, batch_size=10, max_retries=2)
+    assert ids.resolve_many(lookups) == {pair: '' for pair in lookups}
+    assert rate_limited.attempts == 3
+    bad_request = RejectingAnalyticsApi([http_error(400, 'badRequest')])
+    failed = resolver(bad_request, cache_path=cache_path, batch_size=10)
+    assert failed.resolve_many(lookups) == {pair: '' for pair in lookups}
+    assert bad_request.attempts == 1
+    assert ids.cache.get_many(PROPERTY_ID, [c for c, _ in lookups]) == {}
+    ids.close()
+    failed.close()
+
+    # A later run asks again, and keeps the answers
+    api = RejectingAnalyticsApi([])
+    retry = resolver(api, cache_path=cache_path, batch_size=10)
+    assert retry.resolve_many(lookups) == expected(lookups)
+    assert retry.stats['misses'] == 10
+    retry.close()
+    stored = resolver(RejectingAnalyticsApi([]), cache_path=cache_path)
+    assert stored.resolve_many(lookups) == expected(lookups)
+    assert stored.stats == {'hits': 10, 'misses': 0, 'batches': 0, 'requests': 0}
+    stored.close()
+
+
+def test_resolved_pairs_are_only_counted_once():
+    ids = resolver(RejectingAnalyticsApi([]), batch_size=10)
+    lookups = pairs(25)
+    ids.resolve_many(lookups)
+    for client_id, property_id in lookups:
+        ids.resolve(client_id, property_id)
+    assert ids.stats == {'hits': 0, 'misses': 25, 'batches': 3, 'requests': 25}
+
+
+def test_concurrent_days_request_each_pair_once():
+    api = RejectingAnalyticsApi([])
+    api.latency = 0.02
+    ids = resolver(api, batch_size=10)
+    days = [pairs(200)[day * 20:day * 20 + 40] for day in range(8)]
+    results = [None] * len(days)
+
+    def resolve(day):
+        results[day] = ids.resolve_many(days[day])
+
+    threads = [threading.Thread(target=resolve, args=(day,)) for day in range(len(days))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Days that overlap wait for the pairs another day is requesting rather than sending them again
+    assert results == [expected(day) for day in days]
+    assert api.requests == 180
+    stats = ids.stats
+    assert stats['misses'] == stats['requests'] == 180
+    assert stats['hits'] == 0
+
+
+def test_waiting_calls_get_the_request_error():
+    api = RejectingAnalyticsApi([])
+    ids = resolver(api, batch_size=10)
+    lookups = pairs(10)
+    started = threading.Event()
+    release = threading.Event()
+    requested = []
+
+    def fetch(batch):
+        requested.append(batch)
+        started.set()
+        release.wait(5)
+        raise RuntimeError('connection reset')
+
+    ids.fetch = fetch
+    errors = []
+
+    def resolve():
+        try:
+            ids.resolve_many(lookups)
+        except RuntimeError as ex:
+            errors.append(str(ex))
+
+    first = threading.Thread(target=resolve)
+    first.start()
+    started.wait(5)
+    second = threading.Thread(target=resolve)
+    second.start()
+    # The second call is waiting on the first one's request, rather than sending its own
+    second.join(0.2)
+    assert second.is_alive()
+    release.set()
+    first.join()
+    second.join()
+    assert errors == ['connection reset', 'connection reset']
+    assert len(requested) == 1
+    # Nothing is left pending, a later call requests the pairs again
+    del ids.fetch
+    assert ids.resolve_many(lookups) == expected(lookups)